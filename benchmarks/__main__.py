@@ -0,0 +1,133 @@
+"""
+benchmarks of the /run-code pipeline, runs on a single machine without redis or network.
+
+usage (from the repository root):
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks [--suite all|load|micro] [--store fakeredis|memory] [--output FILE] [--baseline FILE]
+
+the report is JSON, with --baseline the run exits with status 1 when a load scenario's
+p95 latency or throughput is worse than the baseline's by more than --tolerance.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+from typing import Dict, List
+
+import settings
+from . import fake_redis
+
+
+def _numbers(kind):
+    return lambda value: [kind(item) for item in value.split(",")]
+
+
+def _scenario_key(scenario: Dict):
+    return scenario["cases"], scenario["runtime_sec"], scenario["concurrency"]
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """
+    Returns:
+        List[str]: a description of every load scenario that regressed
+    """
+    previous = {_scenario_key(scenario): scenario for scenario in baseline.get("load", [])}
+    regressions = []
+    for scenario in report.get("load", []):
+        before = previous.get(_scenario_key(scenario))
+        if before is None:
+            continue
+        name = "cases={} runtime={} concurrency={}".format(*_scenario_key(scenario))
+        if scenario["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {scenario['p95_ms']}ms")
+        if scenario["submissions_per_sec"] < before["submissions_per_sec"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {before['submissions_per_sec']} -> {scenario['submissions_per_sec']} submissions/sec"
+            )
+    return regressions
+
+
+@contextlib.contextmanager
+def _silenced_stdout():
+    # workers started by a forkserver don't inherit sys.stdout, the file descriptor is redirected too
+    sys.stdout.flush()
+    saved = os.dup(1)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        os.dup2(devnull.fileno(), 1)
+        try:
+            yield
+        finally:
+            os.dup2(saved, 1)
+            os.close(saved)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the run_code pipeline")
+    parser.add_argument("--suite", choices=["all", "load", "micro"], default="all")
+    parser.add_argument("--cases", type=_numbers(int), default=[1, 10, 50], help="test cases per submission")
+    parser.add_argument("--runtimes", type=_numbers(float), default=[0, 0.01], help="seconds per test case")
+    parser.add_argument("--concurrency", type=_numbers(int), default=[1, 4, 16], help="concurrent users")
+    parser.add_argument("--submissions", type=int, default=32, help="submissions per load scenario")
+    parser.add_argument("--pool-size", type=int, default=settings.WORKER_POOL_SIZE)
+    parser.add_argument(
+        "--result-cache", action="store_true",
+        help="keep the result cache on, repeated submissions are then served from it",
+    )
+    parser.add_argument(
+        "--store", choices=["fakeredis", "memory"], default="fakeredis",
+        help="in-process stand-in of redis, 'memory' is the store_backend of single node deployments",
+    )
+    parser.add_argument("--output", default="-", help="file the JSON report is written to")
+    parser.add_argument("--baseline", help="JSON report of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression ratio")
+    args = parser.parse_args()
+
+    fake_redis.install(args.store)
+    settings.RESULT_CACHE_ENABLED = args.result_cache
+    settings.EXECUTION_BACKEND = "local"
+
+    from run_code import run_tests
+    from run_code.worker_pool import WorkerPool
+    from . import load, micro
+
+    run_tests.pool = WorkerPool(size=args.pool_size)
+    report = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "pool_size": args.pool_size,
+        "run_tests_mode": settings.RUN_TESTS_MODE,
+        "worker_start_method": settings.WORKER_START_METHOD,
+        "store": args.store,
+    }
+    # the app prints every submission and result
+    with _silenced_stdout():
+        if args.suite in ("all", "micro"):
+            report["micro"] = micro.run()
+        if args.suite in ("all", "load"):
+            report["load"] = asyncio.run(
+                load.run(args.cases, args.runtimes, args.concurrency, args.submissions)
+            )
+
+    output = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
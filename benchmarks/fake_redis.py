@@ -0,0 +1,29 @@
+from run_code.memory_store import AsyncMemoryClient, MemoryStore
+from run_code.redis_operations import (
+    async_blocking_operations,
+    async_redis_operations,
+    async_stream_operations,
+    redis_operations,
+)
+
+
+def install(store: str = "fakeredis"):
+    """
+    points the shared redis clients at an in-process store, the sync and async clients
+    see the same data like they would with a real server. "fakeredis" emulates a redis
+    server, "memory" is the store of settings.STORE_BACKEND = "memory" (fakeredis isn't needed).
+    """
+    if store == "memory":
+        memory_store = MemoryStore()
+        redis_operations.client = memory_store
+        async_redis_operations.client = AsyncMemoryClient(memory_store)
+        async_blocking_operations.client = AsyncMemoryClient(memory_store)
+        async_stream_operations.client = AsyncMemoryClient(memory_store)
+        return memory_store
+    import fakeredis
+    server = fakeredis.FakeServer()
+    redis_operations.client = fakeredis.FakeRedis(server=server)
+    async_redis_operations.client = fakeredis.FakeAsyncRedis(server=server)
+    async_blocking_operations.client = fakeredis.FakeAsyncRedis(server=server)
+    async_stream_operations.client = fakeredis.FakeAsyncRedis(server=server)
+    return server
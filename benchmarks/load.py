@@ -0,0 +1,98 @@
+"""
+end to end load benchmark: simulated users submit a solution to `/run-code` and
+long poll `/get-result` for it, against the ASGI app of main.py and an in-process redis.
+"""
+import asyncio
+import itertools
+import time
+from typing import Dict, List
+
+import httpx
+
+import main
+import settings
+from .stats import latency_summary
+
+
+def solution(runtime: float) -> str:
+    """a solution whose every test case takes `runtime` seconds"""
+    if not runtime:
+        return "def solve(a, b):\n    return a + b\n"
+    return f"import time\n\n\ndef solve(a, b):\n    time.sleep({runtime})\n    return a + b\n"
+
+
+def test_cases(count: int) -> str:
+    """the `test_cases` form field of a submission with `count` test cases"""
+    return repr([
+        {"id": i, "input": f"[{i}, {i + 1}]", "expected": str(2 * i + 1)} for i in range(count)
+    ])
+
+
+async def _submit(client: httpx.AsyncClient, source_code: str, form: Dict) -> bool:
+    response = await client.post("/run-code", files={"python_file": ("solution.py", source_code)}, data=form)
+    if response.status_code != 200:
+        return False
+    execution_id = response.json()["execution_id"]
+    response = await client.get(
+        f"/get-result/{execution_id}", params={"wait": settings.GET_RESULT_MAX_WAIT_SEC}
+    )
+    return response.status_code == 200
+
+
+async def _user(
+    address: str, submissions: int, source_code: str, form: Dict, latencies: List[float], errors: List[int]
+):
+    # every user has its own address, a user can only have one submission running
+    transport = httpx.ASGITransport(app=main.app, client=(address, 50000))
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        for _ in range(submissions):
+            start = time.perf_counter()
+            if await _submit(client, source_code, form):
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors.append(1)
+
+
+async def run_scenario(cases: int, runtime: float, concurrency: int, submissions: int) -> Dict:
+    """
+    Args:
+        cases (int): test cases per submission
+        runtime (float): seconds each test case takes
+        concurrency (int): number of users submitting at the same time
+        submissions (int): total number of submissions, split between the users
+
+    Returns:
+        Dict: the scenario, its latency percentiles and submissions per second
+    """
+    source_code = solution(runtime)
+    form = {"allowed_imports": "time", "test_cases": test_cases(cases)}
+    per_user = max(1, submissions // concurrency)
+    latencies: List[float] = []
+    errors: List[int] = []
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        _user(f"10.0.{i // 256}.{i % 256}", per_user, source_code, form, latencies, errors)
+        for i in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "cases": cases,
+        "runtime_sec": runtime,
+        "concurrency": concurrency,
+        "submissions": len(latencies),
+        "errors": len(errors),
+        "elapsed_sec": round(elapsed, 3),
+        "submissions_per_sec": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        **latency_summary(latencies),
+    }
+
+
+async def run(case_counts: List[int], runtimes: List[float], concurrencies: List[int], submissions: int) -> List[Dict]:
+    """runs every combination of the parameters with the worker pool started once"""
+    results = []
+    async with main.lifespan(main.app):
+        for cases, runtime, concurrency in itertools.product(case_counts, runtimes, concurrencies):
+            results.append(await run_scenario(cases, runtime, concurrency, submissions))
+    return results
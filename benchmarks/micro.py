@@ -0,0 +1,127 @@
+"""micro-benchmarks of the stages a submission goes through"""
+import importlib.util
+import itertools
+import pickle
+import timeit
+from typing import Callable, Dict
+
+import settings
+from run_code import run_tests, utils
+from run_code.job_queue import decode_job, encode_job
+from run_code.test_suites import decode_suite, encode_suite
+from run_code.validation import get_policy, validate_source
+from run_code.worker_pool import Worker, WorkerPool, get_context
+from .load import solution, test_cases
+
+
+def measure(func: Callable, number: int, repeat: int = 5) -> Dict[str, float]:
+    """best and mean time of a single call of func, in microseconds"""
+    timings = [t / number for t in timeit.Timer(func).repeat(repeat=repeat, number=number)]
+    return {
+        "best_us": round(min(timings) * 1e6, 3),
+        "mean_us": round(sum(timings) / len(timings) * 1e6, 3),
+        "calls": number * repeat,
+    }
+
+
+def bench_convert_literal(counts=(10, 100, 1000)) -> Dict:
+    return {
+        f"{count}_cases": measure(lambda form=test_cases(count): utils.convert_literal(form), number=20)
+        for count in counts
+    }
+
+
+def bench_validation() -> Dict:
+    source_code = solution(0.01) + "".join(f"\n\ndef helper_{i}(x):\n    return x * {i}\n" for i in range(50))
+    policy = get_policy(["time", "math"])
+    # a new hash for every call skips the verdict cache
+    hashes = (f"benchmark-{i}" for i in itertools.count())
+    return {
+        "cold": measure(lambda: validate_source(source_code, policy, next(hashes)), number=200),
+        "cached": measure(lambda: validate_source(source_code, policy, "benchmark"), number=2000),
+    }
+
+
+def bench_serialization(count: int = 100) -> Dict:
+    # what crosses the worker pipe, a job going in and the results coming out
+    cases = utils.convert_literal(test_cases(count))
+    source_code = solution(0)
+    job = (run_tests._execute_suite, (source_code, utils.hash_source_code(source_code), cases, 5))
+    results = [{"id": i, "output": 2 * i + 1, "error": None, "error_message": None} for i in range(count)]
+    raw_job = encode_job(source_code, "hash", cases, "execution", "user")
+    suite = encode_suite(cases)
+    return {
+        "test_cases": count,
+        "pipe_job": measure(lambda: pickle.loads(pickle.dumps(job)), number=200),
+        "pipe_results": measure(lambda: pickle.loads(pickle.dumps(results)), number=200),
+        "queue_job": measure(lambda: decode_job(encode_job(source_code, "hash", cases, "execution", "user")), number=200),
+        "queue_job_decode": measure(lambda: decode_job(raw_job), number=200),
+        "suite_encode": measure(lambda: encode_suite(cases), number=200),
+        "suite_decode": measure(lambda: decode_suite(suite), number=200),
+    }
+
+
+def bench_process_spawn() -> Dict:
+    """the cost of forking a worker per test case against dispatching to a pooled worker"""
+    source_code = solution(0)
+    job = (source_code, utils.hash_source_code(source_code), {"id": 1, "input": [1, 2], "expected": 3})
+
+    pool = WorkerPool(size=1)
+    pool.start()
+    try:
+        dispatch = measure(lambda: list(pool.run(run_tests._execute_function, [job], timeout=5)), number=50)
+    finally:
+        pool.shutdown()
+    return {
+        "spawn_and_stop": measure(lambda: Worker().stop(), number=5, repeat=3),
+        "pooled_dispatch": dispatch,
+        "cold_start": {method: bench_cold_start(method) for method in ("fork", "forkserver")},
+    }
+
+
+def bench_cold_start(start_method: str) -> Dict:
+    """a new worker started with start_method until its first job, importing the preloaded modules, is done"""
+    modules = [name for name in settings.PRELOAD_MODULES if importlib.util.find_spec(name) is not None]
+    source_code = "".join(f"import {name}\n" for name in modules) + solution(0)
+    job = (source_code, utils.hash_source_code(source_code), {"id": 1, "input": [1, 2], "expected": 3})
+    context = get_context(start_method)
+    # the forkserver itself starts with the first worker, it's not part of the cold start
+    Worker(context).stop()
+
+    def cold_start():
+        worker = Worker(context)
+        worker.send(run_tests._execute_function, job)
+        done = False
+        while not done:
+            _, _, done = worker.receive(timeout=5)
+        worker.stop()
+
+    return measure(cold_start, number=5, repeat=3)
+
+
+def bench_large_results(sizes=(10_000, 1_000_000)) -> Dict:
+    """a job returning a large output, through the worker's pipe against through shared memory"""
+    source_code = "def solve(n):\n    return list(range(n))\n"
+    report = {}
+    for transport, shm_min_bytes in (("pipe", 0), ("shared_memory", 1)):
+        pool = WorkerPool(size=1, shm_min_bytes=shm_min_bytes)
+        pool.start()
+        try:
+            for size in sizes:
+                job = (source_code, utils.hash_source_code(source_code), {"id": 1, "input": [size]})
+                report[f"{transport}.{size}_items"] = measure(
+                    lambda: list(pool.run(run_tests._execute_function, [job], timeout=30)), number=5, repeat=3
+                )
+        finally:
+            pool.shutdown()
+    return report
+
+
+def run() -> Dict:
+    return {
+        "convert_literal": bench_convert_literal(),
+        "validation": bench_validation(),
+        "serialization": bench_serialization(),
+        "process_spawn": bench_process_spawn(),
+        "large_results": bench_large_results(),
+    }
@@ -1,32 +1,59 @@
-from fastapi import Response, Request
+from fastapi import HTTPException, Response, Request
 from fastapi import status
 from functools import wraps
+import uuid
 import dependencies
-from run_code.redis_operations import redis_operations
+from run_code import admission, metrics
+import settings
 
 
 def prevent_overlapping_process(func):
     """
-    Decorator to prevent overlapping processes based on IP address.
+    Decorator to bound the processes of each user (see dependencies.get_user_id),
+    and to keep the number of submissions in flight bounded.
+
+    one of the user's slots is taken atomically when the submission is received (it's
+    released once the result is collected), the execution id is set on `request.state`.
 
     Args:
-        func (callable): The function to be decorated.
+        func (callable): The async endpoint to be decorated.
 
     Returns:
         callable
     """
     
     @wraps(func)
-    def wrapper(request: Request, *args, **kwargs):
-        # if client's ip address found in the memory we reject the request.
-        ip_addr = request.client.host
-        result = redis_operations.get_value(ip_addr)
-        if result:
-            print(f"result of prevent overlapping decorator from redis: {result}")
+    async def wrapper(request: Request, *args, **kwargs):
+        userid = dependencies.get_user_id(request)
+        execution_id = str(uuid.uuid4())
+        admitted = await admission.admit_async(userid, execution_id)
+        metrics.ADMISSIONS.inc(outcome={
+            admission.ADMITTED: "admitted", admission.USER_BUSY: "user_busy", admission.SATURATED: "saturated",
+        }.get(admitted, "error"))
+        if admitted == admission.USER_BUSY:
             return Response(
-                content = "there is already a process[%s] running please wait..." % result,
+                content = "there is already a process running please wait...",
                 status_code=status.HTTP_400_BAD_REQUEST
             )
-        return func(request, *args, **kwargs)       
+        if admitted == admission.SATURATED:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="too many submissions in flight, please try again later.",
+                headers={"Retry-After": str(settings.ADMISSION_RETRY_AFTER_SEC)},
+            )
+        if admitted is None:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="could not schedule the execution, please try again later.",
+            )
+
+        request.state.execution_id = execution_id
+        try:
+            response = await func(request, *args, **kwargs)
+        except BaseException:
+            # nothing was scheduled, the slots are given back right away
+            await admission.release_async(userid, execution_id, free_user=True)
+            raise
+        return response
         
-    return wrapper
\ No newline at end of file
+    return wrapper
@@ -1,16 +1,53 @@
+import ast
 from fastapi import Form, File, HTTPException, UploadFile, Depends, Header, Request
-from typing import List, Dict, Annotated
+from typing import List, Dict, Annotated, Iterator, Optional
+import run_code.comparators
+import run_code.complexity
+import run_code.metrics
+import run_code.profiling
+import run_code.regrade
 import run_code.utils
+import run_code.test_suites
+from run_code.validation import get_policy, validate_source
+from run_code.test_case_files import TestCaseFile, write_test_case_file
+import settings
 
 
 allowed_imports_description = "Comma separated list of allowed imports example: 'math, os'"
 test_cases_description = \
     "example: '[{'id': 1, 'input': '[1, 2]', 'output': 3}, {'id': 2, 'input': '[1, 4]', 'output': 5}]'"
+cpu_limit_description = "seconds of CPU time (user + sys) each test case may use"
+memory_limit_description = "megabytes each test case may allocate"
+comparator_description = "how outputs are compared with the expected values: " + \
+    ", ".join(run_code.comparators.COMPARATORS)
+fail_fast_description = "skip the remaining test cases as soon as one fails"
+priority_description = "scheduling class of the execution, from the highest: " + \
+    ", ".join(settings.ADMISSION_PRIORITIES)
+profile_description = "profile solve on some test cases, the report is added to their results " + \
+    "(the results of a profiled execution are never cached)"
+profile_tools_description = "comma separated profilers: " + ", ".join(run_code.profiling.TOOLS)
+profile_test_cases_description = "comma separated ids of the profiled test cases " + \
+    f"(the first {settings.PROFILE_MAX_TEST_CASES} without them)"
+test_cases_file_description = "test cases as a JSONL file, one JSON object per line " + \
+    "(example: {'id': 1, 'input': [1, 2], 'expected': 3}), parsed one line at a time"
+test_suite_id_description = "id of a test suite registered with /test-suites, replaces test_cases"
+regrade_submissions_description = "a zip archive of .py files named after their submission ids, " + \
+    "or a JSONL file of {'submission_id': ..., 'source': ...} lines"
+input_template_description = "solve's arguments as a literal with placeholders replaced at every size n: " + \
+    "'$n' (n), '$range' (list(range(n))), '$ints' (n random integers), '$string' (n random letters), " + \
+    "example: ['$ints', '$n']"
+input_generator_description = "python code defining generate(n), which returns the list of solve's " + \
+    "arguments for size n, it's validated like the solution (replaces input_template)"
 function_not_found_description = """
 Function 'solve' not found. please wrap your solution in a function called 'solve'.
 """
 
 
+def get_stage_timings() -> Dict[str, float]:
+    """stage timings of the request, dependencies are cached so every dependency shares them"""
+    return {}
+
+
 def get_allowed_imports(allowed_imports: str=Form(..., description=allowed_imports_description)):
     """extract a list of allowed imports from a string
 
@@ -23,22 +60,201 @@ def get_allowed_imports(allowed_imports: str=Form(..., description=allowed_impor
     return [item.strip() for item in allowed_imports.split(",")]
 
 
-def get_function(python_file: UploadFile=File(...), allowed_imports: List=Depends(get_allowed_imports)):
-    python_file_ = run_code.utils.PythonFile(python_file, allowed_imports)
-    is_valid, error_msg = python_file_.validate()
+def get_python_file(
+    python_file: UploadFile=File(...),
+    allowed_imports: List=Depends(get_allowed_imports),
+    timings: Dict[str, float]=Depends(get_stage_timings),
+) -> run_code.utils.PythonFile:
+    """validate the uploaded solution, it is only compiled and executed inside the workers"""
+    with run_code.metrics.timed("upload", timings):
+        python_file_ = run_code.utils.PythonFile(python_file, allowed_imports)
+    with run_code.metrics.timed("validation", timings):
+        is_valid, error_msg = python_file_.validate()
     if not is_valid:
         raise HTTPException(status_code=422, detail=error_msg)
-    func = python_file_.extract_function("solve")
-    if not func:
+    if not python_file_.defines_function("solve"):
         raise HTTPException(status_code=422, detail=function_not_found_description)
-    return func
+    return python_file_
 
 
-def get_test_cases(test_cases: str=Form(..., description=test_cases_description)) -> List[Dict]:
+def parse_test_cases(
+    test_cases: str=Form(..., description=test_cases_description),
+    timings: Dict[str, float]=Depends(get_stage_timings),
+) -> List[Dict]:
     # print(test_cases, f" before {type(test_cases)}")
     try:
-        result = run_code.utils.convert_literal(test_cases)
+        with run_code.metrics.timed("parse_test_cases", timings):
+            result = run_code.utils.convert_literal(test_cases)
     except (SyntaxError, Exception) as e:
         raise HTTPException(status_code=422, detail="INVALID TEST CASE FORMAT: " + str(e))
     # print(result, f" after {type(result)}")
     return result
+
+
+def get_resource_limits(
+    cpu_limit: Optional[float]=Form(None, gt=0, description=cpu_limit_description),
+    memory_limit: Optional[int]=Form(None, gt=0, description=memory_limit_description),
+) -> Dict[str, Optional[float]]:
+    """optional per test case limits, enforced inside the workers"""
+    return {"cpu_limit": cpu_limit, "memory_limit": memory_limit}
+
+
+def get_judging(
+    comparator: str=Form("exact", description=comparator_description),
+    tolerance: float=Form(settings.COMPARATOR_TOLERANCE, ge=0, description="tolerance of the 'float' comparator"),
+    fail_fast: bool=Form(False, description=fail_fast_description),
+) -> Dict:
+    """how the outputs are judged, the verdicts are given inside the workers"""
+    if comparator not in run_code.comparators.COMPARATORS:
+        raise HTTPException(status_code=422, detail=f"unknown comparator '{comparator}'.")
+    return {"comparator": comparator, "tolerance": tolerance, "fail_fast": fail_fast}
+
+
+def get_priority(
+    priority: str=Form(settings.ADMISSION_DEFAULT_PRIORITY, description=priority_description),
+) -> str:
+    if priority not in settings.ADMISSION_PRIORITIES:
+        raise HTTPException(status_code=422, detail=f"unknown priority '{priority}'.")
+    return priority
+
+
+def get_profiling(
+    profile: bool=Form(False, description=profile_description),
+    profile_tools: str=Form(",".join(run_code.profiling.TOOLS), description=profile_tools_description),
+    profile_test_cases: Optional[str]=Form(None, description=profile_test_cases_description),
+) -> Optional[Dict]:
+    """which profilers run solve and on which test cases, None when profiling is off"""
+    if not profile:
+        return None
+    tools = [tool.strip() for tool in profile_tools.split(",") if tool.strip()]
+    unknown = [tool for tool in tools if tool not in run_code.profiling.TOOLS]
+    if unknown or not tools:
+        raise HTTPException(status_code=422, detail=f"unknown profile tools '{profile_tools}'.")
+    test_case_ids = None
+    if profile_test_cases:
+        test_case_ids = [_id.strip() for _id in profile_test_cases.split(",") if _id.strip()]
+        if len(test_case_ids) > settings.PROFILE_MAX_TEST_CASES:
+            raise HTTPException(
+                status_code=422, detail=f"at most {settings.PROFILE_MAX_TEST_CASES} test cases can be profiled."
+            )
+    return {"tools": tools, "test_case_ids": test_case_ids}
+
+
+def get_complexity_input(
+    input_template: Optional[str]=Form(None, description=input_template_description),
+    input_generator: Optional[str]=Form(None, description=input_generator_description),
+    allowed_imports: List=Depends(get_allowed_imports),
+) -> Dict:
+    """the inputs of a complexity analysis, a validated generator or a template"""
+    if (input_template is None) == (input_generator is None):
+        raise HTTPException(status_code=422, detail="either input_template or input_generator is required.")
+    if input_generator is not None:
+        generator_hash = run_code.utils.hash_source_code(input_generator)
+        result = validate_source(input_generator, get_policy(allowed_imports), generator_hash)
+        if not result.is_valid:
+            raise HTTPException(status_code=422, detail=[violation.as_dict() for violation in result.violations])
+        if run_code.complexity.GENERATOR_FUNCTION not in result.defined_names:
+            raise HTTPException(status_code=422, detail="Function 'generate' not found in input_generator.")
+        return {"generator_source": input_generator, "generator_hash": generator_hash}
+    try:
+        template = ast.literal_eval(input_template)
+    except (SyntaxError, ValueError) as e:
+        raise HTTPException(status_code=422, detail="INVALID INPUT TEMPLATE: " + str(e))
+    if not isinstance(template, (list, tuple)) or not run_code.complexity.has_placeholder(template):
+        raise HTTPException(
+            status_code=422, detail="input_template must be the list of solve's arguments with a placeholder."
+        )
+    return {"template": template}
+
+
+def get_complexity_sizes(
+    min_size: int=Form(16, ge=1, description="smallest input size"),
+    max_size: int=Form(2 ** 20, ge=1, le=settings.COMPLEXITY_MAX_SIZE, description="largest input size"),
+    growth: float=Form(2.0, gt=1, le=16, description="factor between consecutive sizes"),
+    time_budget: float=Form(
+        settings.COMPLEXITY_DEFAULT_BUDGET_SEC, gt=0, le=settings.COMPLEXITY_MAX_BUDGET_SEC,
+        description="seconds the measurements may take, the sizes stop growing once it's used up",
+    ),
+) -> Dict:
+    if min_size > max_size:
+        raise HTTPException(status_code=422, detail="min_size can't be larger than max_size.")
+    return {"min_size": min_size, "max_size": max_size, "growth": growth, "time_budget": time_budget}
+
+
+def get_user_id(request: Request) -> str:
+    """the user named by the settings.USER_ID_HEADER header, or the client's address without it"""
+    return request.headers.get(settings.USER_ID_HEADER) or request.client.host
+
+
+def get_test_suite_id(
+    test_suite_id: Optional[str]=Form(None, description=test_suite_id_description)
+) -> Optional[str]:
+    return test_suite_id
+
+
+def get_test_cases_file(
+    test_cases_file: Optional[UploadFile]=File(None, description=test_cases_file_description),
+    timings: Dict[str, float]=Depends(get_stage_timings),
+) -> Iterator[Optional[TestCaseFile]]:
+    """copies an uploaded JSONL file of test cases, the executor parses it case by case.
+
+    the copy is removed once the request is done (also when another parameter is rejected
+    after it was written), unless the endpoint handed it over to an executor (see TestCaseFile.hand_over)
+    """
+    if test_cases_file is None:
+        yield None
+        return
+    try:
+        with run_code.metrics.timed("parse_test_cases", timings):
+            written = write_test_case_file(test_cases_file.file)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail="INVALID TEST CASE FORMAT: " + str(e))
+    try:
+        yield written
+    finally:
+        if not written.handed_over:
+            written.close()
+
+
+async def get_test_cases(
+    test_cases: Optional[str]=Form(None, description=test_cases_description),
+    test_cases_file: Optional[TestCaseFile]=Depends(get_test_cases_file),
+    test_suite_id: Optional[str]=Depends(get_test_suite_id),
+    timings: Dict[str, float]=Depends(get_stage_timings),
+) -> List[Dict]:
+    """test cases sent with the request (as a string or a JSONL file), or the ones of a registered test suite"""
+    if test_suite_id is not None:
+        with run_code.metrics.timed("suite_load", timings):
+            suite = await run_code.test_suites.get_suite_async(test_suite_id)
+        if suite is None:
+            raise HTTPException(status_code=404, detail="Test suite not found.")
+        return suite
+    if test_cases_file is not None:
+        return test_cases_file
+    if test_cases is None:
+        raise HTTPException(
+            status_code=422, detail="either test_cases, test_cases_file or test_suite_id is required."
+        )
+    return parse_test_cases(test_cases, timings)
+
+
+def get_regrade_submissions(
+    submissions: UploadFile=File(..., description=regrade_submissions_description),
+    allowed_imports: List=Depends(get_allowed_imports),
+    timings: Dict[str, float]=Depends(get_stage_timings),
+) -> List[Dict]:
+    """parse and validate every submission of a regrade, invalid ones are reported, not rejected"""
+    with run_code.metrics.timed("upload", timings):
+        data = submissions.file.read()
+    try:
+        parsed = run_code.regrade.parse_submissions(data)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail="INVALID SUBMISSIONS: " + str(e))
+    if not parsed:
+        raise HTTPException(status_code=422, detail="no submission found.")
+    if len(parsed) > settings.REGRADE_MAX_SUBMISSIONS:
+        raise HTTPException(
+            status_code=413, detail=f"at most {settings.REGRADE_MAX_SUBMISSIONS} submissions per regrade."
+        )
+    with run_code.metrics.timed("validation", timings):
+        return run_code.regrade.validate_submissions(parsed, allowed_imports)
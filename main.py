@@ -1,69 +1,370 @@
 from fastapi import (
     FastAPI,
     Request,
+    Header,
     status,
     BackgroundTasks,
     Depends,
     HTTPException,
+    Query,
 )
-from fastapi.responses import JSONResponse
-from typing import Annotated, List, Dict
-from types import FunctionType
-import json
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
+from typing import Annotated, AsyncIterator, List, Dict, Optional
+import time
 import uuid
 
+import run_code.admission
+import run_code.complexity
+import run_code.metrics
+import run_code.regrade
 import run_code.utils
 import run_code.run_tests
-from run_code.redis_operations import redis_operations
+import run_code.result_cache
+import run_code.test_suites
+from run_code.job_queue import JobQueue, encode_job
+from run_code.test_case_files import TestCaseFile
+from run_code.exceptions import BlockingConnectionsExhausted
+from run_code.redis_operations import async_blocking_operations, async_redis_operations, async_stream_operations
+from run_code.result_store import count_results_async, get_page_async, read_summary_async
 import settings
-from dependencies import get_test_cases, get_function
+from dependencies import (
+    get_test_cases,
+    get_python_file,
+    get_regrade_submissions,
+    get_allowed_imports,
+    get_complexity_input,
+    get_complexity_sizes,
+    get_judging,
+    get_priority,
+    get_profiling,
+    get_resource_limits,
+    get_test_suite_id,
+    get_stage_timings,
+    get_user_id,
+    parse_test_cases,
+)
 from decorators import prevent_overlapping_process
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if settings.EXECUTION_BACKEND == "queue" and settings.STORE_BACKEND == "memory":
+        raise RuntimeError("the queue execution backend needs the redis store backend.")
+    # fork the sandbox workers once instead of once per test case,
+    # with the queue backend tests are executed by `python -m run_code.worker`
+    if settings.EXECUTION_BACKEND == "local":
+        run_code.run_tests.pool.start()
+    yield
+    run_code.run_tests.pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+job_queue = JobQueue()
+
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # the route template keeps ids out of the labels
+    route = request.scope.get("route")
+    run_code.metrics.REQUEST_SECONDS.observe(
+        time.perf_counter() - start,
+        method=request.method,
+        route=route.path if route is not None else "unmatched",
+        status=response.status_code,
+    )
+    return response
+
+
+async def _run_tests_in_turn(cost: int, **job):
+    """
+    runs the tests once the execution holds a running slot, it waits for it here so the
+    waiting executions don't hold the threads of the threadpool (see admission.wait_for_turn_async)
+    """
+    if cost and not run_code.run_tests.fails_on_cached_results(job["fail_fast"], job.get("cached_results")):
+        try:
+            with run_code.metrics.timed("admission_wait"):
+                await run_code.admission.wait_for_turn_async(job["execution_id"], job["userid"], job["priority"], cost)
+        except BaseException:
+            # run_tests won't give the slots back or close the upload
+            await run_code.admission.release_async(job["userid"], job["execution_id"], free_user=True)
+            if isinstance(job["test_cases"], TestCaseFile):
+                job["test_cases"].close()
+            raise
+    await run_in_threadpool(run_code.run_tests.run_tests, admitted=True, **job)
 
 
 @app.post("/run-code")
 @prevent_overlapping_process
-def run(
+async def run(
     request: Request,
     background_tasks: BackgroundTasks,
-    function: Annotated[FunctionType, Depends(get_function)],
+    python_file: Annotated[run_code.utils.PythonFile, Depends(get_python_file)],
     test_cases: List[Dict] = Depends(get_test_cases),
+    allowed_imports: List[str] = Depends(get_allowed_imports),
+    test_suite_id: Optional[str] = Depends(get_test_suite_id),
+    timings: Dict[str, float] = Depends(get_stage_timings),
+    resource_limits: Dict[str, Optional[float]] = Depends(get_resource_limits),
+    judging: Dict = Depends(get_judging),
+    priority: str = Depends(get_priority),
+    profile: Optional[Dict] = Depends(get_profiling),
+    userid: str = Depends(get_user_id),
 ):
-    ip_addr = request.client.host
-    execution_id = str(uuid.uuid4())
-    
-    # run tests
-    background_tasks.add_task(
-        run_code.run_tests.run_tests,
-        function=function,
-        test_cases=test_cases,
+    # taken by prevent_overlapping_process together with the user's slot
+    execution_id = request.state.execution_id
+
+    job = dict(
+        source_code=python_file.source_code,
+        source_hash=python_file.source_hash,
         execution_id=execution_id,
-        userid=ip_addr
+        userid=userid,
+        priority=priority,
+        profile=profile,
+        **resource_limits,
+        **judging,
     )
+    if settings.EXECUTION_BACKEND == "queue" and isinstance(test_cases, TestCaseFile):
+        # the queue workers can't read this node's files (the upload is removed with the request)
+        test_cases = list(test_cases)
+
+    # only the test cases missing from the result cache get executed,
+    # an uploaded file is handed to the executor as it is, a profiled execution runs everything
+    pending = test_cases
+    if settings.RESULT_CACHE_ENABLED and python_file.is_deterministic() and not isinstance(test_cases, TestCaseFile) \
+            and profile is None:
+        with run_code.metrics.timed("cache_lookup", timings):
+            cached_results, pending, miss_keys = await run_code.result_cache.lookup_async(
+                python_file.source_hash, allowed_imports, test_cases,
+                (resource_limits["cpu_limit"], resource_limits["memory_limit"]),
+                judging["comparator"], judging["tolerance"],
+            )
+        job.update(cached_results=cached_results, cache_keys=miss_keys)
+    cache_hits = len(job.get("cached_results") or [])
+
+    if test_suite_id is None:
+        job["test_cases"] = pending
+    else:
+        # the executor loads the suite from its own cache instead of receiving the test cases
+        job.update(test_cases=None, test_suite_id=test_suite_id)
+        if len(pending) != len(test_cases):
+            job["test_case_ids"] = [testcase.get("id") for testcase in pending]
+
+    if settings.EXECUTION_BACKEND == "queue" and pending:
+        with run_code.metrics.timed("enqueue", timings):
+            enqueued = await job_queue.enqueue_async(encode_job(**job))
+        if not enqueued:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="could not schedule the execution, please try again later.",
+            )
+    else:
+        if isinstance(pending, TestCaseFile):
+            # run_tests closes it once it's done
+            pending.hand_over()
+        # run tests (when every result was cached it only stores them, without touching the pool)
+        background_tasks.add_task(_run_tests_in_turn, len(pending), **job)
+    run_code.metrics.SUBMISSIONS.inc(backend=settings.EXECUTION_BACKEND)
+    run_code.metrics.log_stages(execution_id, timings)
 
     return JSONResponse(
-        content={"message": "execution started.", "execution_id": execution_id},
+        content={"message": "execution started.", "execution_id": execution_id, "cache_hits": cache_hits},
         status_code=status.HTTP_200_OK,
     )
 
 
-@app.get("/get-result/{execution_id}", description="retrieve the result of a user's execution")
-def get_result(execution_id: str, request: Request):
-    ip_addr = request.client.host
-    result = redis_operations.get_value(execution_id)
-    print(ip_addr, result)
-    
-    if result is None:
+@app.post(
+    "/complexity",
+    description="measure solve on inputs of growing sizes and fit the growth of its time and memory, "
+    "it takes one of the user's slots while it runs",
+)
+@prevent_overlapping_process
+async def complexity(
+    request: Request,
+    python_file: Annotated[run_code.utils.PythonFile, Depends(get_python_file)],
+    complexity_input: Dict = Depends(get_complexity_input),
+    sizes: Dict = Depends(get_complexity_sizes),
+    priority: str = Depends(get_priority),
+    userid: str = Depends(get_user_id),
+):
+    # runs on this node's pool whatever the execution backend, the response waits for it.
+    # it waits for its turn without holding a thread (prevent_overlapping_process releases it on errors)
+    with run_code.metrics.timed("admission_wait"):
+        await run_code.admission.wait_for_turn_async(
+            request.state.execution_id, userid, priority,
+            len(run_code.complexity.geometric_sizes(sizes["min_size"], sizes["max_size"], sizes["growth"])),
+        )
+    return await run_in_threadpool(
+        run_code.complexity.analyze,
+        python_file.source_code,
+        python_file.source_hash,
+        request.state.execution_id,
+        userid,
+        priority=priority,
+        admitted=True,
+        **complexity_input,
+        **sizes,
+    )
+
+
+@app.post("/test-suites", description="register a test suite once and reference it by id in /run-code")
+async def register_test_suite(test_cases: List[Dict] = Depends(parse_test_cases)):
+    test_suite_id = await run_code.test_suites.register_suite_async(test_cases)
+    if test_suite_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="could not store the test suite, please try again later.",
+        )
+    return {"test_suite_id": test_suite_id, "test_cases": len(test_cases)}
+
+
+@app.post(
+    "/regrade",
+    description="regrade many submissions against one test suite, the submissions don't take the user's slot",
+)
+async def regrade(
+    background_tasks: BackgroundTasks,
+    submissions: List[Dict] = Depends(get_regrade_submissions),
+    test_cases: List[Dict] = Depends(get_test_cases),
+    resource_limits: Dict[str, Optional[float]] = Depends(get_resource_limits),
+    judging: Dict = Depends(get_judging),
+):
+    regrade_id = str(uuid.uuid4())
+    invalid_results = [
+        run_code.regrade.invalid_result(submission) for submission in submissions if submission["violations"]
+    ]
+    if not await run_code.regrade.start_async(regrade_id, len(submissions), invalid_results):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="could not schedule the regrade, please try again later.",
+        )
+    if isinstance(test_cases, TestCaseFile):
+        # run_regrade closes it once it's done
+        test_cases.hand_over()
+    # runs on this node's pool whatever the execution backend
+    background_tasks.add_task(
+        run_code.regrade.run_regrade,
+        regrade_id,
+        [submission for submission in submissions if not submission["violations"]],
+        test_cases,
+        **resource_limits,
+        **judging,
+    )
+    return {"regrade_id": regrade_id, "submissions": len(submissions), "invalid": len(invalid_results)}
+
+
+@app.get("/regrade/{regrade_id}", description="aggregate progress of a regrade")
+async def get_regrade_progress(regrade_id: str):
+    progress = await run_code.regrade.get_progress_async(regrade_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Regrade not found.")
+    return progress
+
+
+@app.get("/regrade/{regrade_id}/results", description="results of a regrade's submissions stored so far")
+async def get_regrade_results(regrade_id: str):
+    if await run_code.regrade.get_progress_async(regrade_id) is None:
+        raise HTTPException(status_code=404, detail="Regrade not found.")
+    return await run_code.regrade.get_results_async(regrade_id)
+
+
+@app.get("/get-result/{execution_id}", description="retrieve the result of a user's execution, a page at a time")
+async def get_result(
+    execution_id: str,
+    wait: float = Query(
+        0, ge=0, le=settings.GET_RESULT_MAX_WAIT_SEC,
+        description="seconds to wait for the result if it's not ready yet",
+    ),
+    offset: int = Query(0, ge=0, description="position of the first test result of the page"),
+    limit: int = Query(
+        settings.GET_RESULT_PAGE_SIZE, ge=1, le=settings.GET_RESULT_PAGE_SIZE,
+        description="maximum number of test results in the page",
+    ),
+    partial: bool = Query(False, description="return the test results stored so far if it's not done"),
+    userid: str = Depends(get_user_id),
+):
+    done_list = run_code.run_tests.done_list_name(execution_id)
+    # reading the summary also allows users to submit future processes,
+    # the read and the deletes happen atomically in a single round trip
+    summary = await read_summary_async(execution_id, userid, done_list)
+    if summary is None and wait:
+        # block on the completion notification of run_tests instead of polling
+        try:
+            done = await async_blocking_operations.blocking_pop_from_list(done_list, timeout=wait)
+        except BlockingConnectionsExhausted:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="too many requests waiting for results, please try again later.",
+                headers={"Retry-After": str(settings.ADMISSION_RETRY_AFTER_SEC)},
+            )
+        if done is not None:
+            summary = await read_summary_async(execution_id, userid, done_list)
+    if summary is None and partial:
+        total = await count_results_async(execution_id)
+        if total:
+            summary = {"execution_id": execution_id, "total": total, "verdict": None, "complete": False}
+    print(userid, summary)
+
+    if summary is None:
         raise HTTPException(status_code=404, detail="Execution not found.")
 
-    json_result = json.loads(result)
+    # the results stay stored until they expire, so later pages can be requested
+    page = await get_page_async(execution_id, offset, min(limit, summary["total"] - offset))
+    return {**summary, "offset": offset, "limit": limit, "test_result": page}
+
+
+async def _result_events(execution_id: str, last_id: str) -> AsyncIterator[str]:
+    """yields the execution's results as server-sent events until the summary event"""
+    stream_name = run_code.run_tests.events_stream_name(execution_id)
+    idle_since = time.monotonic()
+    # taken here (not by stream_result) so it's given back even if the response is never sent
+    try:
+        async_stream_operations.acquire()
+    except BlockingConnectionsExhausted:
+        # the streams opened since stream_result checked took the last ones
+        yield "event: busy\ndata: {}\n\n"
+        return
+    try:
+        while time.monotonic() - idle_since < settings.STREAM_IDLE_TIMEOUT_SEC:
+            for entry_id, fields in await async_stream_operations.read_stream(stream_name, last_id, block=1000):
+                last_id = entry_id
+                idle_since = time.monotonic()
+                yield f"id: {entry_id}\nevent: {fields['event']}\ndata: {fields['data']}\n\n"
+                if fields["event"] == "summary":
+                    return
+        yield "event: timeout\ndata: {}\n\n"
+    finally:
+        async_stream_operations.release()
+
+
+@app.get(
+    "/stream-result/{execution_id}",
+    description="stream each test result of an execution as a server-sent event, "
+    "followed by a 'summary' event",
+)
+async def stream_result(execution_id: str, last_event_id: Optional[str] = Header(None)):
+    if async_stream_operations.in_use >= async_stream_operations.max_connections:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="too many result streams open, please try again later.",
+            headers={"Retry-After": str(settings.ADMISSION_RETRY_AFTER_SEC)},
+        )
+    # a reconnecting client resumes after the last event it received
+    return StreamingResponse(
+        _result_events(execution_id, last_event_id or "0"),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
 
-    # allow users to submit future processes
-    redis_operations.delete_key(ip_addr)
-    redis_operations.delete_key(execution_id)
-    return json_result
+@app.get("/metrics", description="metrics of this node in the prometheus text format")
+async def get_metrics():
+    queue_depth = await async_redis_operations.get_list_length(settings.JOB_QUEUE_NAME)
+    if queue_depth is not None:
+        run_code.metrics.QUEUE_DEPTH.set(queue_depth)
+    return PlainTextResponse(run_code.metrics.render(), media_type="text/plain; version=0.0.4")
 
 
 if __name__ == "__main__":
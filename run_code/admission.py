@@ -0,0 +1,411 @@
+"""
+admission control and fair scheduling of the submissions, shared by every node through redis.
+
+a submission takes one of its user's slots and a place in the wait queue atomically
+when it's received. once its executor is ready it joins its user's queue in its
+priority class, and the running slots are handed out by a deficit round-robin
+between the users of the highest class with executions waiting, where an execution
+costs its number of test cases. the free slots are handed out whenever an execution
+starts waiting or one is released, a waiting execution blocks on a list of its own
+until it's given one. entries are leased, so an executor that dies doesn't hold its
+slots forever.
+"""
+import asyncio
+import time
+from typing import List, Optional
+from .exceptions import BlockingConnectionsExhausted
+from .memory_store import MemoryStore, script_equivalent
+from .redis_operations import (
+    AsyncBlockingOperations,
+    AsyncRedisOperations,
+    RedisOperations,
+    async_blocking_operations,
+    async_redis_operations,
+    redis_operations,
+)
+import settings
+
+
+ADMITTED = 1
+# the user already has settings.ADMISSION_MAX_PER_USER submissions in flight (or results to collect)
+USER_BUSY = 0
+# the running slots and the wait queue are full
+SATURATED = -1
+
+QUEUED_KEY = "admission:queued"
+RUNNING_KEY = "admission:running"
+# cost of every execution waiting in a user queue, by execution id
+TICKETS_KEY = "admission:tickets"
+# prefix of the scheduler's keys of each priority class: the round-robin list of its
+# users with executions waiting, their deficits and the queue of every user
+SCHEDULER_PREFIX = "admission:"
+# a grant gives up after this many turns, it's resumed by the next start or release
+MAX_TURNS = 1000
+
+
+def user_key(userid: str) -> str:
+    """name of the redis sorted set of a user's executions in flight, scored by their lease"""
+    return f"admission:user:{userid}"
+
+
+def priority_class(priority: str) -> int:
+    """position of a priority in settings.ADMISSION_PRIORITIES, unknown ones get the lowest"""
+    try:
+        return settings.ADMISSION_PRIORITIES.index(priority)
+    except ValueError:
+        return len(settings.ADMISSION_PRIORITIES) - 1
+
+
+# KEYS: user's executions, queued, running
+# ARGV: execution id, now, lease, max running, max queued, max per user
+ADMIT_SCRIPT = """
+local now = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[6]) then
+    return 0
+end
+local in_flight = redis.call('ZCARD', KEYS[2]) + redis.call('ZCARD', KEYS[3])
+if in_flight >= tonumber(ARGV[4]) + tonumber(ARGV[5]) then
+    return -1
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[3]), ARGV[1])
+return 1
+"""
+
+# grants the free running slots by the deficit round-robin of the highest class with executions
+# waiting, a granted execution is woken up by its turn list (see turn_key).
+# the scheduler's keys depend on the users so they're built here (a single redis node is assumed),
+# the arguments are the last ARGV of the scripts that include it: now, lease, max running,
+# quantum, number of classes, scheduler prefix, max turns
+GRANT_SCRIPT = """
+local function grant_free_slots(queued, running, tickets, first)
+    local now = tonumber(ARGV[first])
+    local lease = tonumber(ARGV[first + 1])
+    local quantum = tonumber(ARGV[first + 3])
+    local prefix = ARGV[first + 5]
+    redis.call('ZREMRANGEBYSCORE', queued, '-inf', now)
+    redis.call('ZREMRANGEBYSCORE', running, '-inf', now)
+
+    local function grant(class)
+        local users = prefix .. 'users:' .. class
+        local deficits = prefix .. 'deficit:' .. class
+        for turn = 1, tonumber(ARGV[first + 6]) do
+            local user = redis.call('LINDEX', users, 0)
+            if not user then
+                return false
+            end
+            local pending = prefix .. 'pending:' .. class .. ':' .. user
+            local head = redis.call('LINDEX', pending, 0)
+            if not head then
+                redis.call('LPOP', users)
+                redis.call('HDEL', deficits, user)
+            elseif not redis.call('ZSCORE', queued, head) then
+                -- released or expired while it was waiting
+                redis.call('LPOP', pending)
+                redis.call('HDEL', tickets, head)
+            else
+                local cost = tonumber(redis.call('HGET', tickets, head))
+                local deficit = tonumber(redis.call('HGET', deficits, user) or 0)
+                if deficit >= cost then
+                    redis.call('LPOP', pending)
+                    redis.call('HDEL', tickets, head)
+                    redis.call('ZREM', queued, head)
+                    redis.call('ZADD', running, now + lease, head)
+                    redis.call('RPUSH', prefix .. 'turn:' .. head, '1')
+                    redis.call('EXPIRE', prefix .. 'turn:' .. head, lease)
+                    if redis.call('LLEN', pending) == 0 then
+                        redis.call('LPOP', users)
+                        redis.call('HDEL', deficits, user)
+                    else
+                        redis.call('HSET', deficits, user, deficit - cost)
+                    end
+                    return true
+                end
+                redis.call('HSET', deficits, user, deficit + quantum)
+                redis.call('LMOVE', users, users, 'LEFT', 'RIGHT')
+            end
+        end
+        return false
+    end
+
+    local free = tonumber(ARGV[first + 2]) - redis.call('ZCARD', running)
+    local class = 0
+    while free > 0 and class < tonumber(ARGV[first + 4]) do
+        if grant(class) then
+            free = free - 1
+        else
+            class = class + 1
+        end
+    end
+end
+"""
+
+# KEYS: queued, running, tickets
+# ARGV: execution id, user, priority class, cost, then the arguments of GRANT_SCRIPT
+# puts the execution in its user's queue (once) and grants the free running slots,
+# returns 1 once the execution holds one
+START_SCRIPT = GRANT_SCRIPT + """
+local turn = ARGV[10] .. 'turn:' .. ARGV[1]
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', tonumber(ARGV[5]))
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', tonumber(ARGV[5]))
+if redis.call('ZSCORE', KEYS[2], ARGV[1]) or not redis.call('ZSCORE', KEYS[1], ARGV[1]) then
+    -- it holds a slot, or its lease ran out and it runs without one
+    redis.call('DEL', turn)
+    return 1
+end
+if redis.call('HSETNX', KEYS[3], ARGV[1], ARGV[4]) == 1 then
+    local pending = ARGV[10] .. 'pending:' .. ARGV[3] .. ':' .. ARGV[2]
+    if redis.call('RPUSH', pending, ARGV[1]) == 1 then
+        -- a user joining the round starts with a quantum
+        redis.call('RPUSH', ARGV[10] .. 'users:' .. ARGV[3], ARGV[2])
+        redis.call('HSET', ARGV[10] .. 'deficit:' .. ARGV[3], ARGV[2], ARGV[8])
+    end
+end
+grant_free_slots(KEYS[1], KEYS[2], KEYS[3], 5)
+if redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    redis.call('DEL', turn)
+    return 1
+end
+return 0
+"""
+
+# KEYS: user's executions, queued, running, tickets
+# ARGV: execution id, '1' to free the user's slot as well, then the arguments of GRANT_SCRIPT
+# the freed running slot is handed to the next execution waiting right away
+RELEASE_SCRIPT = GRANT_SCRIPT + """
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+redis.call('DEL', ARGV[8] .. 'turn:' .. ARGV[1])
+if ARGV[2] == '1' then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+end
+grant_free_slots(KEYS[2], KEYS[3], KEYS[4], 3)
+return 1
+"""
+
+
+@script_equivalent(ADMIT_SCRIPT)
+def _admit(store: MemoryStore, keys: List[str], args: List):
+    now = float(args[1])
+    for key in keys:
+        store.zremrangebyscore(key, "-inf", now)
+    if store.zcard(keys[0]) >= int(args[5]):
+        return USER_BUSY
+    if store.zcard(keys[1]) + store.zcard(keys[2]) >= int(args[3]) + int(args[4]):
+        return SATURATED
+    store.zadd(keys[0], {args[0]: now + float(args[2])})
+    store.expire(keys[0], int(args[2]))
+    store.zadd(keys[1], {args[0]: now + float(args[2])})
+    return ADMITTED
+
+
+def _grant(store: MemoryStore, keys: List[str], args: List, priority: int) -> bool:
+    now, lease, quantum, prefix, max_turns = args[0], args[1], args[3], args[5], args[6]
+    users, deficits = f"{prefix}users:{priority}", f"{prefix}deficit:{priority}"
+    for _ in range(int(max_turns)):
+        user = store.lindex(users, 0)
+        if user is None:
+            return False
+        pending = f"{prefix}pending:{priority}:{user.decode('utf-8')}"
+        head = store.lindex(pending, 0)
+        if head is None:
+            store.lpop(users)
+            store.hdel(deficits, user)
+        elif store.zscore(keys[0], head) is None:
+            store.lpop(pending)
+            store.hdel(keys[2], head)
+        else:
+            cost = int(store.hget(keys[2], head))
+            deficit = int(store.hget(deficits, user) or 0)
+            if deficit >= cost:
+                store.lpop(pending)
+                store.hdel(keys[2], head)
+                store.zrem(keys[0], head)
+                store.zadd(keys[1], {head: float(now) + float(lease)})
+                store.rpush(f"{prefix}turn:{head.decode('utf-8')}", "1")
+                store.expire(f"{prefix}turn:{head.decode('utf-8')}", int(lease))
+                if store.llen(pending) == 0:
+                    store.lpop(users)
+                    store.hdel(deficits, user)
+                else:
+                    store.hset(deficits, user, deficit - cost)
+                return True
+            store.hset(deficits, user, deficit + int(quantum))
+            store.lmove(users, users, "LEFT", "RIGHT")
+    return False
+
+
+def _grant_free_slots(store: MemoryStore, keys: List[str], args: List):
+    """
+    Args:
+        keys (List[str]): queued, running, tickets
+        args (List): the arguments of GRANT_SCRIPT
+    """
+    store.zremrangebyscore(keys[0], "-inf", float(args[0]))
+    store.zremrangebyscore(keys[1], "-inf", float(args[0]))
+    free = int(args[2]) - store.zcard(keys[1])
+    priority = 0
+    while free > 0 and priority < int(args[4]):
+        if _grant(store, keys, args, priority):
+            free -= 1
+        else:
+            priority += 1
+
+
+@script_equivalent(START_SCRIPT)
+def _start(store: MemoryStore, keys: List[str], args: List):
+    execution_id, userid, priority, cost, grant_args = args[0], args[1], args[2], args[3], args[4:]
+    prefix = grant_args[5]
+    store.zremrangebyscore(keys[0], "-inf", float(grant_args[0]))
+    store.zremrangebyscore(keys[1], "-inf", float(grant_args[0]))
+    if store.zscore(keys[1], execution_id) is not None or store.zscore(keys[0], execution_id) is None:
+        store.delete(f"{prefix}turn:{execution_id}")
+        return 1
+    if store.hget(keys[2], execution_id) is None:
+        store.hset(keys[2], execution_id, cost)
+        if store.rpush(f"{prefix}pending:{priority}:{userid}", execution_id) == 1:
+            store.rpush(f"{prefix}users:{priority}", userid)
+            store.hset(f"{prefix}deficit:{priority}", userid, grant_args[3])
+    _grant_free_slots(store, keys, grant_args)
+    if store.zscore(keys[1], execution_id) is not None:
+        store.delete(f"{prefix}turn:{execution_id}")
+        return 1
+    return 0
+
+
+@script_equivalent(RELEASE_SCRIPT)
+def _release(store: MemoryStore, keys: List[str], args: List):
+    store.zrem(keys[1], args[0])
+    store.zrem(keys[2], args[0])
+    store.hdel(keys[3], args[0])
+    store.delete(f"{args[7]}turn:{args[0]}")
+    if args[1] == "1":
+        store.zrem(keys[0], args[0])
+    _grant_free_slots(store, keys[1:], args[2:])
+    return 1
+
+
+async def admit_async(
+    userid: str, execution_id: str, redis_ops: AsyncRedisOperations = async_redis_operations
+) -> Optional[int]:
+    """
+    takes one of the user's slots and a place in the wait queue in a single step
+
+    Returns:
+        int: ADMITTED, USER_BUSY or SATURATED, None if redis couldn't be reached
+    """
+    return await redis_ops.run_script(
+        ADMIT_SCRIPT,
+        [user_key(userid), QUEUED_KEY, RUNNING_KEY],
+        [execution_id, time.time(), settings.ADMISSION_LEASE_SEC, settings.ADMISSION_MAX_RUNNING,
+         settings.ADMISSION_MAX_QUEUED, settings.ADMISSION_MAX_PER_USER],
+    )
+
+
+def turn_key(execution_id: str) -> str:
+    """name of the redis list an execution waiting for a running slot is woken up by once it's given one"""
+    return f"{SCHEDULER_PREFIX}turn:{execution_id}"
+
+
+def _grant_args() -> List:
+    return [time.time(), settings.ADMISSION_LEASE_SEC, settings.ADMISSION_MAX_RUNNING, settings.ADMISSION_QUANTUM,
+            len(settings.ADMISSION_PRIORITIES), SCHEDULER_PREFIX, MAX_TURNS]
+
+
+def _start_args(execution_id: str, userid: str, priority: str, cost: int):
+    return [QUEUED_KEY, RUNNING_KEY, TICKETS_KEY], \
+        [execution_id, str(userid), priority_class(priority), max(1, cost), *_grant_args()]
+
+
+def wait_for_turn(
+    execution_id: str,
+    userid: str,
+    priority: str = settings.ADMISSION_DEFAULT_PRIORITY,
+    cost: int = 1,
+    redis_ops: RedisOperations = redis_operations,
+) -> bool:
+    """
+    blocks until the execution holds one of the running slots, it's woken up by the
+    release that hands it one (see turn_key) instead of polling. it holds a thread and a
+    connection while it waits, the API waits with wait_for_turn_async instead.
+
+    Args:
+        priority (str): one of settings.ADMISSION_PRIORITIES
+        cost (int): what the execution is charged in its user's round-robin turns,
+            its number of test cases
+
+    Returns:
+        bool: False if its lease ran out while it was waiting (it runs anyway)
+    """
+    deadline = time.monotonic() + settings.ADMISSION_LEASE_SEC
+    while time.monotonic() < deadline:
+        started = redis_ops.run_script(START_SCRIPT, *_start_args(execution_id, userid, priority, cost))
+        # without redis there's nothing to wait for
+        if started is None or started == 1:
+            return True
+        # the slots of executors that died are only freed by the scripts, so it checks again once in a while
+        if redis_ops.blocking_pop_from_list(turn_key(execution_id), settings.ADMISSION_RECHECK_SEC) is not None:
+            return True
+    return False
+
+
+async def wait_for_turn_async(
+    execution_id: str,
+    userid: str,
+    priority: str = settings.ADMISSION_DEFAULT_PRIORITY,
+    cost: int = 1,
+    redis_ops: AsyncRedisOperations = async_redis_operations,
+    blocking_ops: AsyncBlockingOperations = async_blocking_operations,
+) -> bool:
+    """like wait_for_turn without holding a thread, it sleeps between the checks when
+    every blocking connection is taken"""
+    deadline = time.monotonic() + settings.ADMISSION_LEASE_SEC
+    while time.monotonic() < deadline:
+        started = await redis_ops.run_script(START_SCRIPT, *_start_args(execution_id, userid, priority, cost))
+        if started is None or started == 1:
+            return True
+        try:
+            if await blocking_ops.blocking_pop_from_list(turn_key(execution_id), settings.ADMISSION_RECHECK_SEC):
+                return True
+        except BlockingConnectionsExhausted:
+            await asyncio.sleep(settings.ADMISSION_RECHECK_SEC)
+    return False
+
+
+def _release_args(userid: str, execution_id: str, free_user: bool):
+    return [user_key(userid), QUEUED_KEY, RUNNING_KEY, TICKETS_KEY], \
+        [execution_id, "1" if free_user else "0", *_grant_args()]
+
+
+def release(
+    userid: str, execution_id: str, free_user: bool = False, redis_ops: RedisOperations = redis_operations
+) -> bool:
+    """
+    gives the execution's running slot (or place in the queue) back, the free slots
+    are handed to the executions waiting
+
+    Args:
+        free_user (bool): frees the user's slot too. it's kept once the result is stored,
+            until the user collects it, see hold_user_slot.
+    """
+    keys, args = _release_args(userid, execution_id, free_user)
+    return redis_ops.run_script(RELEASE_SCRIPT, keys, args) is not None
+
+
+async def release_async(
+    userid: str, execution_id: str, free_user: bool = False,
+    redis_ops: AsyncRedisOperations = async_redis_operations,
+) -> bool:
+    """like release, for the async endpoints"""
+    keys, args = _release_args(userid, execution_id, free_user)
+    return await redis_ops.run_script(RELEASE_SCRIPT, keys, args) is not None
+
+
+def hold_user_slot(pipe, userid: str, execution_id: str):
+    """queues on a pipeline the hold of the user's slot until the result is collected (or expires)"""
+    pipe.zadd(user_key(userid), {execution_id: time.time() + settings.REDIS_EXPIRE_SEC})
@@ -0,0 +1,63 @@
+import builtins
+from collections import OrderedDict
+from types import CodeType
+from typing import Callable
+import settings
+
+
+class CodeCache:
+    """a bounded LRU cache of compiled modules keyed by the SHA-256 of their source code"""
+
+    def __init__(self, maxsize: int = settings.CODE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._cache: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get_code(self, source_code: str, source_hash: str) -> CodeType:
+        """
+        returns the compiled module, source code is only compiled on a cache miss.
+
+        Raises:
+            SyntaxError: if the source code can't be compiled.
+        """
+        code = self._cache.get(source_hash)
+        if code is not None:
+            self._cache.move_to_end(source_hash)
+            return code
+
+        code = compile(source_code, "<received_file>", "exec")
+        self._cache[source_hash] = code
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return code
+
+
+# every worker process has its own copy
+code_cache = CodeCache()
+
+
+def load_function(source_code: str, source_hash: str, func_name: str) -> Callable:
+    """
+    executes the module in a fresh namespace and extracts a function from it,
+    the namespace has its own copy of the builtins so the module can't change them for the next jobs
+
+    Args:
+        source_code (str): string representation of a python file
+        source_hash (str): SHA-256 of source_code
+        func_name (str): function name to get extracted
+
+    Raises:
+        NameError: if the function is not found
+        Exception: anything raised by the module's top-level code
+
+    Returns:
+        Callable
+    """
+    namespace = {"__builtins__": dict(builtins.__dict__)}
+    exec(code_cache.get_code(source_code, source_hash), namespace)
+    func = namespace.get(func_name)
+    if not callable(func):
+        raise NameError(f"Function '{func_name}' not found.")
+    return func
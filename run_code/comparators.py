@@ -0,0 +1,96 @@
+"""comparators of a test case's output with its expected value, and the verdicts they give"""
+import math
+from collections import Counter
+from typing import Callable, Dict, List, Optional
+
+
+ACCEPTED = "Accepted"
+WRONG_ANSWER = "WrongAnswer"
+# not executed because an earlier test case failed in fail_fast mode
+SKIPPED = "Skipped"
+
+_NUMBERS = (int, float)
+_COLLECTIONS = (list, tuple, set, frozenset)
+
+
+def exact(output, expected, tolerance: float) -> bool:
+    return output == expected
+
+
+def float_tolerance(output, expected, tolerance: float) -> bool:
+    """numbers (also nested in lists, tuples and dicts) may differ by `tolerance`, relative or absolute"""
+    if isinstance(output, _NUMBERS) and isinstance(expected, _NUMBERS) \
+            and not isinstance(output, bool) and not isinstance(expected, bool):
+        return math.isclose(output, expected, rel_tol=tolerance, abs_tol=tolerance)
+    if isinstance(output, (list, tuple)) and isinstance(expected, (list, tuple)):
+        return len(output) == len(expected) and all(
+            float_tolerance(item, expected_item, tolerance) for item, expected_item in zip(output, expected)
+        )
+    if isinstance(output, dict) and isinstance(expected, dict):
+        return output.keys() == expected.keys() and all(
+            float_tolerance(output[key], expected[key], tolerance) for key in output
+        )
+    return output == expected
+
+
+def _freeze(value):
+    # a hashable equivalent of value, so unhashable items can be counted
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return frozenset((key, _freeze(item)) for key, item in value.items())
+    return value
+
+
+def unordered(output, expected, tolerance: float) -> bool:
+    """collections are compared as multisets, the order of their items doesn't matter"""
+    if not (isinstance(output, _COLLECTIONS) and isinstance(expected, _COLLECTIONS)):
+        return output == expected
+    if len(output) != len(expected):
+        return False
+    return Counter(_freeze(item) for item in output) == Counter(_freeze(item) for item in expected)
+
+
+COMPARATORS: Dict[str, Callable] = {
+    "exact": exact,
+    "float": float_tolerance,
+    "unordered": unordered,
+}
+
+
+def verdict(result: Dict, test_case: Dict, comparator: str = "exact", tolerance: float = 0) -> Optional[str]:
+    """
+    Returns:
+        str: the result's error if it has one, otherwise ACCEPTED or WRONG_ANSWER,
+            None if the test case has no expected value
+    """
+    if result.get("error") is not None:
+        return result["error"]
+    if "expected" not in test_case:
+        return None
+    try:
+        matches = COMPARATORS[comparator](result.get("output"), test_case["expected"], tolerance)
+    except Exception:
+        matches = False
+    return ACCEPTED if matches else WRONG_ANSWER
+
+
+def is_failure(result: Dict) -> bool:
+    """whether the result stops a fail_fast execution"""
+    return result.get("verdict") not in (ACCEPTED, None)
+
+
+def overall_verdict(results: List[Dict]) -> Optional[str]:
+    """
+    Returns:
+        str: ACCEPTED if every judged result was accepted, otherwise the verdict of the
+            first one that failed, None if no result was judged
+    """
+    judged = False
+    for result in results:
+        if is_failure(result) and result.get("verdict") != SKIPPED:
+            return result["verdict"]
+        judged = judged or result.get("verdict") == ACCEPTED
+    return ACCEPTED if judged else None
@@ -0,0 +1,373 @@
+"""
+empirical complexity of a solution for /complexity.
+
+solve runs inside a single pool worker on inputs of geometrically growing sizes,
+its time and peak memory are measured at every size and fitted against the usual
+growth classes, the best fit is reported together with the raw measurements.
+the sizes stop growing once the time budget is used up (or a size fails).
+
+geometric sizes can't tell exponential growth apart, it shows up as the budget
+running out after a few sizes.
+"""
+import gc
+import math
+import random
+import signal
+import string
+import time
+import tracemalloc
+from functools import partial
+from typing import Callable, Dict, Iterator, List, Optional
+from .code_cache import load_function
+from .deadlines import DeadlineScheduler
+from .worker_pool import WORKER_TIMEOUT, WORKER_CRASHED, SUBMISSION_TIMEOUT
+from . import admission, metrics, run_tests
+import settings
+
+
+GENERATOR_FUNCTION = "generate"
+
+# placeholders of an input template, replaced by a value of size n
+SIZE = "$n"
+RANGE = "$range"
+RANDOM_INTS = "$ints"
+RANDOM_STRING = "$string"
+PLACEHOLDERS = (SIZE, RANGE, RANDOM_INTS, RANDOM_STRING)
+
+# why the sizes stopped growing
+COMPLETED = "completed"
+BUDGET = "budget"
+TIMEOUT = "timeout"
+ERROR = "error"
+
+# from the simplest, a simpler class wins when it fits about as well
+GROWTH_CLASSES = {
+    "O(1)": lambda n: 1.0,
+    "O(log n)": lambda n: math.log2(n + 1),
+    "O(n)": lambda n: float(n),
+    "O(n log n)": lambda n: n * math.log2(n + 1),
+    "O(n^2)": lambda n: float(n) ** 2,
+    "O(n^3)": lambda n: float(n) ** 3,
+}
+
+# a timed run calls solve (on the same input) until it took this long, short calls can't be timed one by one
+_MIN_RUN_SEC = 0.001
+_MAX_CALLS = 1000
+# values below these are noise, they don't weigh more than these in the fits
+_TIME_FLOOR_SEC = 1e-6
+_MEMORY_FLOOR_BYTES = 1024
+# fits whose errors differ by less than this can't be told apart from the timing noise
+_NOISE_ERROR = 0.01
+# no class fits when even the best one is this far off, eg. exponential growth
+_MAX_FIT_ERROR = 0.5
+
+
+def geometric_sizes(min_size: int, max_size: int, growth: float) -> List[int]:
+    """min_size, min_size * growth, ... up to max_size (every size is larger than the previous one)"""
+    sizes = []
+    size = min_size
+    while size <= max_size:
+        sizes.append(size)
+        size = max(size + 1, round(size * growth))
+    return sizes
+
+
+def has_placeholder(template) -> bool:
+    """whether the template depends on the size, see expand_template"""
+    if isinstance(template, (list, tuple)):
+        return any(has_placeholder(item) for item in template)
+    if isinstance(template, dict):
+        return any(has_placeholder(value) for value in template.values())
+    return isinstance(template, str) and template in PLACEHOLDERS
+
+
+def expand_template(template, n: int, rng: random.Random):
+    """
+    Args:
+        template: a literal, every placeholder in it is replaced: SIZE by n, RANGE by
+            list(range(n)), RANDOM_INTS by n random integers and RANDOM_STRING by
+            n random lowercase letters
+        rng (random.Random): source of the random values
+    """
+    if isinstance(template, list):
+        return [expand_template(item, n, rng) for item in template]
+    if isinstance(template, tuple):
+        return tuple(expand_template(item, n, rng) for item in template)
+    if isinstance(template, dict):
+        return {key: expand_template(value, n, rng) for key, value in template.items()}
+    if template == SIZE:
+        return n
+    if template == RANGE:
+        return list(range(n))
+    if template == RANDOM_INTS:
+        return [rng.randrange(10 ** 9) for _ in range(n)]
+    if template == RANDOM_STRING:
+        return "".join(rng.choices(string.ascii_lowercase, k=n))
+    return template
+
+
+def _template_arguments(template, n: int) -> List:
+    # the same size always gets the same input
+    return expand_template(template, n, random.Random(n))
+
+
+def _arguments(generate: Callable, n: int) -> List:
+    arguments = generate(n)
+    if not isinstance(arguments, (list, tuple)):
+        raise TypeError(f"{GENERATOR_FUNCTION}(n) must return the list of solve's arguments")
+    return arguments
+
+
+def _limited(func: Callable, *args):
+    """calls func with the time limit of a test case, see run_tests._execute_suite"""
+    signal.setitimer(signal.ITIMER_REAL, settings.RUN_TESTS_TIMEOUT)
+    try:
+        return func(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _time_calls(solve: Callable, arguments: List, calls: int) -> float:
+    # like timeit, a collection of garbage made by something else isn't charged to solve
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for _ in range(calls):
+            solve(*arguments)
+        return (time.perf_counter() - start) / calls
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _peak_memory(solve: Callable, arguments: List) -> int:
+    tracemalloc.start()
+    try:
+        solve(*arguments)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _measure(solve: Callable, generate: Callable, n: int, repeats: int) -> Dict:
+    """the fastest of `repeats` timed runs and the peak memory of one more, every run gets a fresh input"""
+    calls = 1
+    times = []
+    while len(times) < repeats:
+        per_call = _limited(_time_calls, solve, _limited(_arguments, generate, n), calls)
+        if per_call * calls < _MIN_RUN_SEC and calls < _MAX_CALLS:
+            # too short to be timed, this run only tells how many calls are needed
+            calls = min(_MAX_CALLS, int(_MIN_RUN_SEC / max(per_call, 1e-9)) + 1)
+            continue
+        times.append(per_call)
+    peak = _limited(_peak_memory, solve, _limited(_arguments, generate, n))
+    return {
+        "size": n,
+        "time_ms": round(min(times) * 1000, 6),
+        "times_ms": [round(seconds * 1000, 6) for seconds in times],
+        "calls_per_run": calls,
+        "peak_memory_kb": round(peak / 1024, 3),
+    }
+
+
+def _measure_sizes(
+    source_code: str,
+    source_hash: str,
+    generator_source: Optional[str],
+    generator_hash: Optional[str],
+    template,
+    sizes: List[int],
+    repeats: int,
+    budget: float,
+) -> Iterator[Dict]:
+    """
+    measures solve at every size inside a pool worker, in order
+
+    Args:
+        source_code (str): the submitted python file, compiled inside the worker.
+        source_hash (str): SHA-256 of source_code, used as the key of the worker's code cache.
+        generator_source (str, optional): python file defining generate(n), which returns
+            the list of solve's arguments for size n.
+        generator_hash (str, optional): SHA-256 of generator_source.
+        template: literal of solve's arguments with placeholders (see expand_template),
+            used without a generator.
+        repeats (int): timed runs per size.
+        budget (float): seconds the measurements may take, a size that isn't expected
+            to fit in what's left isn't measured.
+
+    Yields:
+        Dict: the measurements of each size, the last item has 'stopped' (and 'error') instead
+            if the sizes stopped growing early.
+    """
+    start = time.monotonic()
+    signal.signal(signal.SIGALRM, run_tests._raise_test_case_timeout)
+    try:
+        with metrics.timed("load_solution"):
+            solve = _limited(load_function, source_code, source_hash, "solve")
+            if generator_source is not None:
+                generate = _limited(load_function, generator_source, generator_hash, GENERATOR_FUNCTION)
+            else:
+                generate = partial(_template_arguments, template)
+    except run_tests._TestCaseTimeout:
+        yield {"size": None, "stopped": TIMEOUT, "error": "The top-level code of the module exceeded the time limit."}
+        return
+    except Exception as e:
+        yield {"size": None, "stopped": ERROR, "error": f"{type(e).__name__}: {e}"}
+        return
+
+    costs = []
+    for n in sizes:
+        if costs:
+            # the next size is expected to grow at least as fast as the last one did
+            growth = costs[-1] / costs[-2] if len(costs) > 1 and costs[-2] > 0 else 1
+            if time.monotonic() - start + costs[-1] * max(growth, 1) > budget:
+                yield {"size": n, "stopped": BUDGET}
+                return
+        size_start = time.monotonic()
+        try:
+            measurement = _measure(solve, generate, n, repeats)
+        except run_tests._TestCaseTimeout:
+            yield {"size": n, "stopped": TIMEOUT, "error": f"a run exceeded {settings.RUN_TESTS_TIMEOUT} seconds"}
+            return
+        except Exception as e:
+            yield {"size": n, "stopped": ERROR, "error": f"{type(e).__name__}: {e}"}
+            return
+        costs.append(time.monotonic() - size_start)
+        yield measurement
+
+
+def fit(sizes: List[int], values: List[float], floor: float) -> List[Dict]:
+    """
+    fits value ~ constant + coefficient * f(size) for every growth class, both terms
+    non negative, by least squares on the relative errors (the values span orders of magnitude)
+
+    Args:
+        floor (float): smallest value given its own weight, smaller ones are noise
+
+    Returns:
+        List[Dict]: {'class', 'error', 'constant', 'coefficient'} of every class, from the
+            simplest, 'error' is the root mean square of the relative errors
+    """
+    weights = [1 / max(value, floor) ** 2 for value in values]
+    fits = []
+    for name, growth in GROWTH_CLASSES.items():
+        terms = [growth(size) for size in sizes]
+        candidates = []
+        # only the constant, only the growth term, then both
+        sw, sy = sum(weights), sum(w * y for w, y in zip(weights, values))
+        candidates.append((sy / sw, 0.0))
+        sff = sum(w * f * f for w, f in zip(weights, terms))
+        sfy = sum(w * f * y for w, f, y in zip(weights, terms, values))
+        if sff > 0:
+            candidates.append((0.0, sfy / sff))
+        sf = sum(w * f for w, f in zip(weights, terms))
+        det = sw * sff - sf * sf
+        if det > 1e-12 * sw * sff:
+            constant, coefficient = (sff * sy - sf * sfy) / det, (sw * sfy - sf * sy) / det
+            if constant >= 0 and coefficient >= 0:
+                candidates.append((constant, coefficient))
+        # the first candidate wins a tie, eg. O(1) is a constant
+        error, constant, coefficient = min(
+            (
+                (
+                    math.sqrt(sum(w * (y - a - c * f) ** 2 for w, f, y in zip(weights, terms, values)) / len(values)),
+                    a,
+                    c,
+                )
+                for a, c in candidates
+            ),
+            key=lambda candidate: candidate[0],
+        )
+        fits.append({"class": name, "error": round(error, 4), "constant": constant, "coefficient": coefficient})
+    return fits
+
+
+def best_fit(fits: List[Dict]) -> Optional[str]:
+    """
+    the simplest class whose error is close enough to the smallest (see settings.COMPLEXITY_FIT_TOLERANCE),
+    None if none of them fits
+    """
+    smallest = min(item["error"] for item in fits)
+    if smallest > _MAX_FIT_ERROR:
+        return None
+    limit = smallest * (1 + settings.COMPLEXITY_FIT_TOLERANCE) + _NOISE_ERROR
+    return next(item["class"] for item in fits if item["error"] <= limit)
+
+
+def _growth(measurements: List[Dict], key: str, scale: float, floor: float) -> Optional[Dict]:
+    if len(measurements) < settings.COMPLEXITY_MIN_SIZES:
+        return None
+    # growth classes describe large inputs, the smallest sizes are mostly constant costs
+    # (calls, CPython's cached small integers...) so only the larger half is fitted
+    fitted = measurements[-max(settings.COMPLEXITY_MIN_SIZES, math.ceil(len(measurements) / 2)):]
+    fits = fit([item["size"] for item in fitted], [item[key] * scale for item in fitted], floor)
+    return {"best_fit": best_fit(fits), "fitted_sizes": [fitted[0]["size"], fitted[-1]["size"]], "fits": fits}
+
+
+def analyze(
+    source_code: str,
+    source_hash: str,
+    execution_id: str,
+    userid: str,
+    generator_source: Optional[str] = None,
+    generator_hash: Optional[str] = None,
+    template=None,
+    min_size: int = 16,
+    max_size: int = 2 ** 20,
+    growth: float = 2.0,
+    time_budget: float = settings.COMPLEXITY_DEFAULT_BUDGET_SEC,
+    repeats: int = settings.COMPLEXITY_REPEATS,
+    priority: str = settings.ADMISSION_DEFAULT_PRIORITY,
+    admitted: bool = False,
+) -> Dict:
+    """
+    measures the solution on the pool of run_tests once the execution gets its turn
+    (unless it's already `admitted`), its slots are given back at the end (see admission).
+
+    Returns:
+        Dict: the 'measurements' of every size, why the sizes 'stopped' growing and the
+            'time' and 'memory' growth ({'best_fit', 'fitted_sizes', 'fits'}, None with too few sizes)
+    """
+    sizes = geometric_sizes(min_size, max_size, growth)
+    measurements = []
+    stopped, error = COMPLETED, None
+    try:
+        if not admitted:
+            with metrics.timed("admission_wait"):
+                admission.wait_for_turn(execution_id, userid, priority, len(sizes))
+        start = time.monotonic()
+        # the pool enforces the budget too, eg. on a worker stuck inside C code
+        scheduler = DeadlineScheduler(start + time_budget)
+        for item, pool_error in run_tests.pool.stream(
+            _measure_sizes,
+            (source_code, source_hash, generator_source, generator_hash, template, sizes, repeats, time_budget),
+            timeout=time_budget,
+            scheduler=scheduler,
+            owner=(source_hash, generator_hash),
+        ):
+            if pool_error is not None:
+                stopped = {SUBMISSION_TIMEOUT: BUDGET, WORKER_TIMEOUT: TIMEOUT}.get(pool_error, ERROR)
+                if pool_error == WORKER_CRASHED:
+                    error = "the process measuring the solution crashed"
+                elif stopped == ERROR:
+                    error = f"the measurements could not be serialized: {item}"
+                break
+            if "stopped" in item:
+                stopped, error = item["stopped"], item.get("error")
+                break
+            measurements.append(item)
+        elapsed = time.monotonic() - start
+    finally:
+        admission.release(userid, execution_id, free_user=True)
+    metrics.COMPLEXITY_ANALYSES.inc(stopped=stopped)
+    return {
+        "execution_id": execution_id,
+        "sizes": sizes,
+        "measurements": measurements,
+        "stopped": stopped,
+        "error": error,
+        "elapsed_sec": round(elapsed, 3),
+        "time": _growth(measurements, "time_ms", 1 / 1000, _TIME_FLOOR_SEC),
+        "memory": _growth(measurements, "peak_memory_kb", 1024, _MEMORY_FLOOR_BYTES),
+    }
@@ -0,0 +1,65 @@
+import time
+from multiprocessing.connection import wait
+from typing import Dict, List, Optional, Tuple
+
+
+class DeadlineScheduler:
+    """
+    watches every worker of a submission at the same time, each worker has an
+    absolute deadline which is capped by the submission's overall deadline.
+    """
+
+    def __init__(self, submission_deadline: Optional[float] = None):
+        """
+        Args:
+            submission_deadline (float, optional): absolute time.monotonic() after which
+                the whole submission is out of time, None for no overall budget.
+        """
+        self.submission_deadline = submission_deadline
+        self._deadlines: Dict[object, float] = {}
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __iter__(self):
+        return iter(list(self._deadlines))
+
+    def watch(self, worker, timeout: float):
+        """(re)starts the clock of a worker, it has `timeout` seconds from now"""
+        deadline = time.monotonic() + timeout
+        if self.submission_deadline is not None:
+            deadline = min(deadline, self.submission_deadline)
+        self._deadlines[worker] = deadline
+
+    def forget(self, worker):
+        self._deadlines.pop(worker, None)
+
+    def remaining(self) -> Optional[float]:
+        """seconds left of the submission's budget, None if there is no budget"""
+        if self.submission_deadline is None:
+            return None
+        return max(0.0, self.submission_deadline - time.monotonic())
+
+    def out_of_budget(self) -> bool:
+        return self.submission_deadline is not None and time.monotonic() >= self.submission_deadline
+
+    def wait(self) -> Tuple[List[object], List[object]]:
+        """
+        blocks until a watched worker has something to read or the earliest deadline passes.
+
+        Returns:
+            (ready, expired): workers with a message waiting and workers past their
+            deadline, every expired worker is reported in the same sweep.
+        """
+        if not self._deadlines:
+            return [], []
+        timeout = max(0.0, min(self._deadlines.values()) - time.monotonic())
+        by_conn = {worker.conn: worker for worker in self._deadlines}
+        ready = [by_conn[conn] for conn in wait(list(by_conn), timeout)]
+
+        now = time.monotonic()
+        expired = [
+            worker for worker, deadline in self._deadlines.items()
+            if deadline <= now and worker not in ready
+        ]
+        return ready, expired
@@ -1,2 +1,6 @@
 class NotAllowedImportError(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class BlockingConnectionsExhausted(Exception):
+    """every connection of the pool of the blocking redis commands is taken"""
+    pass
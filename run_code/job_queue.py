@@ -0,0 +1,118 @@
+import ast
+import json
+from typing import Dict, List, Optional, Tuple
+from .redis_operations import (
+    AsyncRedisOperations,
+    RedisOperations,
+    async_redis_operations,
+    redis_operations,
+)
+import settings
+
+
+def encode_job(
+    source_code: str,
+    source_hash: str,
+    test_cases: Optional[List[Dict]],
+    execution_id: str,
+    userid: str,
+    cached_results: List[Dict] = None,
+    cache_keys: List[str] = None,
+    test_suite_id: str = None,
+    test_case_ids: List = None,
+    cpu_limit: float = None,
+    memory_limit: int = None,
+    comparator: str = "exact",
+    tolerance: float = settings.COMPARATOR_TOLERANCE,
+    fail_fast: bool = False,
+    priority: str = settings.ADMISSION_DEFAULT_PRIORITY,
+    profile: Optional[Dict] = None,
+) -> str:
+    """serializes the arguments of run_tests,
+    test cases are python literals (tuples, sets...) so they are stored with repr"""
+    return json.dumps({
+        "source_code": source_code,
+        "source_hash": source_hash,
+        "test_cases": repr(test_cases),
+        "execution_id": execution_id,
+        "userid": userid,
+        "cached_results": cached_results,
+        "cache_keys": cache_keys,
+        "test_suite_id": test_suite_id,
+        "test_case_ids": test_case_ids,
+        "cpu_limit": cpu_limit,
+        "memory_limit": memory_limit,
+        "comparator": comparator,
+        "tolerance": tolerance,
+        "fail_fast": fail_fast,
+        "priority": priority,
+        "profile": profile,
+    })
+
+
+def decode_job(raw_job: str) -> Dict:
+    """the inverse of encode_job, returns the keyword arguments of run_tests"""
+    job = json.loads(raw_job)
+    job["test_cases"] = ast.literal_eval(job["test_cases"])
+    return job
+
+
+class JobQueue:
+    """
+    a durable job queue stored in a redis list, a job stays in the consumer's
+    processing list until it's acknowledged so it's not lost if the consumer dies.
+    """
+
+    def __init__(
+        self,
+        consumer: str = "default",
+        name: str = settings.JOB_QUEUE_NAME,
+        redis_ops: RedisOperations = redis_operations,
+        async_redis_ops: AsyncRedisOperations = async_redis_operations,
+    ):
+        """
+        Args:
+            consumer (str): unique name of the consumer, it owns the processing list.
+            name (str): name of the redis list used as the queue.
+            redis_ops (RedisOperations): redis connection (can wrap an in-process stand-in).
+            async_redis_ops (AsyncRedisOperations): redis connection of the async endpoints.
+        """
+        self.name = name
+        self.processing = f"{name}:processing:{consumer}"
+        self.redis_ops = redis_ops
+        self.async_redis_ops = async_redis_ops
+
+    def enqueue(self, raw_job: str) -> bool:
+        return self.redis_ops.push_to_list(self.name, raw_job)
+
+    async def enqueue_async(self, raw_job: str) -> bool:
+        """like enqueue, for the async endpoints"""
+        return await self.async_redis_ops.push_to_list(self.name, raw_job)
+
+    def dequeue(self, timeout: float = settings.JOB_QUEUE_POLL_SEC) -> Optional[Tuple[str, Dict]]:
+        """
+        waits for the next job and moves it to the processing list.
+
+        Returns:
+            (raw_job, job): raw_job is needed to acknowledge the job, None if the wait expired.
+        """
+        raw_job = self.redis_ops.blocking_move_from_list(self.name, self.processing, timeout)
+        if raw_job is None:
+            return None
+        return raw_job, decode_job(raw_job)
+
+    def ack(self, raw_job: str) -> bool:
+        """removes a finished job from the processing list"""
+        return self.redis_ops.remove_from_list(self.processing, raw_job)
+
+    def requeue_unacked(self) -> int:
+        """puts the jobs left in the processing list (by a consumer that died) back in the queue
+
+        Returns:
+            int: number of requeued jobs
+        """
+        count = 0
+        # the last job of the processing list goes first so the queue keeps its order
+        while self.redis_ops.move_from_list(self.processing, self.name, src="RIGHT", dest="LEFT"):
+            count += 1
+        return count
@@ -0,0 +1,105 @@
+"""resource usage and limits of a single test case, used inside the pool workers"""
+import math
+import resource
+import signal
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+
+TIME_LIMIT_EXCEEDED = "TimeLimitExceeded"
+MEMORY_LIMIT_EXCEEDED = "MemoryLimitExceeded"
+
+
+class CpuLimitExceeded(BaseException):
+    """raised inside a worker when a test case uses up its CPU time
+    (a BaseException so the solution can't swallow it with `except Exception`)"""
+
+
+def _raise_cpu_limit_exceeded(signum, frame):
+    raise CpuLimitExceeded()
+
+
+def _status_kb(field: str) -> Optional[int]:
+    """a memory field of /proc/self/status (eg. VmHWM) in kB, None if it can't be read"""
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # resets VmHWM to the current RSS, so the next reading is the peak of the test case
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def _peak_rss_kb() -> int:
+    peak = _status_kb("VmHWM")
+    if peak is None:
+        # the peak of the whole process, it's only accurate while it keeps growing
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak
+
+
+@contextmanager
+def measure(usage: Dict):
+    """
+    measures the enclosed block, the keys are filled in even if it raises
+
+    Args:
+        usage (Dict): receives 'wall_time_ms', 'cpu_time_ms' (user + sys) and 'peak_rss_kb'
+    """
+    _reset_peak_rss()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    try:
+        yield usage
+    finally:
+        usage["wall_time_ms"] = round((time.perf_counter() - wall_start) * 1000, 3)
+        usage["cpu_time_ms"] = round((time.process_time() - cpu_start) * 1000, 3)
+        usage["peak_rss_kb"] = _peak_rss_kb()
+
+
+@contextmanager
+def enforce(cpu_limit: Optional[float] = None, memory_limit: Optional[int] = None):
+    """
+    limits the CPU time and memory of the enclosed block, only the soft limits
+    are lowered so the worker can raise them back for the next test case.
+
+    Args:
+        cpu_limit (float, optional): seconds of CPU time, CpuLimitExceeded is raised past it.
+            an ITIMER_PROF timer enforces it precisely, RLIMIT_CPU (whole seconds) backs it up.
+        memory_limit (int, optional): megabytes the block may allocate on top of what
+            the worker already uses, allocations past it raise MemoryError (RLIMIT_AS).
+    """
+    saved = {}
+    try:
+        if cpu_limit:
+            signal.signal(signal.SIGPROF, _raise_cpu_limit_exceeded)
+            signal.signal(signal.SIGXCPU, _raise_cpu_limit_exceeded)
+            saved[resource.RLIMIT_CPU] = soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+            used = math.ceil(time.process_time())
+            resource.setrlimit(resource.RLIMIT_CPU, (_capped(used + math.ceil(cpu_limit) + 1, hard), hard))
+            signal.setitimer(signal.ITIMER_PROF, cpu_limit)
+        if memory_limit:
+            saved[resource.RLIMIT_AS] = soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+            address_space = (_status_kb("VmSize") or 0) * 1024 + memory_limit * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (_capped(address_space, hard), hard))
+        yield
+    finally:
+        if cpu_limit:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+        for limit, values in saved.items():
+            resource.setrlimit(limit, values)
+
+
+def _capped(value: int, hard: int) -> int:
+    return value if hard == resource.RLIM_INFINITY else min(value, hard)
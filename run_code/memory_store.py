@@ -0,0 +1,635 @@
+"""
+an in-process stand-in for redis, for single node deployments (settings.STORE_BACKEND = "memory").
+
+MemoryStore implements the redis-py commands used by RedisOperations and by the
+pipelines of the other modules, with the same replies (values are bytes), so it's
+passed to RedisOperations as its client. keys expire like they do in redis, and when
+the values outgrow the memory budget the keys with an expiry are evicted, the
+soonest to expire first (redis' volatile-ttl policy). lua scripts can't run here,
+every script registers a python equivalent with `script_equivalent`.
+"""
+import asyncio
+import heapq
+import threading
+import time
+from bisect import bisect_right
+from collections import deque
+from functools import wraps
+from itertools import islice
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+import settings
+
+
+# rough bytes taken by a key and by every item of a value besides their content
+_KEY_OVERHEAD = 64
+_ITEM_OVERHEAD = 16
+
+_scripts: Dict[str, Callable] = {}
+
+
+def script_equivalent(source: str):
+    """
+    registers the decorated function as the python equivalent of a lua script,
+    it's called as func(store, keys, args) while the store is locked.
+    """
+    def register(func: Callable) -> Callable:
+        _scripts[source] = func
+        return func
+    return register
+
+
+def _encode(value) -> bytes:
+    # like redis-py, every value is stored as bytes
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    if isinstance(value, float):
+        return repr(value).encode("utf-8")
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(value).encode("utf-8")
+    raise TypeError(f"invalid value of type {type(value).__name__}, convert it to bytes, str or a number")
+
+
+def _score(value) -> float:
+    return float(value.decode("utf-8") if isinstance(value, bytes) else value)
+
+
+def _stream_id(value) -> Tuple[int, int]:
+    ms, _, seq = _encode(value).decode("utf-8").partition("-")
+    return int(ms), int(seq or 0)
+
+
+class _Hash(dict):
+    pass
+
+
+class _SortedSet(dict):
+    """scores by member"""
+
+    def ranked(self) -> List[bytes]:
+        return [member for member, _ in sorted(self.items(), key=lambda item: (item[1], item[0]))]
+
+
+class _Stream:
+    def __init__(self):
+        self.ids: List[Tuple[int, int]] = []
+        self.entries: List[Tuple[bytes, Dict[bytes, bytes]]] = []
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def after(self, last_id: Tuple[int, int], count: Optional[int]) -> List[Tuple[bytes, Dict[bytes, bytes]]]:
+        start = bisect_right(self.ids, last_id)
+        return self.entries[start:start + count if count else None]
+
+
+def _command(func: Callable) -> Callable:
+    # every command runs with the store locked, after the expired keys are removed
+    @wraps(func)
+    def wrapper(self: "MemoryStore", *args, **kwargs):
+        with self._lock:
+            self._expire_keys()
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+class MemoryStore:
+    """
+    the keys of a single process, it's thread-safe and its blocking commands
+    also wake up the coroutines waiting in AsyncMemoryClient.
+
+    Args:
+        max_bytes (int): memory budget of the values, writes fail with a MemoryError
+            once it's exceeded and there is no key with an expiry left to evict.
+    """
+
+    def __init__(self, max_bytes: int = settings.MEMORY_STORE_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self._data: Dict[bytes, object] = {}
+        self._sizes: Dict[bytes, int] = {}
+        self._expires: Dict[bytes, float] = {}
+        # (expiry, key), entries whose key got another expiry since are skipped
+        self._expiry_heap: List[Tuple[float, bytes]] = []
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._waiters: Dict[bytes, List[Callable[[], None]]] = {}
+
+    # bookkeeping
+
+    def _expire_keys(self):
+        now = time.time()
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry_heap)
+            if self._expires.get(key) == expires_at:
+                self._remove(key)
+
+    def _set_expiry(self, key: bytes, seconds: Optional[float]):
+        if seconds is None:
+            self._expires.pop(key, None)
+            return
+        expires_at = time.time() + float(seconds)
+        self._expires[key] = expires_at
+        heapq.heappush(self._expiry_heap, (expires_at, key))
+        if len(self._expiry_heap) > 2 * len(self._expires) + 1024:
+            # keys whose expiry is refreshed often leave stale entries behind
+            self._expiry_heap = [(at, name) for name, at in self._expires.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def _remove(self, key: bytes):
+        if key in self._data:
+            del self._data[key]
+            self.used_bytes -= self._sizes.pop(key)
+        self._expires.pop(key, None)
+
+    def _grow(self, key: bytes, delta: int):
+        self._sizes[key] += delta
+        self.used_bytes += delta
+
+    def _reserve(self):
+        """called before a write, evicts keys with an expiry while the store is over its budget"""
+        if self.used_bytes <= self.max_bytes:
+            return
+        # evicting a little more than needed keeps it from running on every write
+        target = self.max_bytes * 0.9
+        for key, _ in sorted(self._expires.items(), key=lambda item: item[1]):
+            if self.used_bytes <= target:
+                break
+            self._remove(key)
+        if self.used_bytes > self.max_bytes:
+            raise MemoryError("OOM command not allowed when the memory store is over its budget")
+
+    def _get(self, key: bytes, kind: type, create: bool = False):
+        value = self._data.get(key)
+        if value is None:
+            if not create:
+                return None
+            value = self._data[key] = kind()
+            self._sizes[key] = _KEY_OVERHEAD + len(key)
+            self.used_bytes += self._sizes[key]
+        elif not isinstance(value, kind):
+            raise TypeError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def _drop_if_empty(self, key: bytes):
+        if key in self._data and not self._data[key]:
+            self._remove(key)
+
+    def _notify(self, key: bytes):
+        self._changed.notify_all()
+        for wake_up in self._waiters.pop(key, ()):
+            wake_up()
+
+    def watch(self, keys: Iterable, wake_up: Callable[[], None]):
+        """calls wake_up (once) the next time one of the keys gets an item, see AsyncMemoryClient"""
+        with self._lock:
+            for key in keys:
+                self._waiters.setdefault(_encode(key), []).append(wake_up)
+
+    def unwatch(self, keys: Iterable, wake_up: Callable[[], None]):
+        with self._lock:
+            for key in map(_encode, keys):
+                waiters = self._waiters.get(key, [])
+                if wake_up in waiters:
+                    waiters.remove(wake_up)
+                if not waiters:
+                    self._waiters.pop(key, None)
+
+    def _wait(self, attempt: Callable, timeout: float):
+        # timeout 0 waits forever, like the blocking commands of redis
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            while True:
+                result = attempt()
+                if result:
+                    return result
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return result
+                self._changed.wait(remaining)
+
+    # keys and strings
+
+    @_command
+    def exists(self, *names) -> int:
+        return sum(1 for name in names if _encode(name) in self._data)
+
+    @_command
+    def delete(self, *names) -> int:
+        deleted = 0
+        for key in map(_encode, names):
+            if key in self._data:
+                self._remove(key)
+                deleted += 1
+        return deleted
+
+    @_command
+    def expire(self, name, seconds: Union[int, float]) -> bool:
+        key = _encode(name)
+        if key not in self._data:
+            return False
+        self._set_expiry(key, seconds)
+        return True
+
+    @_command
+    def ttl(self, name) -> int:
+        key = _encode(name)
+        if key not in self._data:
+            return -2
+        if key not in self._expires:
+            return -1
+        return round(self._expires[key] - time.time())
+
+    @_command
+    def get(self, name) -> Optional[bytes]:
+        return self._get(_encode(name), bytes)
+
+    @_command
+    def mget(self, keys: List, *args) -> List[Optional[bytes]]:
+        return [self.get(name) for name in [*keys, *args]]
+
+    @_command
+    def set(self, name, value, ex: Optional[float] = None, nx: bool = False) -> Optional[bool]:
+        key = _encode(name)
+        if nx and key in self._data:
+            return None
+        self._reserve()
+        self._remove(key)
+        self._data[key] = _encode(value)
+        self._sizes[key] = _KEY_OVERHEAD + len(key) + len(self._data[key])
+        self.used_bytes += self._sizes[key]
+        self._set_expiry(key, ex)
+        return True
+
+    # lists
+
+    @_command
+    def rpush(self, name, *values) -> int:
+        self._reserve()
+        key = _encode(name)
+        items = self._get(key, deque, create=True)
+        for value in map(_encode, values):
+            items.append(value)
+            self._grow(key, len(value) + _ITEM_OVERHEAD)
+        self._notify(key)
+        return len(items)
+
+    def _pop(self, key: bytes, left: bool = True) -> Optional[bytes]:
+        items = self._get(key, deque)
+        if not items:
+            return None
+        value = items.popleft() if left else items.pop()
+        self._grow(key, -len(value) - _ITEM_OVERHEAD)
+        self._drop_if_empty(key)
+        return value
+
+    @_command
+    def lpop(self, name) -> Optional[bytes]:
+        return self._pop(_encode(name))
+
+    @_command
+    def lmove(self, first_list, second_list, src: str = "LEFT", dest: str = "RIGHT") -> Optional[bytes]:
+        value = self._pop(_encode(first_list), left=src.upper() == "LEFT")
+        if value is None:
+            return None
+        key = _encode(second_list)
+        items = self._get(key, deque, create=True)
+        if dest.upper() == "LEFT":
+            items.appendleft(value)
+        else:
+            items.append(value)
+        self._grow(key, len(value) + _ITEM_OVERHEAD)
+        self._notify(key)
+        return value
+
+    def blmove(
+        self, first_list, second_list, timeout: float, src: str = "LEFT", dest: str = "RIGHT"
+    ) -> Optional[bytes]:
+        return self._wait(lambda: self.lmove(first_list, second_list, src, dest), timeout)
+
+    def _pop_first(self, keys: List) -> Optional[List[bytes]]:
+        for name in keys:
+            value = self.lpop(name)
+            if value is not None:
+                return [_encode(name), value]
+        return None
+
+    def blpop(self, keys, timeout: float = 0) -> Optional[List[bytes]]:
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        return self._wait(lambda: self._pop_first(keys), timeout)
+
+    @_command
+    def lrem(self, name, count: int, value) -> int:
+        key, value = _encode(name), _encode(value)
+        items = self._get(key, deque)
+        if not items:
+            return 0
+        kept, removed = list(items), 0
+        positions = range(len(kept)) if count >= 0 else range(len(kept) - 1, -1, -1)
+        for position in positions:
+            if kept[position] == value and (not count or removed < abs(count)):
+                kept[position] = None
+                removed += 1
+        items.clear()
+        items.extend(item for item in kept if item is not None)
+        self._grow(key, -removed * (len(value) + _ITEM_OVERHEAD))
+        self._drop_if_empty(key)
+        return removed
+
+    @_command
+    def lrange(self, name, start: int, end: int) -> List[bytes]:
+        items = self._get(_encode(name), deque) or ()
+        size = len(items)
+        start = max(start + size, 0) if start < 0 else start
+        end = end + size if end < 0 else end
+        return list(islice(items, start, end + 1))
+
+    @_command
+    def lindex(self, name, index: int) -> Optional[bytes]:
+        items = self._get(_encode(name), deque) or ()
+        return items[index] if -len(items) <= index < len(items) else None
+
+    @_command
+    def llen(self, name) -> int:
+        return len(self._get(_encode(name), deque) or ())
+
+    # hashes
+
+    def _set_field(self, key: bytes, fields: _Hash, field: bytes, value: bytes) -> int:
+        previous = fields.get(field)
+        fields[field] = value
+        if previous is None:
+            self._grow(key, len(field) + len(value) + _ITEM_OVERHEAD)
+            return 1
+        self._grow(key, len(value) - len(previous))
+        return 0
+
+    @_command
+    def hset(self, name, key=None, value=None, mapping: Optional[Dict] = None) -> int:
+        self._reserve()
+        hash_key = _encode(name)
+        fields = self._get(hash_key, _Hash, create=True)
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        return sum(self._set_field(hash_key, fields, _encode(field), _encode(item)) for field, item in items.items())
+
+    @_command
+    def hincrby(self, name, key, amount: int = 1) -> int:
+        self._reserve()
+        hash_key, field = _encode(name), _encode(key)
+        fields = self._get(hash_key, _Hash, create=True)
+        value = int(fields.get(field, b"0")) + amount
+        self._set_field(hash_key, fields, field, _encode(value))
+        return value
+
+    @_command
+    def hdel(self, name, *keys) -> int:
+        hash_key = _encode(name)
+        fields = self._get(hash_key, _Hash) or {}
+        deleted = 0
+        for field in map(_encode, keys):
+            value = fields.pop(field, None)
+            if value is not None:
+                self._grow(hash_key, -len(field) - len(value) - _ITEM_OVERHEAD)
+                deleted += 1
+        self._drop_if_empty(hash_key)
+        return deleted
+
+    @_command
+    def hget(self, name, key) -> Optional[bytes]:
+        return (self._get(_encode(name), _Hash) or {}).get(_encode(key))
+
+    @_command
+    def hmget(self, name, keys: List, *args) -> List[Optional[bytes]]:
+        fields = self._get(_encode(name), _Hash) or {}
+        return [fields.get(_encode(key)) for key in [*keys, *args]]
+
+    @_command
+    def hgetall(self, name) -> Dict[bytes, bytes]:
+        return dict(self._get(_encode(name), _Hash) or {})
+
+    @_command
+    def hlen(self, name) -> int:
+        return len(self._get(_encode(name), _Hash) or ())
+
+    # sorted sets, only used by the scripts
+
+    @_command
+    def zadd(self, name, mapping: Dict) -> int:
+        self._reserve()
+        key = _encode(name)
+        members = self._get(key, _SortedSet, create=True)
+        added = 0
+        for member, score in mapping.items():
+            member = _encode(member)
+            if member not in members:
+                self._grow(key, len(member) + _ITEM_OVERHEAD)
+                added += 1
+            members[member] = _score(score)
+        return added
+
+    @_command
+    def zrem(self, name, *values) -> int:
+        key = _encode(name)
+        members = self._get(key, _SortedSet) or {}
+        removed = 0
+        for member in map(_encode, values):
+            if members.pop(member, None) is not None:
+                self._grow(key, -len(member) - _ITEM_OVERHEAD)
+                removed += 1
+        self._drop_if_empty(key)
+        return removed
+
+    @_command
+    def zremrangebyscore(self, name, min_score, max_score) -> int:
+        members = self._get(_encode(name), _SortedSet) or {}
+        low, high = _score(min_score), _score(max_score)
+        return self.zrem(name, *[member for member, score in members.items() if low <= score <= high])
+
+    @_command
+    def zcard(self, name) -> int:
+        return len(self._get(_encode(name), _SortedSet) or ())
+
+    @_command
+    def zscore(self, name, value) -> Optional[float]:
+        return (self._get(_encode(name), _SortedSet) or {}).get(_encode(value))
+
+    @_command
+    def zrank(self, name, value) -> Optional[int]:
+        members = self._get(_encode(name), _SortedSet)
+        member = _encode(value)
+        if not members or member not in members:
+            return None
+        return members.ranked().index(member)
+
+    # streams
+
+    @_command
+    def xadd(self, name, fields: Dict) -> bytes:
+        self._reserve()
+        key = _encode(name)
+        stream = self._get(key, _Stream, create=True)
+        entry_id = (int(time.time() * 1000), 0)
+        if stream.ids and entry_id <= stream.ids[-1]:
+            entry_id = (stream.ids[-1][0], stream.ids[-1][1] + 1)
+        encoded_id = f"{entry_id[0]}-{entry_id[1]}".encode("utf-8")
+        entry = {_encode(field): _encode(value) for field, value in fields.items()}
+        stream.ids.append(entry_id)
+        stream.entries.append((encoded_id, entry))
+        self._grow(key, len(encoded_id) + sum(len(f) + len(v) for f, v in entry.items()) + _ITEM_OVERHEAD)
+        self._notify(key)
+        return encoded_id
+
+    @_command
+    def _read_streams(self, last_ids: Dict[bytes, Tuple[int, int]], count: Optional[int]) -> List:
+        response = []
+        for key, last_id in last_ids.items():
+            stream = self._get(key, _Stream)
+            entries = stream.after(last_id, count) if stream else []
+            if entries:
+                response.append([key, entries])
+        return response
+
+    @_command
+    def _resolve_stream_ids(self, streams: Dict) -> Dict[bytes, Tuple[int, int]]:
+        # "$" only reads the entries added after the call
+        last_ids = {}
+        for name, last_id in streams.items():
+            key = _encode(name)
+            if _encode(last_id) == b"$":
+                stream = self._get(key, _Stream)
+                last_ids[key] = stream.ids[-1] if stream else (0, 0)
+            else:
+                last_ids[key] = _stream_id(last_id)
+        return last_ids
+
+    def xread(self, streams: Dict, count: Optional[int] = None, block: Optional[int] = None) -> List:
+        last_ids = self._resolve_stream_ids(streams)
+        if block is None:
+            return self._read_streams(last_ids, count)
+        return self._wait(lambda: self._read_streams(last_ids, count), block / 1000)
+
+    # pipelines and scripts
+
+    def pipeline(self, transaction: bool = True) -> "MemoryPipeline":
+        return MemoryPipeline(self)
+
+    def run_script(self, source: str, keys: List, args: List):
+        script = _scripts.get(source)
+        if script is None:
+            raise NotImplementedError("the script has no python equivalent, see memory_store.script_equivalent")
+        with self._lock:
+            self._expire_keys()
+            return script(self, list(keys), list(args))
+
+    def register_script(self, source: str) -> Callable:
+        def run(keys: List = (), args: List = ()):
+            return self.run_script(source, keys, args)
+        return run
+
+
+class MemoryPipeline:
+    """queues commands like a redis pipeline, they all run while the store is locked"""
+
+    def __init__(self, store: MemoryStore):
+        self.store = store
+        self._commands: List[Tuple[Callable, tuple, dict]] = []
+
+    def __getattr__(self, name: str) -> Callable:
+        command = getattr(self.store, name)
+
+        def queue(*args, **kwargs) -> "MemoryPipeline":
+            self._commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def __enter__(self) -> "MemoryPipeline":
+        return self
+
+    def __exit__(self, *exc_info):
+        self._commands = []
+
+    def execute(self) -> List:
+        commands, self._commands = self._commands, []
+        with self.store._lock:
+            return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class AsyncMemoryPipeline(MemoryPipeline):
+    async def __aenter__(self) -> "AsyncMemoryPipeline":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._commands = []
+
+    async def execute(self) -> List:
+        return super().execute()
+
+
+class AsyncMemoryClient:
+    """
+    the asyncio counterpart of a MemoryStore, for AsyncRedisOperations.
+    commands never wait for the lock long, the blocking ones wait without holding a thread.
+    """
+
+    def __init__(self, store: MemoryStore):
+        self.store = store
+
+    def __getattr__(self, name: str) -> Callable:
+        command = getattr(self.store, name)
+
+        async def run(*args, **kwargs):
+            return command(*args, **kwargs)
+        return run
+
+    async def _wait(self, keys: List, attempt: Callable, timeout: float):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout else None
+        while True:
+            woken = asyncio.Event()
+
+            def wake_up():
+                loop.call_soon_threadsafe(woken.set)
+
+            # watching before the attempt, an item pushed in between isn't missed
+            self.store.watch(keys, wake_up)
+            try:
+                result = attempt()
+                if result:
+                    return result
+                remaining = None if deadline is None else deadline - loop.time()
+                if remaining is not None and remaining <= 0:
+                    return result
+                try:
+                    await asyncio.wait_for(woken.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                self.store.unwatch(keys, wake_up)
+
+    async def blpop(self, keys, timeout: float = 0) -> Optional[List[bytes]]:
+        keys = [keys] if isinstance(keys, (str, bytes)) else list(keys)
+        return await self._wait(keys, lambda: self.store._pop_first(keys), timeout)
+
+    async def blmove(
+        self, first_list, second_list, timeout: float, src: str = "LEFT", dest: str = "RIGHT"
+    ) -> Optional[bytes]:
+        return await self._wait(
+            [first_list], lambda: self.store.lmove(first_list, second_list, src, dest), timeout
+        )
+
+    async def xread(self, streams: Dict, count: Optional[int] = None, block: Optional[int] = None) -> List:
+        last_ids = self.store._resolve_stream_ids(streams)
+        if block is None:
+            return self.store._read_streams(last_ids, count)
+        return await self._wait(list(streams), lambda: self.store._read_streams(last_ids, count), block / 1000)
+
+    def pipeline(self, transaction: bool = True) -> AsyncMemoryPipeline:
+        return AsyncMemoryPipeline(self.store)
+
+    def register_script(self, source: str) -> Callable:
+        async def run(keys: List = (), args: List = ()):
+            return self.store.run_script(source, keys, args)
+        return run
@@ -0,0 +1,225 @@
+"""
+in-process counters, gauges and histograms rendered in the prometheus text format,
+and per-stage timers of a submission.
+
+worker processes don't own any metric, the stages they time are forwarded to
+the parent with the end of job message (see worker_pool._worker_loop).
+"""
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Tuple
+import settings
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry: List["_Metric"] = []
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, description: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [
+                f"{self.name}{_format_labels(self.labels, key)} {value}"
+                for key, value in self._values.items()
+            ]
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"] + self._samples()
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self, name: str, description: str, labels: Iterable[str] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # a count per bucket (the last one is +Inf) and the sum of the values
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            states = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        lines = []
+        bounds = [str(bucket) for bucket in self.buckets] + ["+Inf"]
+        for key, counts, total in states:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labels + ('le',), key + (bound,))} {cumulative}"
+                )
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    """every metric in the prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "run_code_stage_seconds", "time spent in each stage of a submission", ["stage"]
+)
+REQUEST_SECONDS = Histogram(
+    "run_code_request_seconds", "duration of the http requests", ["method", "route", "status"]
+)
+SUBMISSIONS = Counter("run_code_submissions_total", "accepted submissions", ["backend"])
+TEST_RESULTS = Counter("run_code_test_results_total", "verdicts of the executed test cases", ["verdict"])
+CACHED_RESULTS = Counter("run_code_cached_results_total", "test results served from the result cache")
+WORKERS_ACTIVE = Gauge("run_code_workers_active", "pool workers running a job")
+WORKER_SPAWNS = Counter("run_code_worker_spawns_total", "pool workers forked")
+WORKER_TIMEOUTS = Counter("run_code_worker_timeouts_total", "pool workers killed because a job ran out of time")
+WORKER_REPLACEMENTS = Counter(
+    "run_code_worker_replacements_total", "idle workers replaced before running the code of another owner"
+)
+WORKER_CRASHES = Counter("run_code_worker_crashes_total", "pool workers that died while running a job")
+ADMISSIONS = Counter("run_code_admissions_total", "admission decisions of the submissions", ["outcome"])
+EXECUTIONS_RUNNING = Gauge("run_code_executions_running", "executions currently in run_tests")
+QUEUE_DEPTH = Gauge("run_code_queue_depth", "jobs waiting in the redis job queue")
+REGRADED_SUBMISSIONS = Counter(
+    "run_code_regraded_submissions_total", "submissions executed by /regrade", ["verdict"]
+)
+COMPLEXITY_ANALYSES = Counter(
+    "run_code_complexity_analyses_total", "analyses of /complexity by why their sizes stopped growing", ["stopped"]
+)
+REDIS_ERRORS = Counter(
+    "run_code_redis_errors_total", "redis errors handled by RedisOperations", ["operation"]
+)
+
+
+# stage timings of the execution running in the current context
+_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("stage_timings", default=None)
+# set inside pool workers, their stages are sent to the parent instead of being observed
+_forwarded: Optional[List[Tuple[str, float]]] = None
+
+
+def observe_stage(stage: str, seconds: float, timings: Optional[Dict[str, float]] = None):
+    """
+    Args:
+        timings (Dict[str, float], optional): the seconds are added to timings[stage],
+            defaults to the timings of the execution tracked by track_stages
+    """
+    if _forwarded is not None:
+        _forwarded.append((stage, seconds))
+        return
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if timings is None:
+        timings = _timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage: str, timings: Optional[Dict[str, float]] = None):
+    """times the enclosed block as `stage`, see observe_stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start, timings)
+
+
+def log_stages(execution_id: str, timings: Dict[str, float]):
+    """prints the stage timings of an execution as a single JSON line"""
+    if settings.METRICS_LOG_STAGES and timings:
+        stages_ms = {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()}
+        print(json.dumps({"execution_id": execution_id, "stages_ms": stages_ms}))
+
+
+@contextmanager
+def track_stages(execution_id: str):
+    """collects the stages timed in the enclosed block (also by the pool workers) and logs them"""
+    timings: Dict[str, float] = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+        log_stages(execution_id, timings)
+
+
+def forward_stages():
+    """called once in a worker process, see drain_stages"""
+    global _forwarded
+    _forwarded = []
+
+
+def drain_stages() -> List[Tuple[str, float]]:
+    """the stages timed in this worker since the last call"""
+    global _forwarded
+    stages, _forwarded = _forwarded, []
+    return stages
+
+
+def record_stages(stages: Optional[List[Tuple[str, float]]]):
+    """observes the stages forwarded by a worker"""
+    for stage, seconds in stages or ():
+        observe_stage(stage, seconds)
@@ -0,0 +1,22 @@
+"""
+imported by the forkserver of the worker pool, everything it loads is shared by
+every worker it starts (see settings.WORKER_START_METHOD).
+"""
+import importlib
+import pickle
+import settings
+# the worker loop and the targets it receives
+from . import complexity, profiling, regrade, run_tests  # noqa: F401
+
+
+for module_name in settings.PRELOAD_MODULES:
+    try:
+        importlib.import_module(module_name)
+    except ImportError:
+        pass
+
+# a job round trip resolves everything a job references once, before any worker starts
+pickle.loads(pickle.dumps((run_tests._execute_suite, ({"id": 1, "input": (1, 2.0), "expected": [3]},))))
+# measured once here instead of in every worker that profiles
+profiling.call_overhead_us()
+profiling.allocation_slowdown()
@@ -0,0 +1,199 @@
+"""
+profiling of the solution's solve() inside the workers, the profile mode of /run-code.
+
+cProfile records the calls made by solve ("cpu") and tracemalloc the memory it
+allocates ("memory"), both only while solve runs. the reports are compact, only the
+settings.PROFILE_TOP entries that matter most are kept, and they carry an estimate
+of the profilers' own overhead so the timings can be read with it in mind.
+"""
+import cProfile
+import os
+import pstats
+import time
+import tracemalloc
+from functools import lru_cache
+from typing import Dict, List, Optional
+import settings
+
+
+CPU = "cpu"
+MEMORY = "memory"
+TOOLS = (CPU, MEMORY)
+
+# solutions are compiled under this name, see code_cache
+SOLUTION_FILE = "<received_file>"
+
+
+def _calls(count: int):
+    def leaf():
+        pass
+
+    for _ in range(count):
+        leaf()
+
+
+def _allocations(count: int):
+    for _ in range(count):
+        [None] * 8
+
+
+@lru_cache(maxsize=None)
+def call_overhead_us(count: int = 20000) -> float:
+    """microseconds cProfile adds to every function call in this process, measured once"""
+    start = time.perf_counter()
+    _calls(count)
+    bare = time.perf_counter() - start
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.runcall(_calls, count)
+    profiled = time.perf_counter() - start
+    return max(profiled - bare, 0) / count * 1e6
+
+
+@lru_cache(maxsize=None)
+def allocation_slowdown(count: int = 20000) -> float:
+    """how many times slower allocations get while tracemalloc traces them, measured once"""
+    start = time.perf_counter()
+    _allocations(count)
+    bare = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        _allocations(count)
+        traced = time.perf_counter() - start
+    finally:
+        tracemalloc.stop()
+    return traced / bare if bare else 1.0
+
+
+def _function_name(file: str, line: int, name: str) -> str:
+    if file == "~":
+        # builtins, eg. "<built-in method builtins.sorted>"
+        return name
+    return f"{name} ({os.path.basename(file)}:{line})"
+
+
+class Profiler:
+    """
+    profiles the enclosed block (the call of solve) with the given tools,
+    the report is available once the block is done, also when it raised (eg. timed out).
+    """
+
+    def __init__(self, tools: List[str] = TOOLS, top: int = settings.PROFILE_TOP):
+        self.tools = [tool for tool in TOOLS if tool in tools]
+        self.top = top
+        self._profile: Optional[cProfile.Profile] = None
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._peak = 0
+        self._tracer_memory = 0
+        self._start = 0.0
+        self._wall = 0.0
+        self._done = False
+
+    def __enter__(self) -> "Profiler":
+        if MEMORY in self.tools:
+            # a previous trace of this worker would be mixed with this one
+            tracemalloc.stop()
+            tracemalloc.start()
+        if CPU in self.tools:
+            self._profile = cProfile.Profile()
+        self._start = time.perf_counter()
+        if self._profile is not None:
+            self._profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._profile is not None:
+            self._profile.disable()
+        self._wall = time.perf_counter() - self._start
+        if MEMORY in self.tools:
+            self._peak = tracemalloc.get_traced_memory()[1]
+            self._tracer_memory = tracemalloc.get_tracemalloc_memory()
+            # the test harness around solve isn't the solution's
+            self._snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, os.path.join(os.path.dirname(__file__), "*")),
+            ])
+            tracemalloc.stop()
+        self._done = True
+        return False
+
+    def _functions(self) -> Dict:
+        stats = pstats.Stats(self._profile).stats
+        entries = [
+            (key, calls, total, cumulative)
+            for key, (_, calls, total, cumulative, _) in stats.items()
+            # the profiler's own methods
+            if key[0] != __file__ and "_lsprof.Profiler" not in key[2]
+        ]
+        entries.sort(key=lambda entry: entry[3], reverse=True)
+        total_calls = sum(entry[1] for entry in entries)
+        estimated_ms = total_calls * call_overhead_us() / 1000
+        return {
+            "functions": [
+                {
+                    "function": _function_name(*key),
+                    "calls": calls,
+                    "own_time_ms": round(total * 1000, 3),
+                    "cumulative_time_ms": round(cumulative * 1000, 3),
+                }
+                for key, calls, total, cumulative in entries[:self.top]
+            ],
+            "calls": total_calls,
+            "cpu_overhead": {
+                "estimated_ms": round(estimated_ms, 3),
+                # share of the profiled wall time spent in the profiler
+                "estimated_ratio": round(min(estimated_ms / (self._wall * 1000), 1), 3) if self._wall else 0,
+            },
+        }
+
+    def _allocations(self) -> Dict:
+        statistics = self._snapshot.statistics("lineno")
+        return {
+            # memory solve allocated and still held when it returned, by line
+            "allocations": [
+                {
+                    "site": f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+                    "size_kb": round(stat.size / 1024, 3),
+                    "count": stat.count,
+                }
+                for stat in statistics[:self.top]
+            ],
+            "peak_memory_kb": round(self._peak / 1024, 3),
+            "memory_overhead": {
+                "allocation_slowdown": round(allocation_slowdown(), 2),
+                "tracer_memory_kb": round(self._tracer_memory / 1024, 3),
+            },
+        }
+
+    def report(self) -> Optional[Dict]:
+        """the compact report of the profiled block, None if it didn't run"""
+        if not self._done:
+            return None
+        report = {"tools": self.tools, "profiled_wall_time_ms": round(self._wall * 1000, 3)}
+        if self._profile is not None:
+            report.update(self._functions())
+        if self._snapshot is not None:
+            report.update(self._allocations())
+        return report
+
+
+def selected_positions(profile: Optional[Dict], ids: List) -> List[int]:
+    """
+    Args:
+        profile (Dict, optional): {'tools', 'test_case_ids'} of a profiled execution,
+            the ids are strings
+        ids (List): ids of the execution's test cases, in order
+
+    Returns:
+        List[int]: positions of the profiled test cases, those with the selected ids or else
+            the first ones, at most settings.PROFILE_MAX_TEST_CASES
+    """
+    if not profile:
+        return []
+    if profile.get("test_case_ids"):
+        wanted = set(profile["test_case_ids"])
+        positions = [position for position, _id in enumerate(ids) if str(_id) in wanted]
+    else:
+        positions = list(range(len(ids)))
+    return positions[:settings.PROFILE_MAX_TEST_CASES]
@@ -1,16 +1,77 @@
 import redis
-from typing import List, Optional, Dict
+import redis.asyncio
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Dict, Tuple
+from .exceptions import BlockingConnectionsExhausted
+from .memory_store import AsyncMemoryClient, MemoryStore, script_equivalent
+from .metrics import REDIS_ERRORS
 import settings
 
+
+# returns the value of KEYS[1] and deletes every key if it exists, in a single round trip
+GET_AND_DELETE_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('DEL', unpack(KEYS))
+end
+return value
+"""
+
+
+@script_equivalent(GET_AND_DELETE_SCRIPT)
+def _get_and_delete(store: MemoryStore, keys: List[str], args: List):
+    value = store.get(keys[0])
+    if value is not None:
+        store.delete(*keys)
+    return value
+
+
 class RedisOperations:
-    def __init__(self, host: str = settings.REDIS_HOST, port: int = settings.REDIS_PORT, db: int = 0):
-        self.client = redis.Redis(host=host, port=port, db=db)
+    """
+    the operations on the state shared by the API and the executors, the client is a
+    redis server's or a MemoryStore (see settings.STORE_BACKEND).
+    """
+
+    def __init__(
+        self,
+        host: str = settings.REDIS_HOST,
+        port: int = settings.REDIS_PORT,
+        db: int = 0,
+        client: Optional[redis.Redis] = None,
+        max_connections: int = settings.REDIS_MAX_CONNECTIONS,
+    ):
+        # a client can be passed in to use an in-process stand-in (eg. MemoryStore),
+        # otherwise every thread shares one pool and waits for a free connection
+        if client is None:
+            pool = redis.BlockingConnectionPool(
+                host=host, port=port, db=db, max_connections=max_connections
+            )
+            client = redis.Redis(connection_pool=pool)
+        self.client = client
+
+    def execute_pipeline(
+        self, build: Callable[[redis.client.Pipeline], None], transaction: bool = True
+    ) -> Optional[List]:
+        """queues the commands added by build(pipe) and sends them in a single round trip
+
+        Returns:
+            List: the reply of every command, None if the pipeline failed
+        """
+        try:
+            with self.client.pipeline(transaction=transaction) as pipe:
+                build(pipe)
+                return pipe.execute()
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="execute_pipeline")
+            print(f"Error executing pipeline: {e}")
+            return None
 
     def set_value(self, key: str, value: str, ex: int=None) -> bool:
         try:
             self.client.set(key, value, ex=ex)
             return True
         except Exception as e:
+            REDIS_ERRORS.inc(operation="set_value")
             print(f"Error setting value: {e}")
             return False
 
@@ -19,22 +80,48 @@ class RedisOperations:
             value = self.client.get(key)
             return value.decode('utf-8') if value else None
         except Exception as e:
+            REDIS_ERRORS.inc(operation="get_value")
+            print(f"Error getting value: {e}")
+            return None
+
+    def get_raw_value(self, key: str) -> Optional[bytes]:
+        """like get_value for binary values"""
+        try:
+            return self.client.get(key)
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="get_raw_value")
             print(f"Error getting value: {e}")
             return None
 
+    def get_values(self, keys: List[str]) -> List[Optional[str]]:
+        """gets many values in a single round trip, missing keys are None"""
+        try:
+            values = self.client.mget(keys)
+            return [value.decode('utf-8') if value else None for value in values]
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="get_values")
+            print(f"Error getting values: {e}")
+            return [None] * len(keys)
+
     def delete_key(self, key: str) -> bool:
         try:
             result = self.client.delete(key)
             return result > 0
         except Exception as e:
+            REDIS_ERRORS.inc(operation="delete_key")
             print(f"Error deleting key: {e}")
             return False
 
-    def push_to_list(self, list_name: str, value: str) -> bool:
+    def push_to_list(self, list_name: str, value: str, ex: int = None) -> bool:
         try:
-            self.client.rpush(list_name, value)
+            with self.client.pipeline() as pipe:
+                pipe.rpush(list_name, value)
+                if ex:
+                    pipe.expire(list_name, ex)
+                pipe.execute()
             return True
         except Exception as e:
+            REDIS_ERRORS.inc(operation="push_to_list")
             print(f"Error pushing to list: {e}")
             return False
 
@@ -43,22 +130,84 @@ class RedisOperations:
             value = self.client.lpop(list_name)
             return value.decode('utf-8') if value else None
         except Exception as e:
+            REDIS_ERRORS.inc(operation="pop_from_list")
             print(f"Error popping from list: {e}")
             return None
 
+    def move_from_list(self, source: str, destination: str, src: str = "LEFT", dest: str = "RIGHT") -> Optional[str]:
+        try:
+            value = self.client.lmove(source, destination, src=src, dest=dest)
+            return value.decode('utf-8') if value else None
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="move_from_list")
+            print(f"Error moving from list: {e}")
+            return None
+
+    def blocking_pop_from_list(self, list_name: str, timeout: float) -> Optional[str]:
+        """waits up to timeout seconds for an item of the list"""
+        try:
+            value = self.client.blpop([list_name], timeout=timeout)
+            return value[1].decode('utf-8') if value else None
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="blocking_pop_from_list")
+            print(f"Error popping from list: {e}")
+            return None
+
+    def blocking_move_from_list(self, source: str, destination: str, timeout: float = 0) -> Optional[str]:
+        """atomically moves the first item of source to the end of destination,
+        waits up to timeout seconds (0 waits forever) for an item to show up"""
+        try:
+            value = self.client.blmove(source, destination, timeout, src="LEFT", dest="RIGHT")
+            return value.decode('utf-8') if value else None
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="blocking_move_from_list")
+            print(f"Error moving from list: {e}")
+            return None
+
+    def remove_from_list(self, list_name: str, value: str, count: int = 1) -> bool:
+        try:
+            return self.client.lrem(list_name, count, value) > 0
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="remove_from_list")
+            print(f"Error removing from list: {e}")
+            return False
+
     def get_all_from_list(self, list_name: str) -> List[str]:
         try:
             values = self.client.lrange(list_name, 0, -1)
             return [value.decode('utf-8') for value in values]
         except Exception as e:
+            REDIS_ERRORS.inc(operation="get_all_from_list")
             print(f"Error getting all from list: {e}")
             return []
 
+    def get_list_length(self, list_name: str) -> Optional[int]:
+        try:
+            return self.client.llen(list_name)
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="get_list_length")
+            print(f"Error getting list length: {e}")
+            return None
+
+    def run_script(self, script: str, keys: List[str], args: List) -> Optional[object]:
+        """runs a lua script atomically
+
+        Returns:
+            the script's reply, None if it failed
+        """
+        try:
+            return self.client.register_script(script)(keys=keys, args=args)
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="run_script")
+            print(f"Error running script: {e}")
+            return None
+
     def set_hash_field(self, hash_name: str, field: str, value: str) -> bool:
         try:
             self.client.hset(hash_name, field, value)
             return True
         except Exception as e:
+            REDIS_ERRORS.inc(operation="set_hash_field")
             print(f"Error setting hash field: {e}")
             return False
 
@@ -67,6 +216,7 @@ class RedisOperations:
             value = self.client.hget(hash_name, field)
             return value.decode('utf-8') if value else None
         except Exception as e:
+            REDIS_ERRORS.inc(operation="get_hash_field")
             print(f"Error getting hash field: {e}")
             return None
 
@@ -75,11 +225,249 @@ class RedisOperations:
             fields = self.client.hgetall(hash_name)
             return {k.decode('utf-8'): v.decode('utf-8') for k, v in fields.items()}
         except Exception as e:
+            REDIS_ERRORS.inc(operation="get_all_from_hash")
             print(f"Error getting all from hash: {e}")
             return {}
 
 
-redis_operations = RedisOperations()
+class AsyncRedisOperations:
+    """asyncio counterpart of RedisOperations for the async endpoints"""
+
+    def __init__(
+        self,
+        host: str = settings.REDIS_HOST,
+        port: int = settings.REDIS_PORT,
+        db: int = 0,
+        client: Optional[redis.asyncio.Redis] = None,
+        max_connections: int = settings.REDIS_MAX_CONNECTIONS,
+    ):
+        if client is None:
+            pool = redis.asyncio.BlockingConnectionPool(
+                host=host, port=port, db=db, max_connections=max_connections
+            )
+            client = redis.asyncio.Redis(connection_pool=pool)
+        self.client = client
+
+    async def execute_pipeline(
+        self, build: Callable[[redis.asyncio.client.Pipeline], None], transaction: bool = True
+    ) -> Optional[List]:
+        try:
+            async with self.client.pipeline(transaction=transaction) as pipe:
+                build(pipe)
+                return await pipe.execute()
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="execute_pipeline")
+            print(f"Error executing pipeline: {e}")
+            return None
+
+    async def set_value(self, key: str, value: str, ex: int=None) -> bool:
+        try:
+            await self.client.set(key, value, ex=ex)
+            return True
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="set_value")
+            print(f"Error setting value: {e}")
+            return False
+
+    async def get_value(self, key: str) -> Optional[str]:
+        try:
+            value = await self.client.get(key)
+            return value.decode('utf-8') if value else None
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="get_value")
+            print(f"Error getting value: {e}")
+            return None
+
+    async def get_raw_value(self, key: str) -> Optional[bytes]:
+        try:
+            return await self.client.get(key)
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="get_raw_value")
+            print(f"Error getting value: {e}")
+            return None
+
+    async def get_values(self, keys: List[str]) -> List[Optional[str]]:
+        try:
+            values = await self.client.mget(keys)
+            return [value.decode('utf-8') if value else None for value in values]
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="get_values")
+            print(f"Error getting values: {e}")
+            return [None] * len(keys)
+
+    async def get_and_delete(self, key: str, *other_keys: str) -> Optional[str]:
+        """atomically reads key and, if it exists, deletes it together with other_keys"""
+        try:
+            script = self.client.register_script(GET_AND_DELETE_SCRIPT)
+            value = await script(keys=[key, *other_keys])
+            return value.decode('utf-8') if value else None
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="get_and_delete")
+            print(f"Error getting and deleting value: {e}")
+            return None
+
+    async def run_script(self, script: str, keys: List[str], args: List) -> Optional[object]:
+        """like RedisOperations.run_script"""
+        try:
+            return await self.client.register_script(script)(keys=keys, args=args)
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="run_script")
+            print(f"Error running script: {e}")
+            return None
+
+    async def delete_key(self, key: str) -> bool:
+        try:
+            result = await self.client.delete(key)
+            return result > 0
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="delete_key")
+            print(f"Error deleting key: {e}")
+            return False
+
+    async def push_to_list(self, list_name: str, value: str) -> bool:
+        try:
+            await self.client.rpush(list_name, value)
+            return True
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="push_to_list")
+            print(f"Error pushing to list: {e}")
+            return False
+
+    async def blocking_pop_from_list(self, list_name: str, timeout: float) -> Optional[str]:
+        """waits up to timeout seconds for an item of the list without holding a thread"""
+        try:
+            value = await self.client.blpop([list_name], timeout=timeout)
+            return value[1].decode('utf-8') if value else None
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="blocking_pop_from_list")
+            print(f"Error popping from list: {e}")
+            return None
+
+    async def get_list_length(self, list_name: str) -> Optional[int]:
+        try:
+            return await self.client.llen(list_name)
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="get_list_length")
+            print(f"Error getting list length: {e}")
+            return None
+
+    async def get_hash_fields(self, hash_name: str, fields: List[str]) -> List[Optional[bytes]]:
+        """gets the raw values of many fields in a single round trip, missing fields are None"""
+        try:
+            return await self.client.hmget(hash_name, fields)
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="get_hash_fields")
+            print(f"Error getting hash fields: {e}")
+            return [None] * len(fields)
+
+    async def get_hash_length(self, hash_name: str) -> Optional[int]:
+        try:
+            return await self.client.hlen(hash_name)
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="get_hash_length")
+            print(f"Error getting hash length: {e}")
+            return None
+
+    async def get_all_from_hash(self, hash_name: str) -> Dict[str, str]:
+        try:
+            fields = await self.client.hgetall(hash_name)
+            return {k.decode('utf-8'): v.decode('utf-8') for k, v in fields.items()}
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="get_all_from_hash")
+            print(f"Error getting all from hash: {e}")
+            return {}
+
+    async def read_stream(
+        self, stream_name: str, last_id: str = "0", block: int = None, count: int = None
+    ) -> List[Tuple[str, Dict[str, str]]]:
+        try:
+            response = await self.client.xread({stream_name: last_id}, count=count, block=block)
+            if not response:
+                return []
+            return [
+                (entry_id.decode('utf-8'), {k.decode('utf-8'): v.decode('utf-8') for k, v in fields.items()})
+                for entry_id, fields in response[0][1]
+            ]
+        except Exception as e:
+            REDIS_ERRORS.inc(operation="read_stream")
+            print(f"Error reading from stream: {e}")
+            return []
+
+
+class AsyncBlockingOperations(AsyncRedisOperations):
+    """
+    AsyncRedisOperations for the commands that hold their connection while they wait,
+    on a pool of their own so they can't take every connection of the other commands.
+
+    a blocking command raises BlockingConnectionsExhausted right away when every connection
+    of the pool is taken, instead of waiting for one.
+    """
+
+    def __init__(
+        self,
+        host: str = settings.REDIS_HOST,
+        port: int = settings.REDIS_PORT,
+        db: int = 0,
+        client: Optional[redis.asyncio.Redis] = None,
+        max_connections: int = settings.REDIS_MAX_BLOCKING_CONNECTIONS,
+    ):
+        super().__init__(host, port, db, client, max_connections)
+        self.max_connections = max_connections
+        # blocking commands in progress, there's no await between the check and the increment
+        self.in_use = 0
+
+    def acquire(self):
+        """
+        takes one of the connections for a caller that keeps blocking (eg. a stream of
+        blocking reads), it must be given back with release
+
+        Raises:
+            BlockingConnectionsExhausted: if every connection is taken
+        """
+        if self.in_use >= self.max_connections:
+            raise BlockingConnectionsExhausted()
+        self.in_use += 1
+
+    def release(self):
+        self.in_use -= 1
+
+    @contextmanager
+    def _connection(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def blocking_pop_from_list(self, list_name: str, timeout: float) -> Optional[str]:
+        """
+        Raises:
+            BlockingConnectionsExhausted: if every connection is taken
+        """
+        with self._connection():
+            return await super().blocking_pop_from_list(list_name, timeout)
+
+
+def _create_operations() -> Tuple[RedisOperations, AsyncRedisOperations, AsyncBlockingOperations, AsyncBlockingOperations]:
+    if settings.STORE_BACKEND == "memory":
+        # they all share the keys of this process
+        store = MemoryStore()
+        return (
+            RedisOperations(client=store),
+            AsyncRedisOperations(client=AsyncMemoryClient(store)),
+            AsyncBlockingOperations(client=AsyncMemoryClient(store)),
+            AsyncBlockingOperations(client=AsyncMemoryClient(store), max_connections=settings.STREAM_MAX_CONCURRENT),
+        )
+    return (
+        RedisOperations(),
+        AsyncRedisOperations(),
+        AsyncBlockingOperations(),
+        AsyncBlockingOperations(max_connections=settings.STREAM_MAX_CONCURRENT),
+    )
+
+
+# the streams of /stream-result have a pool of their own, every stream holds one of its connections
+redis_operations, async_redis_operations, async_blocking_operations, async_stream_operations = _create_operations()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,266 @@
+"""
+regrading of many stored submissions against one test suite.
+
+the submissions are validated in bulk when they're received, identical sources
+run only once, every job runs a whole submission on one of the pool's workers
+and the results are written to redis in pipelined batches.
+"""
+import io
+import json
+import time
+import zipfile
+from typing import Dict, List, Optional
+from .redis_operations import (
+    AsyncRedisOperations,
+    RedisOperations,
+    async_redis_operations,
+    redis_operations,
+)
+from .result_store import jsonable
+from .test_case_files import TestCaseFile, get_test_case_ids
+from .utils import hash_source_code
+from .validation import get_policy, validate_source
+from . import comparators, metrics, run_tests
+import settings
+
+
+VALIDATION_ERROR = "ValidationError"
+RUNNING = "running"
+DONE = "done"
+
+
+def progress_key(regrade_id: str) -> str:
+    """name of the redis hash holding the progress counters of a regrade"""
+    return f"regrade:{regrade_id}"
+
+
+def results_key(regrade_id: str) -> str:
+    """name of the redis hash holding the result of every submission of a regrade"""
+    return f"regrade:{regrade_id}:results"
+
+
+def _parse_zip(data: bytes) -> List[Dict]:
+    submissions = []
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.endswith(".py"):
+                continue
+            submissions.append({
+                "submission_id": info.filename[:-len(".py")],
+                "source_code": archive.read(info).decode("utf-8"),
+            })
+    return submissions
+
+
+def _parse_jsonl(data: bytes) -> List[Dict]:
+    submissions = []
+    for number, line in enumerate(data.decode("utf-8").splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+            submissions.append({"submission_id": str(item["submission_id"]), "source_code": item["source"]})
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValueError(f"line {number}: expected {{'submission_id': ..., 'source': ...}} ({e})")
+    return submissions
+
+
+def parse_submissions(data: bytes) -> List[Dict]:
+    """
+    Args:
+        data (bytes): a zip archive of .py files named after their submission ids,
+            or JSONL lines of {"submission_id": ..., "source": ...}
+
+    Raises:
+        ValueError: if the file can't be parsed or a submission id is repeated
+
+    Returns:
+        List[Dict]: {'submission_id', 'source_code'} in the order of the file
+    """
+    try:
+        submissions = _parse_zip(data) if zipfile.is_zipfile(io.BytesIO(data)) else _parse_jsonl(data)
+    except (zipfile.BadZipFile, UnicodeDecodeError) as e:
+        raise ValueError(str(e))
+    seen = set()
+    for submission in submissions:
+        if submission["submission_id"] in seen:
+            raise ValueError(f"submission {submission['submission_id']} is repeated")
+        seen.add(submission["submission_id"])
+    return submissions
+
+
+def validate_submissions(submissions: List[Dict], allowed_imports: List[str]) -> List[Dict]:
+    """
+    validates every submission against the same policy, 'source_hash' and
+    'violations' (None for a valid submission) are added to each of them.
+    """
+    policy = get_policy(allowed_imports)
+    for submission in submissions:
+        submission["source_hash"] = hash_source_code(submission["source_code"])
+        result = validate_source(submission["source_code"], policy, submission["source_hash"])
+        if not result.is_valid:
+            submission["violations"] = [violation.as_dict() for violation in result.violations]
+        elif "solve" not in result.defined_names:
+            submission["violations"] = [{"line": None, "col": None, "message": "Function 'solve' not found."}]
+        else:
+            submission["violations"] = None
+    return submissions
+
+
+def _submission_result(submission_id: str, verdict: Optional[str], test_result: List[Dict], **extra) -> Dict:
+    return {"submission_id": submission_id, "verdict": verdict, "test_result": test_result, **extra}
+
+
+def invalid_result(submission: Dict) -> Dict:
+    """result of a submission that failed the validation, it's never executed"""
+    return _submission_result(
+        submission["submission_id"], VALIDATION_ERROR, [], violations=submission["violations"]
+    )
+
+
+def _queue_results(pipe, regrade_id: str, results: List[Dict]):
+    verdicts: Dict[str, int] = {}
+    for result in results:
+        pipe.hset(results_key(regrade_id), result["submission_id"], json.dumps(result, default=jsonable))
+        verdict = result["verdict"] or "none"
+        verdicts[verdict] = verdicts.get(verdict, 0) + 1
+    pipe.hincrby(progress_key(regrade_id), "completed", len(results))
+    for verdict, count in verdicts.items():
+        pipe.hincrby(progress_key(regrade_id), f"verdict:{verdict}", count)
+    pipe.expire(results_key(regrade_id), settings.REGRADE_TTL_SEC)
+    pipe.expire(progress_key(regrade_id), settings.REGRADE_TTL_SEC)
+
+
+async def start_async(
+    regrade_id: str, total: int, invalid_results: List[Dict],
+    redis_ops: AsyncRedisOperations = async_redis_operations,
+) -> bool:
+    """creates the progress of a regrade together with the results of its invalid submissions"""
+    def build(pipe):
+        pipe.hset(progress_key(regrade_id), mapping={
+            "status": RUNNING, "total": total, "invalid": len(invalid_results),
+            "completed": 0, "started_at": time.time(),
+        })
+        _queue_results(pipe, regrade_id, invalid_results)
+
+    return await redis_ops.execute_pipeline(build) is not None
+
+
+def _store_batch(regrade_id: str, results: List[Dict], done: bool = False, redis_ops: RedisOperations = redis_operations):
+    def build(pipe):
+        if results:
+            _queue_results(pipe, regrade_id, results)
+        if done:
+            pipe.hset(progress_key(regrade_id), mapping={"status": DONE, "finished_at": time.time()})
+
+    with metrics.timed("redis_write"):
+        redis_ops.execute_pipeline(build, transaction=False)
+
+
+def _grade(
+    source_code: str,
+    source_hash: str,
+    test_cases: List[Dict],
+    timeout: float,
+    cpu_limit: float = None,
+    memory_limit: int = None,
+    comparator: str = "exact",
+    tolerance: float = 0,
+    fail_fast: bool = False,
+) -> List[Dict]:
+    """runs a whole submission inside a pool worker (see run_tests._execute_suite) and returns every result"""
+    results = list(run_tests._execute_suite(
+        source_code, source_hash, test_cases, timeout, cpu_limit, memory_limit, comparator, tolerance, fail_fast
+    ))
+    return results + run_tests._skipped_results(get_test_case_ids(test_cases)[len(results):])
+
+
+def run_regrade(
+    regrade_id: str,
+    submissions: List[Dict],
+    test_cases: List[Dict],
+    cpu_limit: float = None,
+    memory_limit: int = None,
+    comparator: str = "exact",
+    tolerance: float = settings.COMPARATOR_TOLERANCE,
+    fail_fast: bool = False,
+):
+    """
+    runs the valid submissions of a regrade on every worker of the pool
+
+    Args:
+        regrade_id (str): id of the regrade, see start_async
+        submissions (List[Dict]): validated submissions, see validate_submissions
+        test_cases (List[Dict]): the test suite, decoded once for every submission
+            (an uploaded TestCaseFile is read by the workers, it's closed at the end)
+    """
+    # submissions with the same source share a single execution
+    submission_ids: Dict[str, List[str]] = {}
+    sources: Dict[str, str] = {}
+    for submission in submissions:
+        submission_ids.setdefault(submission["source_hash"], []).append(submission["submission_id"])
+        sources[submission["source_hash"]] = submission["source_code"]
+
+    jobs = [
+        (source_code, source_hash, test_cases, settings.RUN_TESTS_TIMEOUT,
+         cpu_limit, memory_limit, comparator, tolerance, fail_fast)
+        for source_hash, source_code in sources.items()
+    ]
+    # the module's top-level code has the same time limit as a test case
+    timeout = settings.RUN_TESTS_TIMEOUT * (len(test_cases) + 1) + settings.RUN_TESTS_GRACE_SEC
+    batch = []
+    try:
+        for job, results, error in run_tests.pool.run(_grade, jobs, timeout=timeout, owner=run_tests.source_owner):
+            if error is not None:
+                results = [
+                    run_tests._worker_error_result(_id, error, results) for _id in get_test_case_ids(test_cases)
+                ]
+            verdict = comparators.overall_verdict(results)
+            for submission_id in submission_ids[job[1]]:
+                batch.append(_submission_result(submission_id, verdict, results))
+                metrics.REGRADED_SUBMISSIONS.inc(verdict=verdict or "none")
+            if len(batch) >= settings.REGRADE_BATCH_SIZE:
+                _store_batch(regrade_id, batch)
+                batch = []
+        _store_batch(regrade_id, batch, done=True)
+    finally:
+        if isinstance(test_cases, TestCaseFile):
+            test_cases.close()
+    print(f"regrade {regrade_id} done: {len(submissions)} submissions, {len(jobs)} executions.")
+
+
+def _decode_progress(regrade_id: str, fields: Dict[str, str]) -> Optional[Dict]:
+    if not fields:
+        return None
+    progress = {
+        "regrade_id": regrade_id,
+        "status": fields.get("status"),
+        "total": int(fields.get("total", 0)),
+        "completed": int(fields.get("completed", 0)),
+        "invalid": int(fields.get("invalid", 0)),
+        "verdicts": {
+            field[len("verdict:"):]: int(value) for field, value in fields.items() if field.startswith("verdict:")
+        },
+    }
+    started_at = float(fields.get("started_at", 0))
+    finished_at = float(fields.get("finished_at", 0)) or time.time()
+    progress["elapsed_sec"] = round(finished_at - started_at, 3)
+    return progress
+
+
+async def get_progress_async(
+    regrade_id: str, redis_ops: AsyncRedisOperations = async_redis_operations
+) -> Optional[Dict]:
+    """
+    Returns:
+        Dict: the aggregate progress of the regrade, None if it doesn't exist
+    """
+    return _decode_progress(regrade_id, await redis_ops.get_all_from_hash(progress_key(regrade_id)))
+
+
+async def get_results_async(
+    regrade_id: str, redis_ops: AsyncRedisOperations = async_redis_operations
+) -> Dict[str, Dict]:
+    """the results stored so far, by submission id"""
+    fields = await redis_ops.get_all_from_hash(results_key(regrade_id))
+    return {submission_id: json.loads(value) for submission_id, value in fields.items()}
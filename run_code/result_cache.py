@@ -0,0 +1,215 @@
+import ast
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from .comparators import SKIPPED, verdict
+from .redis_operations import (
+    AsyncRedisOperations,
+    RedisOperations,
+    async_redis_operations,
+    redis_operations,
+)
+import settings
+
+
+# only these results depend on nothing but the solution and the input
+CACHEABLE_ERRORS = (None, "ExecutionError")
+
+# bumped when the stored values change, entries of the previous format are never read
+KEY_PREFIX = "result_cache:v2:"
+
+
+def cache_key(source_hash: str, allowed_imports: List[str], test_case: Dict, resource_limits: Tuple = ()) -> str:
+    """key of a single test case's result
+
+    Args:
+        source_hash (str): SHA-256 of the solution
+        allowed_imports (List[str]): the allowed imports the solution was validated with
+        test_case (Dict): only its 'input' is part of the key, so ids can change freely
+        resource_limits (Tuple): the CPU and memory limits the test case ran with
+    """
+    fingerprint = "|".join((
+        source_hash,
+        ",".join(sorted(allowed_imports)),
+        repr(test_case.get("input")),
+        repr(tuple(resource_limits)),
+    ))
+    return KEY_PREFIX + hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+
+def judging_key(test_case: Dict, comparator: str, tolerance: float) -> str:
+    """
+    what the verdict of a test case's result depends on besides its output, a cached verdict
+    is only reused by a submission that judges the same expected value the same way
+    """
+    expected = repr(test_case["expected"]) if "expected" in test_case else ""
+    fingerprint = "|".join((comparator, repr(float(tolerance)), expected))
+    return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+
+def encode_result(result: Dict) -> Optional[str]:
+    """
+    the cached value of a result, its output is stored as a python literal (like job_queue stores
+    the test cases) since JSON turns tuples into lists and the keys of dicts into strings.
+
+    Returns:
+        str: None if the output can't be written as a literal that reads back the same
+            (eg. a frozenset, nan or a deque)
+    """
+    value = result.get("output")
+    output = repr(value)
+    try:
+        literal = ast.literal_eval(output)
+        if type(literal) is not type(value) or literal != value:
+            # an object whose repr looks like a literal
+            return None
+        return json.dumps({**{k: v for k, v in result.items() if k != "id"}, "output": output})
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        return None
+
+
+def decode_result(value: str) -> Dict:
+    result = json.loads(value)
+    result["output"] = ast.literal_eval(result["output"])
+    return result
+
+
+class ResultCache:
+    """
+    a two tier cache of test results, an in-process LRU in front of redis
+    (where entries expire after `ttl` seconds and are shared between nodes).
+    """
+
+    def __init__(
+        self,
+        maxsize: int = settings.RESULT_CACHE_SIZE,
+        ttl: int = settings.RESULT_CACHE_TTL_SEC,
+        redis_ops: RedisOperations = redis_operations,
+        async_redis_ops: AsyncRedisOperations = async_redis_operations,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.redis_ops = redis_ops
+        self.async_redis_ops = async_redis_ops
+        self._lru: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key: str, value: str):
+        with self._lock:
+            self._lru[key] = value
+            self._lru.move_to_end(key)
+            if len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+
+    def _from_lru(self, keys: List[str]) -> Dict[str, str]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    found[key] = self._lru[key]
+        return found
+
+    def _merge(self, found: Dict[str, str], missing: List[str], values: List) -> Dict[str, Dict]:
+        for key, value in zip(missing, values):
+            if value is not None:
+                found[key] = value
+                self._remember(key, value)
+        return {key: decode_result(value) for key, value in found.items()}
+
+    def get_many(self, keys: List[str]) -> Dict[str, Dict]:
+        """
+        Returns:
+            Dict[str, Dict]: cached results (without their test case id) by key, misses are left out
+        """
+        found = self._from_lru(keys)
+        missing = [key for key in keys if key not in found]
+        values = self.redis_ops.get_values(missing) if missing else []
+        return self._merge(found, missing, values)
+
+    async def get_many_async(self, keys: List[str]) -> Dict[str, Dict]:
+        """like get_many, for the async endpoints"""
+        found = self._from_lru(keys)
+        missing = [key for key in keys if key not in found]
+        values = await self.async_redis_ops.get_values(missing) if missing else []
+        return self._merge(found, missing, values)
+
+    def set(self, key: str, result: Dict, judged_by: str = None, pipe=None) -> bool:
+        """
+        caches a test result, results that depend on the load of the system (or were truncated,
+        or have an output that isn't a literal, see encode_result) are skipped
+
+        Args:
+            judged_by (str, optional): judging_key of the result's verdict, the verdict is
+                judged again on hits without it
+            pipe (redis.client.Pipeline, optional): the redis write is queued on this pipeline
+                instead of being sent right away
+        """
+        if result.get("error") not in CACHEABLE_ERRORS or result.get("verdict") == SKIPPED:
+            return False
+        if result.get("output_truncated"):
+            # the whole output is needed to judge it again
+            return False
+        value = encode_result({**result, "judged_by": judged_by})
+        if value is None:
+            return False
+        self._remember(key, value)
+        if pipe is not None:
+            pipe.set(key, value, ex=self.ttl)
+            return True
+        return self.redis_ops.set_value(key, value, ex=self.ttl)
+
+
+result_cache = ResultCache()
+
+
+def _split(
+    test_cases: List[Dict], keys: List[str], found: Dict[str, Dict], comparator: str, tolerance: float
+) -> Tuple[List[Dict], List[Dict], List[str]]:
+    cached_results, misses, miss_keys = [], [], []
+    for test_case, key in zip(test_cases, keys):
+        if key in found:
+            result = {"id": test_case.get("id"), **found[key]}
+            # the worker's verdict is kept when it was judged the same way, otherwise
+            # the (lossless) output is judged again
+            if result.pop("judged_by", None) != judging_key(test_case, comparator, tolerance):
+                result["verdict"] = verdict(result, test_case, comparator, tolerance)
+            cached_results.append(result)
+        else:
+            misses.append(test_case)
+            miss_keys.append(key)
+    return cached_results, misses, miss_keys
+
+
+def lookup(
+    source_hash: str,
+    allowed_imports: List[str],
+    test_cases: List[Dict],
+    resource_limits: Tuple = (),
+    comparator: str = "exact",
+    tolerance: float = settings.COMPARATOR_TOLERANCE,
+) -> Tuple[List[Dict], List[Dict], List[str]]:
+    """
+    splits the test cases of a submission into cached results (judged with
+    comparator) and test cases to run
+
+    Returns:
+        (cached_results, misses, miss_keys): miss_keys are aligned with misses
+    """
+    keys = [cache_key(source_hash, allowed_imports, test_case, resource_limits) for test_case in test_cases]
+    return _split(test_cases, keys, result_cache.get_many(keys), comparator, tolerance)
+
+
+async def lookup_async(
+    source_hash: str,
+    allowed_imports: List[str],
+    test_cases: List[Dict],
+    resource_limits: Tuple = (),
+    comparator: str = "exact",
+    tolerance: float = settings.COMPARATOR_TOLERANCE,
+) -> Tuple[List[Dict], List[Dict], List[str]]:
+    """like lookup, for the async endpoints"""
+    keys = [cache_key(source_hash, allowed_imports, test_case, resource_limits) for test_case in test_cases]
+    return _split(test_cases, keys, await result_cache.get_many_async(keys), comparator, tolerance)
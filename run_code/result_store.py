@@ -0,0 +1,150 @@
+"""
+storage of the test results of an execution for /get-result.
+
+every result is written to a redis hash as soon as its test case is done, the
+fields are the positions of the results (in the order they finished, ids aren't
+required to be unique) and the values are msgpack, compressed with zlib when it's
+worth it. once the execution is done a small summary is stored under its id.
+"""
+import hashlib
+import json
+import zlib
+from typing import Dict, List, Optional
+import msgpack
+from .admission import user_key
+from .memory_store import MemoryStore, script_equivalent
+from .redis_operations import AsyncRedisOperations, async_redis_operations
+import settings
+
+
+# first byte of every stored value
+_MSGPACK = b"m"
+_ZLIB = b"z"
+
+# KEYS: summary, user's executions, done list
+# ARGV: execution id
+# returns the summary and frees the user's slot held by this execution,
+# the results are kept until they expire so they can be paged through
+READ_SUMMARY_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    redis.call('DEL', KEYS[3])
+end
+return value
+"""
+
+
+@script_equivalent(READ_SUMMARY_SCRIPT)
+def _read_summary(store: MemoryStore, keys: List[str], args: List):
+    value = store.get(keys[0])
+    if value is not None:
+        store.zrem(keys[1], args[0])
+        store.delete(keys[2])
+    return value
+
+
+def results_key(execution_id: str) -> str:
+    """name of the redis hash holding the results of an execution"""
+    return f"results:{execution_id}"
+
+
+def jsonable(value):
+    """the `default` of json.dumps and msgpack for outputs they can't represent"""
+    if isinstance(value, (set, frozenset)):
+        try:
+            return sorted(value)
+        except TypeError:
+            return list(value)
+    return repr(value)
+
+
+def _pack(value) -> bytes:
+    try:
+        return msgpack.packb(value, default=jsonable)
+    except (OverflowError, TypeError, ValueError):
+        # eg. integers wider than 64 bits
+        return msgpack.packb(repr(value))
+
+
+def encode_result(result: Dict) -> bytes:
+    try:
+        data = msgpack.packb(result, default=jsonable)
+    except (OverflowError, TypeError, ValueError):
+        data = msgpack.packb({**result, "output": repr(result.get("output"))}, default=jsonable)
+    if settings.RESULT_COMPRESSION == "zlib" and len(data) >= settings.RESULT_COMPRESS_MIN_BYTES:
+        return _ZLIB + zlib.compress(data)
+    return _MSGPACK + data
+
+
+def decode_result(data: bytes) -> Dict:
+    payload = zlib.decompress(data[1:]) if data[:1] == _ZLIB else data[1:]
+    # outputs may be dicts with non string keys
+    return msgpack.unpackb(payload, strict_map_key=False)
+
+
+def compact(result: Dict) -> Dict:
+    """
+    truncates an output larger than settings.RESULT_MAX_OUTPUT_BYTES once encoded, it's
+    replaced by the beginning of its repr and 'output_size' (bytes) and 'output_sha256' are recorded
+    (the verdict was given with the whole output).
+    """
+    if result.get("output") is None:
+        return result
+    encoded = _pack(result["output"])
+    if len(encoded) <= settings.RESULT_MAX_OUTPUT_BYTES:
+        return result
+    return {
+        **result,
+        "output": repr(result["output"])[:settings.RESULT_MAX_OUTPUT_BYTES],
+        "output_truncated": True,
+        "output_size": len(encoded),
+        "output_sha256": hashlib.sha256(encoded).hexdigest(),
+    }
+
+
+def queue_result(pipe, execution_id: str, position: int, result: Dict):
+    """queues the write of a single result on a redis pipeline"""
+    pipe.hset(results_key(execution_id), str(position), encode_result(result))
+    pipe.expire(results_key(execution_id), settings.RESULT_TTL_SEC)
+
+
+def queue_summary(pipe, execution_id: str, summary: Dict):
+    """queues the write of the summary, once every result is stored"""
+    pipe.set(execution_id, json.dumps(summary), ex=settings.RESULT_TTL_SEC)
+    pipe.expire(results_key(execution_id), settings.RESULT_TTL_SEC)
+
+
+async def read_summary_async(
+    execution_id: str, userid: str, done_list: str, redis_ops: AsyncRedisOperations = async_redis_operations
+) -> Optional[Dict]:
+    """
+    reading the summary also allows the user to submit future processes,
+    in a single round trip.
+
+    Returns:
+        Dict: None if the execution isn't done (or doesn't exist)
+    """
+    value = await redis_ops.run_script(
+        READ_SUMMARY_SCRIPT, [execution_id, user_key(userid), done_list], [execution_id]
+    )
+    return json.loads(value) if value else None
+
+
+async def count_results_async(
+    execution_id: str, redis_ops: AsyncRedisOperations = async_redis_operations
+) -> int:
+    """results stored so far, also those of an execution that didn't finish"""
+    return await redis_ops.get_hash_length(results_key(execution_id)) or 0
+
+
+async def get_page_async(
+    execution_id: str, offset: int, limit: int, redis_ops: AsyncRedisOperations = async_redis_operations
+) -> List[Dict]:
+    """the results from position offset to offset + limit, missing ones are left out"""
+    if limit <= 0:
+        return []
+    values = await redis_ops.get_hash_fields(
+        results_key(execution_id), [str(position) for position in range(offset, offset + limit)]
+    )
+    return [decode_result(value) for value in values if value is not None]
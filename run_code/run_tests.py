@@ -1,41 +1,290 @@
-import multiprocessing
 import json
-import dill
-from typing import List, Dict
-from . import redis_operations
+import signal
+import time
+from contextlib import nullcontext
+from typing import Iterator, List, Dict, Optional, Tuple
+from .redis_operations import redis_operations
+from .code_cache import load_function
+from .deadlines import DeadlineScheduler
+from .result_cache import judging_key, result_cache
+from .test_suites import get_suite
+from .test_case_files import TestCaseFile, get_test_case_ids, load_test_case
+from . import admission, comparators, limits, metrics, profiling, result_store
+from .worker_pool import WorkerPool, WORKER_TIMEOUT, WORKER_CRASHED, SUBMISSION_TIMEOUT
 import settings
 from pydantic_models import TestCase
 
-redis_client = redis_operations.RedisOperations()
+def events_stream_name(execution_id: str) -> str:
+    """name of the redis stream the results of an execution are published to"""
+    return f"events:{execution_id}"
 
 
-def _execute_function(
-    b_func: bytes, test_case: Dict, result_queue: multiprocessing.Queue
-):
+def done_list_name(execution_id: str) -> str:
+    """name of the redis list notified once the result of an execution is stored"""
+    return f"done:{execution_id}"
+
+
+def _queue_event(pipe, execution_id: str, event: str, data: Dict):
+    """queues an event of the execution's stream on a redis pipeline"""
+    stream_name = events_stream_name(execution_id)
+    pipe.xadd(stream_name, {"event": event, "data": json.dumps(data, default=result_store.jsonable)})
+    pipe.expire(stream_name, settings.REDIS_EXPIRE_SEC)
+
+
+def _publish_result(execution_id: str, position: int, result: Dict, cache_key: str = None, judged_by: str = None):
     """
-    executes the function and stores the output in result_queue
+    publishes a test result for /stream-result, stores it for /get-result and caches it,
+    in a single round trip (so the results of an execution that dies halfway are kept).
 
     Args:
-        b_func (bytes): the pickled version of the function going to get deserialized and executed.
-        args (Tuple): arguments for func
-        result_queue (multiprocessing.Queue): a global queue used to store the output of the func.
+        position (int): number of results of the execution published before this one
+        judged_by (str, optional): see result_cache.judging_key
     """
-    func = dill.loads(b_func)
+    def build(pipe):
+        _queue_event(pipe, execution_id, "result", result)
+        result_store.queue_result(pipe, execution_id, position, result)
+        if cache_key is not None:
+            result_cache.set(cache_key, result, judged_by=judged_by, pipe=pipe)
 
-    test_result = {
-        "id": test_case.get("id"),
-        "output": None,
-        "error": None,
-        "error_message": None,
+    with metrics.timed("redis_write"):
+        redis_operations.execute_pipeline(build, transaction=False)
+
+
+def _summarize(execution_id: str, outcomes: List[Dict]) -> Dict:
+    """
+    Args:
+        outcomes (List[Dict]): the 'error' and 'verdict' of every result, in order
+    """
+    return {
+        "execution_id": execution_id,
+        "total": len(outcomes),
+        "errors": sum(1 for outcome in outcomes if outcome["error"]),
+        "accepted": sum(1 for outcome in outcomes if outcome["verdict"] == comparators.ACCEPTED),
+        "verdict": comparators.overall_verdict(outcomes),
+        "complete": True,
     }
+
+
+def _store_final_result(execution_id: str, userid: str, summary: Dict) -> bool:
+    """
+    stores the summary of the execution (its results are already stored), sends the summary
+    event, marks the user as having a result to collect and wakes up the long-polling
+    /get-result requests, all in a single transaction.
+
+    Returns:
+        bool: False if the transaction failed
+    """
+    def build(pipe):
+        _queue_event(pipe, execution_id, "summary", summary)
+        result_store.queue_summary(pipe, execution_id, summary)
+        admission.hold_user_slot(pipe, userid, execution_id)
+        pipe.rpush(done_list_name(execution_id), "1")
+        pipe.expire(done_list_name(execution_id), settings.REDIS_EXPIRE_SEC)
+
+    with metrics.timed("redis_write"):
+        return redis_operations.execute_pipeline(build) is not None
+
+# long-lived sandbox workers shared by every submission, started at app startup
+pool = WorkerPool()
+
+
+def source_owner(job: Tuple) -> str:
+    """the owner of a pool job (see WorkerPool.acquire), the source hash that follows its source code"""
+    return job[1]
+
+
+class _TestCaseTimeout(BaseException):
+    """raised inside a worker when a test case runs out of time
+    (a BaseException so the solution can't swallow it with `except Exception`)"""
+
+
+def _raise_test_case_timeout(signum, frame):
+    raise _TestCaseTimeout()
+
+
+def fails_on_cached_results(fail_fast: bool, cached_results: Optional[List[Dict]]) -> bool:
+    """whether a cached result already failed a fail_fast execution, nothing needs to run then"""
+    return fail_fast and any(comparators.is_failure(result) for result in cached_results or [])
+
+
+def _test_result(_id, output=None, error: str = None, error_message: str = None, usage: Dict = None) -> Dict:
+    # the resource usage is only known for test cases that ran
+    usage = usage or {}
+    return {
+        "id": _id,
+        "output": output,
+        "error": error,
+        "error_message": error_message,
+        # set by comparators.verdict once the output is known
+        "verdict": error,
+        "wall_time_ms": usage.get("wall_time_ms"),
+        "cpu_time_ms": usage.get("cpu_time_ms"),
+        "peak_rss_kb": usage.get("peak_rss_kb"),
+    }
+
+
+def _skipped_results(ids: List) -> List[Dict]:
+    """results of the test cases (by id) a fail_fast execution didn't run"""
+    results = []
+    for _id in ids:
+        result = _test_result(_id)
+        result["verdict"] = comparators.SKIPPED
+        results.append(result)
+    return results
+
+
+def _run_test_case(
+    func,
+    test_case: Dict,
+    cpu_limit: float = None,
+    memory_limit: int = None,
+    comparator: str = "exact",
+    tolerance: float = 0,
+    profiler: Optional[profiling.Profiler] = None,
+) -> Dict:
+    _id = test_case.get("id")
+    usage = {}
     try:
-        output = func(*test_case.get("input"))
-        test_result["output"] = output
+        with metrics.timed("test"), limits.measure(usage), limits.enforce(cpu_limit, memory_limit), \
+                profiler or nullcontext():
+            output = func(*test_case.get("input"))
+        test_result = _test_result(_id, output, usage=usage)
+    except limits.CpuLimitExceeded:
+        test_result = _test_result(
+            _id, error=limits.TIME_LIMIT_EXCEEDED,
+            error_message=f"Test case {_id} exceeded its CPU time limit of {cpu_limit} seconds.",
+            usage=usage,
+        )
+    except MemoryError as e:
+        if memory_limit:
+            test_result = _test_result(
+                _id, error=limits.MEMORY_LIMIT_EXCEEDED,
+                error_message=f"Test case {_id} exceeded its memory limit of {memory_limit} MB.",
+                usage=usage,
+            )
+        else:
+            test_result = _test_result(_id, error="ExecutionError", error_message=str(e), usage=usage)
     except Exception as e:
-        test_result["error"] = "ExecutionError"
-        test_result["error_message"] = str(e)
-    result_queue.put(test_result)
-    print(f"TESTCASE [{test_case.get("id")}] DONE.")
+        test_result = _test_result(_id, error="ExecutionError", error_message=str(e), usage=usage)
+    test_result["verdict"] = comparators.verdict(test_result, test_case, comparator, tolerance)
+    _add_profile(test_result, profiler)
+    print(f"TESTCASE [{test_result['id']}] DONE.")
+    return test_result
+
+
+def _add_profile(test_result: Dict, profiler: Optional[profiling.Profiler]):
+    # the profile of a test case that timed out covers what it did until then
+    report = profiler.report() if profiler is not None else None
+    if report is not None:
+        test_result["profile"] = report
+
+
+def _load_error_results(test_cases: List[Dict], error: str, error_message: str) -> List[Dict]:
+    """results of test cases that couldn't run because the module failed to load"""
+    return [_test_result(test_case.get("id"), error=error, error_message=error_message) for test_case in test_cases]
+
+
+def _execute_function(
+    source_code: str,
+    source_hash: str,
+    test_case: Dict,
+    cpu_limit: float = None,
+    memory_limit: int = None,
+    comparator: str = "exact",
+    tolerance: float = 0,
+    profile: Optional[Dict] = None,
+) -> Dict:
+    """
+    loads the solution and executes it inside a pool worker
+
+    Args:
+        source_code (str): the submitted python file, compiled inside the worker.
+        source_hash (str): SHA-256 of source_code, used as the key of the worker's code cache.
+        test_case (Dict): the test case, its 'input' is used as the arguments of the function
+            (or a TestCaseFile holding it, read inside the worker).
+        cpu_limit (float, optional): seconds of CPU time the test case may use.
+        memory_limit (int, optional): megabytes the test case may allocate.
+        comparator (str): name of the comparator the output is judged with, see comparators.
+        tolerance (float): tolerance of the 'float' comparator.
+        profile (Dict, optional): {'tools'} to profile solve with, see profiling.Profiler.
+
+    Returns:
+        Dict: the result of the test case.
+    """
+    test_case = load_test_case(test_case)
+    try:
+        with metrics.timed("load_solution"):
+            func = load_function(source_code, source_hash, "solve")
+    except Exception as e:
+        return _load_error_results([test_case], "ExecutionError", str(e))[0]
+    profiler = profiling.Profiler(profile["tools"]) if profile else None
+    return _run_test_case(func, test_case, cpu_limit, memory_limit, comparator, tolerance, profiler)
+
+
+def _execute_suite(
+    source_code: str,
+    source_hash: str,
+    test_cases: List[Dict],
+    timeout: float,
+    cpu_limit: float = None,
+    memory_limit: int = None,
+    comparator: str = "exact",
+    tolerance: float = 0,
+    fail_fast: bool = False,
+    profile: Optional[Dict] = None,
+) -> Iterator[Dict]:
+    """
+    executes every test case in sequence inside a single pool worker,
+    the solution is loaded only once.
+
+    Args:
+        source_code (str): the submitted python file, compiled inside the worker.
+        source_hash (str): SHA-256 of source_code, used as the key of the worker's code cache.
+        test_cases (List[Dict]): test cases to run, in order (a TestCaseFile is read one at a time).
+        timeout (float): seconds each test case is allowed to take, enforced with an interval timer.
+        cpu_limit (float, optional): seconds of CPU time each test case may use.
+        memory_limit (int, optional): megabytes each test case may allocate.
+        comparator (str): name of the comparator the outputs are judged with, see comparators.
+        tolerance (float): tolerance of the 'float' comparator.
+        fail_fast (bool): stop after the first test case that fails.
+        profile (Dict, optional): {'tools', 'positions'}, solve is profiled on the test cases
+            at these positions of test_cases, see profiling.Profiler.
+
+    Yields:
+        Dict: the result of each test case as soon as it's done.
+    """
+    signal.signal(signal.SIGALRM, _raise_test_case_timeout)
+    try:
+        # the module's top-level code gets the same time limit as a test case
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        with metrics.timed("load_solution"):
+            func = load_function(source_code, source_hash, "solve")
+    except _TestCaseTimeout:
+        yield from _load_error_results(
+            test_cases, WORKER_TIMEOUT, "The top-level code of the module exceeded the time limit."
+        )
+        return
+    except Exception as e:
+        yield from _load_error_results(test_cases, "ExecutionError", str(e))
+        return
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+    for position, test_case in enumerate(test_cases):
+        profiler = None
+        if profile and position in profile["positions"]:
+            profiler = profiling.Profiler(profile["tools"])
+        try:
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+            test_result = _run_test_case(func, test_case, cpu_limit, memory_limit, comparator, tolerance, profiler)
+        except _TestCaseTimeout:
+            test_result = _worker_error_result(test_case.get("id"), WORKER_TIMEOUT)
+            _add_profile(test_result, profiler)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        yield test_result
+        if fail_fast and comparators.is_failure(test_result):
+            return
 
 
 def _timeout_error_message(_id):
@@ -45,53 +294,251 @@ Please check if the function is taking too long to execute or
 if there are any infinite loops in the test case."""
 
 
-def run_tests(function, test_cases: List[Dict], execution_id: str, userid: str):
-    """runs a list of testcases on a function in parallel
+def _worker_error_result(_id, error: str, detail: str = None) -> Dict:
+    """builds the result of a test case whose worker didn't return one"""
+    if error == WORKER_TIMEOUT:
+        error_message = _timeout_error_message(_id)
+    elif error == SUBMISSION_TIMEOUT:
+        error_message = (
+            f"Test case {_id} was stopped because the submission exceeded its overall "
+            f"time limit of {settings.RUN_TESTS_SUBMISSION_TIMEOUT} seconds."
+        )
+    elif error == WORKER_CRASHED:
+        error_message = f"The process running test case {_id} crashed."
+    else:
+        error_message = f"The output of test case {_id} could not be serialized: {detail}"
+    return _test_result(_id, error=error, error_message=error_message)
+
+
+def _run_parallel(
+    source_code: str,
+    source_hash: str,
+    test_cases: List[Dict],
+    scheduler: DeadlineScheduler,
+    cpu_limit: float = None,
+    memory_limit: int = None,
+    comparator: str = "exact",
+    tolerance: float = 0,
+    fail_fast: bool = False,
+    profile: Optional[Dict] = None,
+) -> Iterator[Dict]:
+    """
+    runs every test case in its own pool job, in parallel
+    (a profiled test case that times out has no profile, its worker is killed)
+    """
+    ids = get_test_case_ids(test_cases)
+    profiled = set(profiling.selected_positions(profile, ids))
+    # the jobs of an uploaded file only carry their line, workers parse it
+    cases = test_cases.split() if isinstance(test_cases, TestCaseFile) else test_cases
+    jobs = [
+        (source_code, source_hash, testcase, cpu_limit, memory_limit, comparator, tolerance,
+         {"tools": profile["tools"]} if position in profiled else None)
+        for position, testcase in enumerate(cases)
+    ]
+    positions = {id(job): index for index, job in enumerate(jobs)}
+    finished = set()
+    results = pool.run(
+        _execute_function, jobs, timeout=settings.RUN_TESTS_TIMEOUT, scheduler=scheduler, owner=source_owner
+    )
+    for job, result, error in results:
+        index = positions[id(job)]
+        if error is not None:
+            result = _worker_error_result(ids[index], error, result)
+        finished.add(index)
+        yield result
+        if fail_fast and comparators.is_failure(result):
+            # kills the workers still running a test case, the pending ones are never sent
+            results.close()
+            yield from _skipped_results([_id for index, _id in enumerate(ids) if index not in finished])
+            return
+
+
+def _run_suite(
+    source_code: str,
+    source_hash: str,
+    test_cases: List[Dict],
+    scheduler: DeadlineScheduler,
+    cpu_limit: float = None,
+    memory_limit: int = None,
+    comparator: str = "exact",
+    tolerance: float = 0,
+    fail_fast: bool = False,
+    profile: Optional[Dict] = None,
+) -> Iterator[Dict]:
+    """
+    runs the whole suite in a single pool job, if the worker gets stuck
+    (eg. inside C code the interval timer can't interrupt) it is killed and
+    only the remaining test cases are dispatched to a fresh worker.
+    with fail_fast the worker stops after the first failure and the rest is skipped.
+    """
+    ids = get_test_case_ids(test_cases)
+    profiled = profiling.selected_positions(profile, ids)
+    # index of the first test case without a result
+    start = 0
+    while start < len(ids):
+        failed = False
+        # the positions are relative to the test cases the worker receives
+        suite_profile = {
+            "tools": profile["tools"], "positions": [position - start for position in profiled if position >= start],
+        } if profiled else None
+        for result, error in pool.stream(
+            _execute_suite,
+            (
+                source_code, source_hash, test_cases[start:], settings.RUN_TESTS_TIMEOUT,
+                cpu_limit, memory_limit, comparator, tolerance, fail_fast, suite_profile,
+            ),
+            timeout=settings.RUN_TESTS_TIMEOUT + settings.RUN_TESTS_GRACE_SEC,
+            scheduler=scheduler,
+            owner=source_hash,
+        ):
+            if error == SUBMISSION_TIMEOUT:
+                # out of budget, nothing left is going to run
+                for _id in ids[start:]:
+                    yield _worker_error_result(_id, error)
+                return
+            if error is not None:
+                result = _worker_error_result(ids[start], error, result)
+            start += 1
+            yield result
+            failed = failed or comparators.is_failure(result)
+        if fail_fast and failed:
+            yield from _skipped_results(ids[start:])
+            return
+
+
+def run_tests(
+    source_code: str,
+    source_hash: str,
+    test_cases: Optional[List[Dict]],
+    execution_id: str,
+    userid: str,
+    cached_results: List[Dict] = None,
+    cache_keys: List[str] = None,
+    test_suite_id: str = None,
+    test_case_ids: List = None,
+    cpu_limit: float = None,
+    memory_limit: int = None,
+    comparator: str = "exact",
+    tolerance: float = settings.COMPARATOR_TOLERANCE,
+    fail_fast: bool = False,
+    priority: str = settings.ADMISSION_DEFAULT_PRIORITY,
+    profile: Optional[Dict] = None,
+    admitted: bool = False,
+):
+    """runs a list of testcases on the solution's 'solve' function using the worker pool
 
     Args:
-        function (_type_): function to be executed
+        source_code (str): the validated python file, it's compiled and loaded inside the workers
+        source_hash (str): SHA-256 of source_code
         test_cases (List[Dict]): list of testcases to be executed over the function
-            example of a single testcase: {'id': 1, 'input': (1, 2), 'expected': 3}
+            example of a single testcase: {'id': 1, 'input': (1, 2), 'expected': 3},
+            or an uploaded TestCaseFile, it's closed once the execution is done
         execution_id (str): a unique id for the execution
         userid (str): unique user id (it is used for prevent overlapping process
-        like a rate limiter so they cant submit another process if they already 
-        have one processing and it can be their 
+        like a rate limiter so they cant submit more processes than allowed, and to
+        share the running slots fairly between the users, it can be their
         session id, authentication token, or their userid(from database))
+        cached_results (List[Dict], optional): results of the submission's other test cases
+            that were found in the result cache
+        cache_keys (List[str], optional): result cache keys aligned with test_cases,
+            the results are cached when given
+        test_suite_id (str, optional): id of a registered test suite, replaces test_cases
+        test_case_ids (List, optional): only these test cases of the suite are executed
+        cpu_limit (float, optional): seconds of CPU time each test case may use
+        memory_limit (int, optional): megabytes each test case may allocate
+        comparator (str): name of the comparator the outputs are judged with, see comparators
+        tolerance (float): tolerance of the 'float' comparator
+        fail_fast (bool): skip the remaining test cases once one fails
+        priority (str): scheduling class of the execution, see admission.wait_for_turn
+        profile (Dict, optional): {'tools', 'test_case_ids'}, the selected test cases
+            get a 'profile' report, see profiling
+        admitted (bool): the execution already holds a running slot (eg. it waited for it
+            with admission.wait_for_turn_async), it doesn't wait for one
     """
+    metrics.EXECUTIONS_RUNNING.inc()
+    stored = False
+    try:
+        with metrics.track_stages(execution_id):
+            stored = _run_tests(
+                source_code, source_hash, test_cases, execution_id, userid,
+                cached_results, cache_keys, test_suite_id, test_case_ids, cpu_limit, memory_limit,
+                comparator, tolerance, fail_fast, priority, profile, admitted,
+            )
+    finally:
+        # the user's slot is kept until the stored result is collected
+        admission.release(userid, execution_id, free_user=not stored)
+        metrics.EXECUTIONS_RUNNING.dec()
+        if isinstance(test_cases, TestCaseFile):
+            test_cases.close()
+
+
+def _run_tests(
+    source_code: str,
+    source_hash: str,
+    test_cases: Optional[List[Dict]],
+    execution_id: str,
+    userid: str,
+    cached_results: Optional[List[Dict]],
+    cache_keys: Optional[List[str]],
+    test_suite_id: Optional[str],
+    test_case_ids: Optional[List],
+    cpu_limit: Optional[float],
+    memory_limit: Optional[int],
+    comparator: str,
+    tolerance: float,
+    fail_fast: bool,
+    priority: str,
+    profile: Optional[Dict],
+    admitted: bool,
+) -> bool:
+    """the body of run_tests, returns whether the final result was stored"""
+    if test_suite_id is not None:
+        with metrics.timed("suite_load"):
+            test_cases = get_suite(test_suite_id)
+        if test_cases is None:
+            print(f"test suite {test_suite_id} not found.")
+            test_cases = []
+        if test_case_ids is not None:
+            wanted = set(test_case_ids)
+            test_cases = [testcase for testcase in test_cases if testcase.get("id") in wanted]
     print("test_cases: List[Dict] = ", test_cases)
-    final_result = {"execution_id": execution_id, "test_result": None}
-    result_queue = multiprocessing.Queue()
-
-    # creating processes
-    processes: Dict[multiprocessing.Process] = {}
-    for testcase in test_cases:
-        process = multiprocessing.Process(
-            target=_execute_function,
-            args=(dill.dumps(function), testcase, result_queue),
+    # only what the summary needs is kept, the results are stored one at a time
+    outcomes = []
+
+    # every result is published as soon as it's done for /stream-result and /get-result
+    for result in cached_results or []:
+        _publish_result(execution_id, len(outcomes), result)
+        outcomes.append({"error": result["error"], "verdict": result.get("verdict")})
+        metrics.CACHED_RESULTS.inc()
+
+    if test_cases and fails_on_cached_results(fail_fast, cached_results):
+        results = _skipped_results(get_test_case_ids(test_cases))
+    elif test_cases:
+        if not admitted:
+            with metrics.timed("admission_wait"):
+                admission.wait_for_turn(execution_id, userid, priority, len(test_cases))
+        scheduler = DeadlineScheduler(
+            time.monotonic() + settings.RUN_TESTS_SUBMISSION_TIMEOUT
+            if settings.RUN_TESTS_SUBMISSION_TIMEOUT else None
         )
-        process.start()
-        processes[process] = testcase.get("id")
-
-    # wait for processes
-    for process in processes:
-        process.join(timeout=settings.RUN_TESTS_TIMEOUT)
-        if process.is_alive():
-            process.terminate()
-            process_result = {
-                "id": processes[process],
-                "output": None,
-                "error": "TimeoutError",
-                "error_message": _timeout_error_message(processes.get(process)),
-            }
-            result_queue.put(process_result)
-
-    final_result["test_result"] = [
-        result_queue.get() for _ in range(result_queue.qsize())
-    ]
-    print(f"final_result: {final_result}")
-    redis_client.set_value(
-        key=execution_id, value=json.dumps(final_result), ex=settings.REDIS_EXPIRE_SEC
-    )
+        run = _run_suite if settings.RUN_TESTS_MODE == "suite" else _run_parallel
+        results = run(
+            source_code, source_hash, test_cases, scheduler,
+            cpu_limit, memory_limit, comparator, tolerance, fail_fast, profile,
+        )
+    else:
+        results = []
+    keys = {}
+    if cache_keys:
+        for _id, test_case, key in zip(get_test_case_ids(test_cases), test_cases, cache_keys):
+            keys[_id] = (key, judging_key(test_case, comparator, tolerance))
+    for result in results:
+        result = result_store.compact(result)
+        _publish_result(execution_id, len(outcomes), result, *keys.get(result["id"], ()))
+        outcomes.append({"error": result["error"], "verdict": result["verdict"]})
+        metrics.TEST_RESULTS.inc(verdict=result["verdict"] or "none")
+    summary = _summarize(execution_id, outcomes)
 
+    print(f"final_result: {summary}")
     print("received ip addr: {}".format(userid))
-    redis_client.set_value(key=str(userid), value=str(execution_id), ex=settings.REDIS_EXPIRE_SEC)
+    return _store_final_result(execution_id, userid, summary)
@@ -0,0 +1,111 @@
+"""
+test cases uploaded as a JSONL file, one JSON object per line.
+
+the upload is copied to a temporary file line by line and only the offset and
+id of every test case are kept, the executors parse the test cases one at a time
+when they iterate over them, so the peak memory is bounded by the largest one.
+"""
+import json
+import os
+import tempfile
+from typing import BinaryIO, Dict, Iterator, List, Union
+
+
+class TestCaseFile:
+    """
+    a lazy sequence of the test cases of a JSONL file, it's picklable
+    (only the path, offsets and ids are sent) so workers read the file themselves.
+    """
+
+    def __init__(self, path: str, offsets: List[int], ids: List):
+        self.path = path
+        self.offsets = offsets
+        self.ids = ids
+        # set once an executor took over closing the file, see hand_over
+        self.handed_over = False
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __iter__(self) -> Iterator[Dict]:
+        with open(self.path, "rb") as file:
+            for offset in self.offsets:
+                file.seek(offset)
+                yield json.loads(file.readline())
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Dict, "TestCaseFile"]:
+        if isinstance(index, slice):
+            return TestCaseFile(self.path, self.offsets[index], self.ids[index])
+        with open(self.path, "rb") as file:
+            file.seek(self.offsets[index])
+            return json.loads(file.readline())
+
+    def __repr__(self) -> str:
+        return f"TestCaseFile({self.path!r}, {len(self)} test cases)"
+
+    def split(self) -> List["TestCaseFile"]:
+        """a single test case file per test case, for the jobs of the parallel mode"""
+        return [self[index:index + 1] for index in range(len(self))]
+
+    def hand_over(self) -> "TestCaseFile":
+        """marks the file as closed by the executor it's given to instead of the request that uploaded it"""
+        self.handed_over = True
+        return self
+
+    def close(self):
+        """removes the file, every slice of it becomes unreadable"""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _check(test_case, number: int):
+    if not isinstance(test_case, dict):
+        raise ValueError(f"line {number}: a test case must be a JSON object")
+    if not isinstance(test_case.get("input"), list):
+        raise ValueError(f"line {number}: 'input' must be the list of arguments of the function")
+
+
+def write_test_case_file(upload: BinaryIO) -> TestCaseFile:
+    """
+    copies an uploaded JSONL file of test cases ({"id": 1, "input": [1, 2], "expected": 3}
+    per line, blank lines are skipped), every line is parsed once to be checked.
+
+    Raises:
+        ValueError: if a line isn't a valid test case, nothing is left on disk then
+
+    Returns:
+        TestCaseFile: its owner must close it
+    """
+    offsets, ids = [], []
+    with tempfile.NamedTemporaryFile("wb", prefix="test_cases_", suffix=".jsonl", delete=False) as file:
+        try:
+            for number, line in enumerate(upload, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    test_case = json.loads(line)
+                except ValueError as e:
+                    raise ValueError(f"line {number}: {e}")
+                _check(test_case, number)
+                offsets.append(file.tell())
+                ids.append(test_case.get("id"))
+                file.write(line if line.endswith(b"\n") else line + b"\n")
+        except BaseException:
+            file.close()
+            os.unlink(file.name)
+            raise
+    return TestCaseFile(file.name, offsets, ids)
+
+
+def load_test_case(test_case: Union[Dict, TestCaseFile]) -> Dict:
+    """the test case of a job, parallel jobs of an uploaded file carry a single test case file"""
+    return test_case[0] if isinstance(test_case, TestCaseFile) else test_case
+
+
+def get_test_case_ids(test_cases: Union[List[Dict], TestCaseFile]) -> List:
+    """ids of the test cases, without parsing an uploaded file again"""
+    if isinstance(test_cases, TestCaseFile):
+        return list(test_cases.ids)
+    return [test_case.get("id") for test_case in test_cases]
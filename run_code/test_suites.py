@@ -0,0 +1,135 @@
+import hashlib
+import marshal
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from .redis_operations import (
+    AsyncRedisOperations,
+    RedisOperations,
+    async_redis_operations,
+    redis_operations,
+)
+import settings
+
+
+# marshal handles every python literal (tuples, sets, bytes...) and decodes much faster
+# than ast.literal_eval, the version is pinned so every node reads the same format
+MARSHAL_VERSION = 4
+
+
+def suite_key(suite_id: str) -> str:
+    return f"test_suite:{suite_id}"
+
+
+def encode_suite(test_cases: List[Dict]) -> bytes:
+    return zlib.compress(marshal.dumps(test_cases, MARSHAL_VERSION))
+
+
+def decode_suite(data: bytes) -> List[Dict]:
+    return marshal.loads(zlib.decompress(data))
+
+
+class SuiteCache:
+    """an LRU cache of decoded test suites bounded by the size of their encoding"""
+
+    def __init__(self, max_bytes: int = settings.TEST_SUITE_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._suites: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, suite_id: str) -> Optional[List[Dict]]:
+        with self._lock:
+            entry = self._suites.get(suite_id)
+            if entry is None:
+                return None
+            self._suites.move_to_end(suite_id)
+            return entry[0]
+
+    def put(self, suite_id: str, test_cases: List[Dict], size: int):
+        """
+        Args:
+            size (int): weight of the suite, the length of its uncompressed encoding
+        """
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if suite_id in self._suites:
+                return
+            self._suites[suite_id] = (test_cases, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._suites.popitem(last=False)
+                self.size -= evicted_size
+
+
+suite_cache = SuiteCache()
+
+
+def _prepare(test_cases: List[Dict]) -> Tuple[str, bytes]:
+    data = encode_suite(test_cases)
+    return hashlib.sha256(data).hexdigest(), data
+
+
+def _remember(suite_id: str, test_cases: List[Dict]):
+    suite_cache.put(suite_id, test_cases, len(marshal.dumps(test_cases, MARSHAL_VERSION)))
+
+
+def register_suite(test_cases: List[Dict], redis_ops: RedisOperations = redis_operations) -> Optional[str]:
+    """
+    stores a parsed test suite, suites are content addressed so registering
+    the same suite twice returns the same id.
+
+    Returns:
+        str: the suite id, None if it couldn't be stored
+    """
+    suite_id, data = _prepare(test_cases)
+    if not redis_ops.set_value(suite_key(suite_id), data, ex=settings.TEST_SUITE_TTL_SEC or None):
+        return None
+    _remember(suite_id, test_cases)
+    return suite_id
+
+
+async def register_suite_async(
+    test_cases: List[Dict], redis_ops: AsyncRedisOperations = async_redis_operations
+) -> Optional[str]:
+    """like register_suite, for the async endpoints"""
+    suite_id, data = _prepare(test_cases)
+    if not await redis_ops.set_value(suite_key(suite_id), data, ex=settings.TEST_SUITE_TTL_SEC or None):
+        return None
+    _remember(suite_id, test_cases)
+    return suite_id
+
+
+def _decode_and_remember(suite_id: str, data: Optional[bytes]) -> Optional[List[Dict]]:
+    if data is None:
+        return None
+    raw = zlib.decompress(data)
+    test_cases = marshal.loads(raw)
+    suite_cache.put(suite_id, test_cases, len(raw))
+    return test_cases
+
+
+def get_suite(suite_id: str, redis_ops: RedisOperations = redis_operations) -> Optional[List[Dict]]:
+    """
+    returns the decoded test suite, it's only fetched and decoded on a cache miss.
+    callers must not modify the returned test cases, they are shared.
+
+    Returns:
+        List[Dict]: None if the suite doesn't exist
+    """
+    test_cases = suite_cache.get(suite_id)
+    if test_cases is not None:
+        return test_cases
+    return _decode_and_remember(suite_id, redis_ops.get_raw_value(suite_key(suite_id)))
+
+
+async def get_suite_async(
+    suite_id: str, redis_ops: AsyncRedisOperations = async_redis_operations
+) -> Optional[List[Dict]]:
+    """like get_suite, for the async endpoints"""
+    test_cases = suite_cache.get(suite_id)
+    if test_cases is not None:
+        return test_cases
+    return _decode_and_remember(suite_id, await redis_ops.get_raw_value(suite_key(suite_id)))
@@ -1,12 +1,10 @@
 import ast
+import hashlib
 
 # import re
 from typing import List
 from fastapi import HTTPException, UploadFile
-
-
-def func_error(func_name: str, line_number: int):
-    return f"VALIDATION ERROR line {line_number}: use of function '{func_name}' is not allowed."
+from .validation import ValidationResult, get_policy, validate_source
 
 
 class PythonFile:
@@ -14,11 +12,27 @@ class PythonFile:
         self.file = upload_file.file
         self.allowed_imports = allowed_imports
         self.source_code = self.get_source_code()
+        self.source_hash = hash_source_code(self.source_code)
         print(self.source_code)
 
     def get_source_code(self):
         return self.file.read().decode("utf-8")
 
+    def _validation(self) -> ValidationResult:
+        # verdicts are cached, so the file is only walked once
+        return validate_source(self.source_code, get_policy(self.allowed_imports), self.source_hash)
+
+    def defines_function(self, func_name: str) -> bool:
+        """checks whether a name is bound at the top level of the file, without executing it
+
+        Args:
+            func_name (str): function name to look for
+
+        Returns:
+            bool
+        """
+        return func_name in self._validation().defined_names
+
     def validate(self):
         """
         Validate the python file.
@@ -29,50 +43,25 @@ class PythonFile:
         3. any invalid functions
 
         Returns:
-            tuple: (bool, str) where bool is True if the file is valid, False otherwise.
-                str is an error message if the file is invalid, None otherwise
+            tuple: (bool, list) where bool is True if the file is valid, False otherwise.
+                list holds every violation found ({'line', 'col', 'message'}), None if the file is valid
         """
-        # check for any syntax errors
-        try:
-            tree = ast.parse(source=self.source_code)
-        except (SyntaxError, Exception) as e:
-            return False, f"VALIDATION ERROR: {str(e)}"
-
-        invalid_functions = set({"compile", "eval", "exec"})
-        for node in ast.walk(tree):
-            # check for invalid imports
-            if isinstance(node, ast.Import):
-                for alias in node.names:
-                    if not alias.name in self.allowed_imports:
-                        return (
-                            False,
-                            f"VALIDATION ERROR: Import '{alias.name}' is not allowed.",
-                        )
-            elif isinstance(node, ast.ImportFrom):
-                if node.module not in self.allowed_imports:
-                    return (
-                        False,
-                        f"VALIDATION ERROR: Import '{node.module}' is not allowed.",
-                    )
-
-            # check for invalid functions
-            elif (
-                isinstance(node, ast.Name) and node.id in invalid_functions
-            ):  # 'compile'
-                return False, func_error(node.id, node.lineno)
-            elif isinstance(node, ast.Call):
-                if (
-                    isinstance(node.func, ast.Name)
-                    and node.func.id in invalid_functions
-                ):  # 'compile()'
-                    return False, func_error(node.func.id, node.lineno)
-                elif isinstance(node.func, ast.Attribute):  # module.compile()
-                    if node.func.attr in invalid_functions:
-                        return False, func_error(node.func.attr, node.lineno)
-            elif isinstance(node, ast.Attribute):  # module.compile
-                if node.attr in invalid_functions:
-                    return False, func_error(node.attr, node.lineno)
-        return True, None
+        result = self._validation()
+        if result.is_valid:
+            return True, None
+        return False, [violation.as_dict() for violation in result.violations]
+
+    def is_deterministic(self) -> bool:
+        """
+        checks that the solution can't depend on anything but its input
+        (no nondeterministic imports such as `random` or `time`, and no names such as `id`),
+        only deterministic solutions can have their results cached.
+
+        Returns:
+            bool
+        """
+        result = self._validation()
+        return result.is_valid and result.deterministic
 
     def _execute_python_code(self):
         """
@@ -110,6 +99,11 @@ class PythonFile:
         return func
 
 
+def hash_source_code(source_code: str) -> str:
+    """SHA-256 of the source code, used as the key of the workers' code cache"""
+    return hashlib.sha256(source_code.encode("utf-8")).hexdigest()
+
+
 def get_ast(source_code: str):
     """get the Abstract Syntax Tree of a file
 
@@ -127,31 +121,15 @@ def validate_file(source_code: str, allowed_imports: List):
     """validate the imports of the file as well as any syntax errors
 
     Args:
-        tree (ast.AST): the AST of the file
+        source_code (str): string representation of a python file
         allowed_imports (set): a set of allowed imports
 
     Raises:
-        HTTPException: if there are any SyntaxErrors or if an invalid import was found
+        HTTPException: listing every SyntaxError or invalid import/function found
     """
-    # check for any syntax errors
-    try:
-        tree = get_ast(source_code=source_code)
-    except (SyntaxError, Exception) as e:
-        raise HTTPException(status_code=422, detail=f"VALIDATION ERROR: {str(e)}")
-
-    # check for any invalid imports
-    for node in ast.walk(tree):
-        if isinstance(node, ast.Import):
-            for alias in node.names:
-                if not alias.name in allowed_imports:
-                    raise HTTPException(
-                        422, f"VALIDATION ERROR: Import '{alias.name}' is not allowed"
-                    )
-        if isinstance(node, ast.ImportFrom):
-            if node.module not in allowed_imports:
-                raise HTTPException(
-                    422, f"VALIDATION ERROR: Import '{node.module}' is not allowed"
-                )
+    result = validate_source(source_code, get_policy(allowed_imports))
+    if not result.is_valid:
+        raise HTTPException(422, [violation.as_dict() for violation in result.violations])
 
 
 def _execute_python_code(source_code):
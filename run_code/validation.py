@@ -1,5 +1,168 @@
 import ast
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple
 from .exceptions import NotAllowedImportError
+import settings
+
+
+BANNED_NAMES = frozenset({"compile", "eval", "exec"})
+
+
+class Violation(NamedTuple):
+    line: int
+    col: int
+    message: str
+
+    def as_dict(self) -> Dict:
+        return {"line": self.line, "col": self.col, "message": self.message}
+
+
+class ValidationPolicy:
+    """the allowed imports and banned names a file is validated against, hashed once"""
+
+    def __init__(
+        self,
+        allowed_imports: Iterable[str],
+        banned_names: Iterable[str] = BANNED_NAMES,
+        nondeterministic_modules: Iterable[str] = settings.NONDETERMINISTIC_MODULES,
+        nondeterministic_names: Iterable[str] = settings.NONDETERMINISTIC_NAMES,
+    ):
+        self.allowed_imports: FrozenSet[str] = frozenset(allowed_imports)
+        self.banned_names: FrozenSet[str] = frozenset(banned_names)
+        self.nondeterministic_modules: FrozenSet[str] = frozenset(nondeterministic_modules)
+        self.nondeterministic_names: FrozenSet[str] = frozenset(nondeterministic_names)
+        fingerprint = repr(tuple(sorted(s) for s in (
+            self.allowed_imports,
+            self.banned_names,
+            self.nondeterministic_modules,
+            self.nondeterministic_names,
+        )))
+        self.hash = hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+
+@lru_cache(maxsize=256)
+def _policy(allowed_imports: FrozenSet[str]) -> ValidationPolicy:
+    return ValidationPolicy(allowed_imports)
+
+
+def get_policy(allowed_imports: Iterable[str]) -> ValidationPolicy:
+    """the default policy for a set of allowed imports, built once per set"""
+    return _policy(frozenset(allowed_imports))
+
+
+class ValidationResult(NamedTuple):
+    violations: Tuple[Violation, ...]
+    # False if the file could depend on anything but its input (eg. it imports `random`)
+    deterministic: bool
+    # names bound at the top level of the file
+    defined_names: FrozenSet[str]
+
+    @property
+    def is_valid(self) -> bool:
+        return not self.violations
+
+
+class Validator(ast.NodeVisitor):
+    """collects every violation of a policy in a single pass over the tree"""
+
+    def __init__(self, policy: ValidationPolicy):
+        self.policy = policy
+        self.violations: List[Violation] = []
+        self.deterministic = True
+
+    def _add(self, node: ast.AST, message: str):
+        self.violations.append(Violation(node.lineno, node.col_offset, message))
+
+    def _check_module(self, node: ast.AST, module: str):
+        if module not in self.policy.allowed_imports:
+            self._add(node, f"VALIDATION ERROR line {node.lineno}: Import '{module}' is not allowed.")
+        if module.split(".")[0] in self.policy.nondeterministic_modules:
+            self.deterministic = False
+
+    def _check_name(self, node: ast.AST, name: str):
+        if name in self.policy.banned_names:
+            self._add(
+                node, f"VALIDATION ERROR line {node.lineno}: use of function '{name}' is not allowed."
+            )
+
+    def visit_Import(self, node: ast.Import):
+        for alias in node.names:
+            self._check_module(node, alias.name)
+
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        self._check_module(node, node.module or "")
+
+    def visit_Name(self, node: ast.Name):  # 'compile' and 'compile()'
+        self._check_name(node, node.id)
+        if node.id in self.policy.nondeterministic_names:
+            self.deterministic = False
+
+    def visit_Attribute(self, node: ast.Attribute):  # module.compile and module.compile()
+        self._check_name(node, node.attr)
+        self.generic_visit(node)
+
+
+def _defined_names(tree: ast.Module) -> FrozenSet[str]:
+    names = set()
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            names.update(target.id for target in targets if isinstance(target, ast.Name))
+    return frozenset(names)
+
+
+_verdicts: OrderedDict = OrderedDict()
+_verdicts_lock = threading.Lock()
+
+
+def validate_source(
+    source_code: str, policy: ValidationPolicy, source_hash: Optional[str] = None
+) -> ValidationResult:
+    """
+    validates a file against a policy, verdicts are cached by (source hash, policy hash).
+
+    Args:
+        source_code (str): string representation of a python file
+        policy (ValidationPolicy): see get_policy
+        source_hash (str, optional): SHA-256 of source_code, computed if not given
+
+    Returns:
+        ValidationResult: with every violation found, a syntax error is a single violation
+    """
+    if source_hash is None:
+        source_hash = hashlib.sha256(source_code.encode("utf-8")).hexdigest()
+    key = (source_hash, policy.hash)
+    with _verdicts_lock:
+        verdict = _verdicts.get(key)
+        if verdict is not None:
+            _verdicts.move_to_end(key)
+            return verdict
+
+    try:
+        tree = ast.parse(source=source_code)
+    except (SyntaxError, Exception) as e:
+        violation = Violation(
+            getattr(e, "lineno", None) or 0, getattr(e, "offset", None) or 0, f"VALIDATION ERROR: {str(e)}"
+        )
+        verdict = ValidationResult((violation,), False, frozenset())
+    else:
+        validator = Validator(policy)
+        validator.visit(tree)
+        verdict = ValidationResult(
+            tuple(validator.violations), validator.deterministic, _defined_names(tree)
+        )
+
+    with _verdicts_lock:
+        _verdicts[key] = verdict
+        if len(_verdicts) > settings.VALIDATION_CACHE_SIZE:
+            _verdicts.popitem(last=False)
+    return verdict
+
 
 def validate_imports(tree: ast.AST, allowed_imports: set):
     """validate the imports of the file
@@ -9,14 +172,10 @@ def validate_imports(tree: ast.AST, allowed_imports: set):
         allowed_imports (set): a set of allowed imports
 
     Raises:
-        NotAllowedImportError: if an invalid import was found.
+        NotAllowedImportError: listing every invalid import found.
         None: if all imports are valid
     """
-    for node in ast.walk(tree):
-        if isinstance(node, ast.Import):
-            for alias in node.names:
-                if not alias.name in allowed_imports:
-                    raise NotAllowedImportError(f"Import '{alias.name}' is not allowed")
-        if isinstance(node, ast.ImportFrom):
-            if node.module not in allowed_imports:
-                raise NotAllowedImportError(f"Import '{node.module}' is not allowed")
+    validator = Validator(ValidationPolicy(allowed_imports, banned_names=()))
+    validator.visit(tree)
+    if validator.violations:
+        raise NotAllowedImportError("\n".join(v.message for v in validator.violations))
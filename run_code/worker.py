@@ -0,0 +1,104 @@
+"""
+standalone execution node, consumes the redis job queue filled by `/run-code`
+when settings.EXECUTION_BACKEND is "queue".
+
+usage: python -m run_code.worker [--name NAME] [--concurrency N] [--metrics-port PORT]
+"""
+import argparse
+import signal
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .job_queue import JobQueue
+from .redis_operations import redis_operations
+from . import metrics, run_tests
+import settings
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """serves the node's metrics in the prometheus text format on every path"""
+
+    def do_GET(self):
+        queue_depth = redis_operations.get_list_length(settings.JOB_QUEUE_NAME)
+        if queue_depth is not None:
+            metrics.QUEUE_DEPTH.set(queue_depth)
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def consume(job_queue: JobQueue, stop_event: threading.Event):
+    """runs jobs from the queue until stop_event is set
+
+    Args:
+        job_queue (JobQueue): queue of this consumer.
+        stop_event (threading.Event): set to finish the current job and exit.
+    """
+    while not stop_event.is_set():
+        item = job_queue.dequeue()
+        if item is None:
+            continue
+        raw_job, job = item
+        try:
+            run_tests.run_tests(**job)
+        except Exception as e:
+            print(f"job {job.get('execution_id')} failed: {e}")
+        # a failing job is acknowledged as well, retrying it would fail again
+        job_queue.ack(raw_job)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="consume the run_code job queue")
+    parser.add_argument(
+        "--name", default=socket.gethostname(),
+        help="unique name of this node, it owns the node's processing lists",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=settings.JOB_QUEUE_CONCURRENCY,
+        help="number of jobs executed at the same time",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, default=None,
+        help="serve the node's metrics on this port",
+    )
+    args = parser.parse_args()
+    if settings.STORE_BACKEND == "memory":
+        parser.error("the job queue lives in redis, set store_backend to 'redis'")
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+
+    run_tests.pool.start()
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = ThreadingHTTPServer(("", args.metrics_port), MetricsHandler)
+        threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+    consumers = []
+    for i in range(args.concurrency):
+        job_queue = JobQueue(consumer=f"{args.name}-{i}")
+        requeued = job_queue.requeue_unacked()
+        if requeued:
+            print(f"requeued {requeued} unfinished jobs of {job_queue.processing}")
+        thread = threading.Thread(target=consume, args=(job_queue, stop_event))
+        thread.start()
+        consumers.append(thread)
+    print(f"worker {args.name} consuming {settings.JOB_QUEUE_NAME} with {args.concurrency} consumers")
+
+    # the main thread must stay free to receive signals
+    while any(thread.is_alive() for thread in consumers):
+        for thread in consumers:
+            thread.join(timeout=0.5)
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    run_tests.pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import types
+from multiprocessing import shared_memory
+from multiprocessing.connection import Connection
+from typing import Callable, Dict, Hashable, Iterable, Iterator, NamedTuple, Optional, Tuple, Union
+from .deadlines import DeadlineScheduler
+from . import metrics
+import settings
+
+
+WORKER_TIMEOUT = "TimeoutError"
+WORKER_CRASHED = "WorkerCrashed"
+WORKER_UNPICKLABLE = "SerializationError"
+SUBMISSION_TIMEOUT = "SubmissionTimeoutError"
+
+
+def _current_rss() -> int:
+    """resident set size of the calling process in bytes (0 if it can't be read)"""
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class _Segment(NamedTuple):
+    """an item pickled by a worker into a shared memory segment, the parent unlinks it once loaded"""
+    name: str
+    size: int
+
+
+def _dump_item(item, shm_min_bytes: int) -> Union[bytes, _Segment]:
+    """
+    pickles an item of a job, items of at least shm_min_bytes are left in shared memory
+    instead of being written through the pipe (0 disables it).
+    """
+    data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+    if not shm_min_bytes or len(data) < shm_min_bytes:
+        return data
+    try:
+        segment = shared_memory.SharedMemory(create=True, size=len(data))
+    except OSError:
+        # eg. /dev/shm is full
+        return data
+    segment.buf[:len(data)] = data
+    segment.close()
+    return _Segment(segment.name, len(data))
+
+
+def _load_item(payload: Union[bytes, _Segment]):
+    """the item of a job sent by _dump_item"""
+    if not isinstance(payload, _Segment):
+        return pickle.loads(payload)
+    segment = shared_memory.SharedMemory(name=payload.name)
+    try:
+        with segment.buf[:payload.size] as data:
+            return pickle.loads(data)
+    finally:
+        segment.close()
+        segment.unlink()
+
+
+def get_context(start_method: str = settings.WORKER_START_METHOD) -> multiprocessing.context.BaseContext:
+    """
+    the multiprocessing context the workers are started with, a forkserver
+    preloads run_code.preload (and so settings.PRELOAD_MODULES) once for all of them.
+    """
+    context = multiprocessing.get_context(start_method)
+    if start_method == "forkserver":
+        # only taken into account before the server starts, with `__main__` the main
+        # script is imported once by the server instead of once by every worker
+        context.set_forkserver_preload(["__main__", "run_code.preload"])
+    return context
+
+
+def _worker_loop(conn: Connection, shm_min_bytes: int = 0):
+    """
+    main loop of a pool worker, receives (target, args) jobs from the pool and
+    sends back the result of target(*args) together with the worker's memory usage.
+    if target is a generator function every item is sent as soon as it's produced,
+    each job ends with a `done` message carrying the stages the job timed.
+
+    Args:
+        conn (Connection): the worker's end of the pipe.
+        shm_min_bytes (int): pickled items this large go through shared memory, see _dump_item.
+    """
+    metrics.forward_stages()
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+
+        target, args = job
+        result = target(*args)
+        items = result if isinstance(result, types.GeneratorType) else [result]
+        for item in items:
+            try:
+                conn.send((_dump_item(item, shm_min_bytes), None, _current_rss(), False))
+            except Exception as e:
+                # the result could not be pickled (eg. the function returned a generator)
+                conn.send((str(e), WORKER_UNPICKLABLE, _current_rss(), False))
+        conn.send((metrics.drain_stages(), None, _current_rss(), True))
+    conn.close()
+
+
+class Worker:
+    """a long-lived sandbox process connected to the pool through a pipe"""
+
+    def __init__(self, context: Optional[multiprocessing.context.BaseContext] = None, shm_min_bytes: int = 0):
+        context = context or multiprocessing.get_context()
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_loop, args=(child_conn, shm_min_bytes), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.rss = 0
+        # key of the untrusted code the worker ran, whatever it changed in the process stays there
+        self.owner: Optional[Hashable] = None
+
+    def send(self, target: Callable, args: Tuple):
+        with metrics.timed("serialize"):
+            self.conn.send((target, args))
+        self.jobs += 1
+
+    def receive(self, timeout: float) -> Tuple[object, Optional[str], bool]:
+        """
+        waits for the next message of the running job.
+
+        Returns:
+            (item, error, done): error is WORKER_TIMEOUT if nothing arrived in time
+            and WORKER_CRASHED if the process died, done is True in both cases.
+        """
+        if not self.conn.poll(timeout):
+            return None, WORKER_TIMEOUT, True
+        try:
+            item, error, self.rss, done = self.conn.recv()
+        except (EOFError, OSError):
+            return None, WORKER_CRASHED, True
+        if done:
+            metrics.record_stages(item)
+            item = None
+        elif error is None:
+            with metrics.timed("deserialize"):
+                item = _load_item(item)
+        return item, error, done
+
+    def kill(self):
+        """kills the worker immediately (used when it timed out or crashed)"""
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        """asks the worker to exit gracefully and kills it if it doesn't"""
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    a pool of pre-forked workers, workers are recycled after `max_jobs` jobs or
+    when their memory grows past `max_memory` bytes, a worker that times out or
+    crashes is killed and replaced. workers are started with `start_method`, see get_context.
+    results of at least `shm_min_bytes` once pickled are passed through shared memory.
+    """
+
+    def __init__(
+        self,
+        size: int = settings.WORKER_POOL_SIZE,
+        max_jobs: int = settings.WORKER_MAX_JOBS,
+        max_memory: int = settings.WORKER_MAX_MEMORY_MB * 1024 * 1024,
+        start_method: str = settings.WORKER_START_METHOD,
+        shm_min_bytes: int = settings.WORKER_SHM_MIN_BYTES,
+    ):
+        self.size = size
+        self.shm_min_bytes = shm_min_bytes
+        self.start_method = start_method
+        self.context = get_context(start_method)
+        self.max_jobs = max_jobs
+        self.max_memory = max_memory
+        self._idle: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _spawn(self) -> Worker:
+        with metrics.timed("spawn"):
+            worker = Worker(self.context, self.shm_min_bytes)
+        metrics.WORKER_SPAWNS.inc()
+        return worker
+
+    def start(self):
+        """forks the workers of the pool, calling it on a started pool does nothing"""
+        with self._lock:
+            if self._started:
+                return
+            for _ in range(self.size):
+                self._idle.put(self._spawn())
+            self._started = True
+
+    def shutdown(self):
+        """stops every idle worker, busy workers are stopped when they are released"""
+        with self._lock:
+            self._started = False
+            while True:
+                try:
+                    worker = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                worker.stop()
+
+    def acquire(self, block: bool = True, timeout: Optional[float] = None, owner: Optional[Hashable] = None) -> Worker:
+        """
+        takes an idle worker out of the pool (the pool is started if it's not),
+        a worker that ran the code of another owner is replaced by a fresh one first.
+
+        Args:
+            owner (Hashable, optional): key of the untrusted code the job runs (eg. its source hash),
+                None for a job that runs none.
+
+        Raises:
+            queue.Empty: if there is no idle worker and block is False or the timeout expired
+        """
+        if not self._started:
+            self.start()
+        worker = self._idle.get(block=block, timeout=timeout)
+        metrics.WORKERS_ACTIVE.inc()
+        if worker.owner is not None and worker.owner != owner:
+            # patched builtins, modules or classes of the previous code leave with its process
+            worker.stop()
+            worker = self._spawn()
+            metrics.WORKER_REPLACEMENTS.inc()
+        worker.owner = owner
+        return worker
+
+    def release(self, worker: Worker):
+        """gives a worker back to the pool, recycling it if it's worn out"""
+        metrics.WORKERS_ACTIVE.dec()
+        if not self._started:
+            worker.stop()
+            return
+        if worker.jobs >= self.max_jobs or worker.rss > self.max_memory:
+            worker.stop()
+            worker = self._spawn()
+        self._idle.put(worker)
+
+    def discard(self, worker: Worker):
+        """kills a misbehaving worker and replaces it with a fresh one"""
+        metrics.WORKERS_ACTIVE.dec()
+        worker.kill()
+        if self._started:
+            self._idle.put(self._spawn())
+
+    def _expired_error(self, scheduler: DeadlineScheduler) -> str:
+        return SUBMISSION_TIMEOUT if scheduler.out_of_budget() else WORKER_TIMEOUT
+
+    def run(
+        self,
+        target: Callable,
+        jobs: Iterable[Tuple],
+        timeout: float,
+        scheduler: Optional[DeadlineScheduler] = None,
+        owner: Optional[Callable[[Tuple], Hashable]] = None,
+    ) -> Iterator[Tuple[Tuple, Optional[dict], Optional[str]]]:
+        """
+        runs target once per job on the pool's workers, every running job is
+        watched at the same time and all jobs past their deadline are killed in one sweep.
+
+        Args:
+            target (Callable): a picklable function, executed inside the workers.
+            jobs (Iterable[Tuple]): arguments for target, one tuple per job.
+            timeout (float): seconds a single job is allowed to take.
+            scheduler (DeadlineScheduler, optional): carries the submission's overall deadline.
+            owner (Callable, optional): the owner of a job's untrusted code, see acquire.
+
+        Yields:
+            (job, result, error): error is None on success, otherwise it's one of
+            WORKER_TIMEOUT, SUBMISSION_TIMEOUT, WORKER_CRASHED (result is None)
+            or WORKER_UNPICKLABLE (result is the error message).
+        """
+        if scheduler is None:
+            scheduler = DeadlineScheduler()
+        pending = list(jobs)
+        in_flight: Dict[Worker, Tuple] = {}
+        try:
+            while pending or in_flight:
+                # dispatch to every idle worker, only block when nothing is running
+                while pending:
+                    try:
+                        worker = self.acquire(
+                            block=not in_flight,
+                            timeout=scheduler.remaining(),
+                            owner=owner(pending[0]) if owner is not None else None,
+                        )
+                    except queue.Empty:
+                        break
+                    job = pending.pop(0)
+                    worker.send(target, job)
+                    in_flight[worker] = job
+                    scheduler.watch(worker, timeout)
+
+                if scheduler.out_of_budget():
+                    for worker in scheduler:
+                        scheduler.forget(worker)
+                        self.discard(worker)
+                        metrics.WORKER_TIMEOUTS.inc()
+                        yield in_flight.pop(worker), None, SUBMISSION_TIMEOUT
+                    while pending:
+                        yield pending.pop(0), None, SUBMISSION_TIMEOUT
+                    return
+
+                ready, expired = scheduler.wait()
+                for worker in expired:
+                    scheduler.forget(worker)
+                    self.discard(worker)
+                    metrics.WORKER_TIMEOUTS.inc()
+                    yield in_flight.pop(worker), None, self._expired_error(scheduler)
+
+                for worker in ready:
+                    scheduler.forget(worker)
+                    job = in_flight.pop(worker)
+                    result, error, done = worker.receive(0)
+                    if error in (WORKER_TIMEOUT, WORKER_CRASHED):
+                        self.discard(worker)
+                        metrics.WORKER_CRASHES.inc()
+                        yield job, None, WORKER_CRASHED
+                        continue
+                    # the result is followed by the end of job message
+                    if not done and worker.receive(timeout)[1] is not None:
+                        self.discard(worker)
+                    else:
+                        self.release(worker)
+                    yield job, result, error
+        finally:
+            # the consumer stopped early, the remaining workers are still busy
+            for worker in in_flight:
+                scheduler.forget(worker)
+                self.discard(worker)
+
+    def stream(
+        self,
+        target: Callable,
+        args: Tuple,
+        timeout: float,
+        scheduler: Optional[DeadlineScheduler] = None,
+        owner: Optional[Hashable] = None,
+    ) -> Iterator[Tuple[object, Optional[str]]]:
+        """
+        runs a generator function on a single worker and yields its items as
+        soon as the worker produces them.
+
+        Args:
+            target (Callable): a picklable generator function.
+            args (Tuple): arguments for target.
+            timeout (float): seconds the worker may take to produce each item.
+            scheduler (DeadlineScheduler, optional): carries the submission's overall deadline.
+            owner (Hashable, optional): the owner of the job's untrusted code, see acquire.
+
+        Yields:
+            (item, error): like `run`, after a WORKER_TIMEOUT, SUBMISSION_TIMEOUT or
+            WORKER_CRASHED the worker is replaced and the stream ends.
+        """
+        if scheduler is None:
+            scheduler = DeadlineScheduler()
+        try:
+            worker = self.acquire(timeout=scheduler.remaining(), owner=owner)
+        except queue.Empty:
+            yield None, SUBMISSION_TIMEOUT
+            return
+
+        worker.send(target, args)
+        scheduler.watch(worker, timeout)
+        try:
+            while True:
+                ready, expired = scheduler.wait()
+                if expired:
+                    error = self._expired_error(scheduler)
+                elif not ready:
+                    continue
+                else:
+                    item, error, done = worker.receive(0)
+                if error in (WORKER_TIMEOUT, SUBMISSION_TIMEOUT, WORKER_CRASHED):
+                    scheduler.forget(worker)
+                    self.discard(worker)
+                    if error == WORKER_CRASHED:
+                        metrics.WORKER_CRASHES.inc()
+                    else:
+                        metrics.WORKER_TIMEOUTS.inc()
+                    worker = None
+                    yield None, error
+                    return
+                if done:
+                    scheduler.forget(worker)
+                    self.release(worker)
+                    worker = None
+                    return
+                scheduler.watch(worker, timeout)
+                yield item, error
+        finally:
+            # the consumer stopped early, the worker is still busy with the job
+            if worker is not None:
+                scheduler.forget(worker)
+                self.discard(worker)
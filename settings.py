@@ -18,6 +18,124 @@ FASTAPI_HOST = settings_dict.get("fastapi_host", "localhost")
 FASTAPI_PORT = int(settings_dict.get("fastapi_port", 5000))
 REDIS_HOST = settings_dict.get("redis_host", "localhost")
 REDIS_PORT = int(settings_dict.get("redis_port", 6379))
+# size of each process' redis connection pool
+REDIS_MAX_CONNECTIONS = int(settings_dict.get("redis_max_connections", 100))
+# size of the separate pool of the commands that hold their connection while they wait
+# (the long-polls of /get-result), a request finding it exhausted gets a 503
+REDIS_MAX_BLOCKING_CONNECTIONS = int(settings_dict.get("redis_max_blocking_connections", 50))
 REDIS_EXPIRE_SEC = int(settings_dict.get("redis_expire_sec", 10))
+# "redis": the state is shared by every node through redis, "memory": it's kept in the
+# process (a single API process with the "local" execution backend, no redis server needed)
+STORE_BACKEND = settings_dict.get("store_backend", "redis")
+# memory budget of the "memory" store, keys with an expiry are evicted past it
+MEMORY_STORE_MAX_MB = int(settings_dict.get("memory_store_max_mb", 256))
 RUN_TESTS_TIMEOUT = int(settings_dict.get("run_tests_timeout", 5))
+# overall wall-clock budget of a submission in seconds, 0 disables it
+RUN_TESTS_SUBMISSION_TIMEOUT = float(settings_dict.get("run_tests_submission_timeout", 0))
+# "suite": a single worker runs every test case, "parallel": one job per test case
+RUN_TESTS_MODE = settings_dict.get("run_tests_mode", "suite")
+# extra seconds a suite worker gets before it's considered stuck and killed
+RUN_TESTS_GRACE_SEC = float(settings_dict.get("run_tests_grace_sec", 1))
+WORKER_POOL_SIZE = int(settings_dict.get("worker_pool_size", os.cpu_count() or 1))
+WORKER_MAX_JOBS = int(settings_dict.get("worker_max_jobs", 100))
+WORKER_MAX_MEMORY_MB = int(settings_dict.get("worker_max_memory_mb", 256))
+# number of compiled solutions each worker keeps
+CODE_CACHE_SIZE = int(settings_dict.get("code_cache_size", 128))
+# "local": run_tests runs as a background task of the API, "queue": jobs are
+# pushed to a redis queue consumed by `python -m run_code.worker`
+EXECUTION_BACKEND = settings_dict.get("execution_backend", "local")
+JOB_QUEUE_NAME = settings_dict.get("job_queue_name", "run_code:jobs")
+JOB_QUEUE_POLL_SEC = float(settings_dict.get("job_queue_poll_sec", 1))
+JOB_QUEUE_CONCURRENCY = int(settings_dict.get("job_queue_concurrency", WORKER_POOL_SIZE))
+# /stream-result gives up if no event arrives for this many seconds
+STREAM_IDLE_TIMEOUT_SEC = float(settings_dict.get("stream_idle_timeout_sec", 30))
+# /stream-result streams open at the same time in each process, each one holds a connection
+# of a pool of this size (apart from the other commands') while it's open, more get a 503
+STREAM_MAX_CONCURRENT = int(settings_dict.get("stream_max_concurrent", 50))
+# longest a /get-result request may wait for its result (the `wait` query parameter)
+GET_RESULT_MAX_WAIT_SEC = float(settings_dict.get("get_result_max_wait_sec", 30))
+# results of deterministic solutions are cached per test case
+RESULT_CACHE_ENABLED = bool(settings_dict.get("result_cache_enabled", True))
+RESULT_CACHE_SIZE = int(settings_dict.get("result_cache_size", 10000))
+RESULT_CACHE_TTL_SEC = int(settings_dict.get("result_cache_ttl_sec", 3600))
+# a solution importing one of these modules or using one of these names is never cached
+NONDETERMINISTIC_MODULES = set(settings_dict.get(
+    "nondeterministic_modules",
+    ["random", "time", "datetime", "secrets", "uuid", "os", "sys", "threading", "multiprocessing"],
+))
+NONDETERMINISTIC_NAMES = set(settings_dict.get(
+    "nondeterministic_names", ["id", "hash", "input", "open", "globals", "locals", "vars"]
+))
+# registered test suites never expire when this is 0
+TEST_SUITE_TTL_SEC = int(settings_dict.get("test_suite_ttl_sec", 0))
+# memory budget of the decoded test suites each process keeps
+TEST_SUITE_CACHE_MB = int(settings_dict.get("test_suite_cache_mb", 64))
+# number of validation verdicts kept, keyed by (source hash, policy hash)
+VALIDATION_CACHE_SIZE = int(settings_dict.get("validation_cache_size", 1024))
+# print the stage timings of every execution as a JSON line
+METRICS_LOG_STAGES = settings_dict.get("metrics_log_stages", True)
+# executions running at the same time across every node, admitted submissions wait for a turn
+ADMISSION_MAX_RUNNING = int(settings_dict.get("admission_max_running", WORKER_POOL_SIZE))
+# admitted submissions waiting for a turn, /run-code answers 429 once it's full
+ADMISSION_MAX_QUEUED = int(settings_dict.get("admission_max_queued", 100))
+# an admitted execution gives its slot back after this long even if its executor died
+ADMISSION_LEASE_SEC = int(settings_dict.get("admission_lease_sec", 300))
+# executions waiting for a running slot are woken up when they're given one, they check again
+# this often in case the slots are held by executors that died (their leases run out)
+ADMISSION_RECHECK_SEC = float(settings_dict.get("admission_recheck_sec", 5))
+# submissions of a single user in flight at the same time (results not collected yet included)
+ADMISSION_MAX_PER_USER = int(settings_dict.get("admission_max_per_user", 4))
+# priority classes of /run-code from the highest, the running slots go to a lower class
+# only when the higher ones have nothing waiting
+ADMISSION_PRIORITIES = list(settings_dict.get("admission_priorities", ["sample", "submit"]))
+ADMISSION_DEFAULT_PRIORITY = settings_dict.get("admission_default_priority", "submit")
+# test cases a user is credited with on each of its turns of the deficit round-robin
+ADMISSION_QUANTUM = int(settings_dict.get("admission_quantum", 10))
+# header naming the user (eg. set by an authenticating proxy), the client's address is used without it
+USER_ID_HEADER = settings_dict.get("user_id_header", "X-User-Id")
+# Retry-After of the 429 responses
+ADMISSION_RETRY_AFTER_SEC = int(settings_dict.get("admission_retry_after_sec", 1))
+# default tolerance of the 'float' comparator (relative or absolute)
+COMPARATOR_TOLERANCE = float(settings_dict.get("comparator_tolerance", 1e-6))
+# "forkserver" starts the workers from a small server process that preloaded PRELOAD_MODULES,
+# "fork" copies the web server into every worker
+WORKER_START_METHOD = settings_dict.get("worker_start_method", "forkserver")
+# imported once by the forkserver so the workers start with them (missing modules are skipped)
+PRELOAD_MODULES = list(settings_dict.get(
+    "preload_modules",
+    ["collections", "heapq", "bisect", "itertools", "functools", "math", "re", "string", "operator", "numpy"],
+))
+# results a worker pickles to at least this many bytes are passed through shared memory
+# instead of the worker's pipe (0 sends everything through the pipe)
+WORKER_SHM_MIN_BYTES = int(settings_dict.get("worker_shm_min_bytes", 256 * 1024))
+# results of a regrade are written to redis every REGRADE_BATCH_SIZE submissions
+REGRADE_BATCH_SIZE = int(settings_dict.get("regrade_batch_size", 100))
+REGRADE_MAX_SUBMISSIONS = int(settings_dict.get("regrade_max_submissions", 10000))
+# the progress and results of a regrade are kept for this long
+REGRADE_TTL_SEC = int(settings_dict.get("regrade_ttl_sec", 86400))
+# results of finished executions are kept this long so /get-result can page through them
+RESULT_TTL_SEC = int(settings_dict.get("result_ttl_sec", 300))
+# outputs larger than this once encoded are truncated, their size and hash are kept
+RESULT_MAX_OUTPUT_BYTES = int(settings_dict.get("result_max_output_bytes", 64 * 1024))
+# "zlib" compresses the stored results of at least RESULT_COMPRESS_MIN_BYTES, "none" doesn't
+RESULT_COMPRESSION = settings_dict.get("result_compression", "zlib")
+RESULT_COMPRESS_MIN_BYTES = int(settings_dict.get("result_compress_min_bytes", 512))
+# results per /get-result page (the largest `limit`)
+GET_RESULT_PAGE_SIZE = int(settings_dict.get("get_result_page_size", 1000))
+# test cases profiled at most by an execution with profile=true
+PROFILE_MAX_TEST_CASES = int(settings_dict.get("profile_max_test_cases", 3))
+# functions and allocation sites kept in every profile report
+PROFILE_TOP = int(settings_dict.get("profile_top", 10))
+# time budget of a /complexity analysis, the sizes stop growing once it's used up
+COMPLEXITY_DEFAULT_BUDGET_SEC = float(settings_dict.get("complexity_default_budget_sec", 5))
+COMPLEXITY_MAX_BUDGET_SEC = float(settings_dict.get("complexity_max_budget_sec", 30))
+# largest input size /complexity accepts
+COMPLEXITY_MAX_SIZE = int(settings_dict.get("complexity_max_size", 10 ** 7))
+# timed runs per size, the fastest one is fitted
+COMPLEXITY_REPEATS = int(settings_dict.get("complexity_repeats", 3))
+# sizes measured at least for the growth to be fitted
+COMPLEXITY_MIN_SIZES = int(settings_dict.get("complexity_min_sizes", 4))
+# a simpler growth class is preferred while its fit's error is at most this much larger (relatively)
+# than the best one's
+COMPLEXITY_FIT_TOLERANCE = float(settings_dict.get("complexity_fit_tolerance", 0.25))
 # print("RUN_TESTS_TIMEOUT: ", RUN_TESTS_TIMEOUT)
@@ -0,0 +1,24 @@
+import pytest
+from run_code import redis_operations, run_tests
+from run_code.memory_store import AsyncMemoryClient, MemoryStore
+from run_code.worker_pool import WorkerPool
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """a single worker pool, every job of a test runs in the same worker unless it's replaced"""
+    pool = WorkerPool(size=1)
+    monkeypatch.setattr(run_tests, "pool", pool)
+    yield pool
+    pool.shutdown()
+
+
+@pytest.fixture
+def store(monkeypatch):
+    """an in-process store behind both the sync and the async operations"""
+    store = MemoryStore()
+    monkeypatch.setattr(redis_operations.redis_operations, "client", store)
+    monkeypatch.setattr(redis_operations.async_redis_operations, "client", AsyncMemoryClient(store))
+    monkeypatch.setattr(redis_operations.async_blocking_operations, "client", AsyncMemoryClient(store))
+    monkeypatch.setattr(redis_operations.async_stream_operations, "client", AsyncMemoryClient(store))
+    return store
@@ -0,0 +1,81 @@
+import asyncio
+import threading
+import time
+import pytest
+import settings
+from run_code import admission
+from run_code.redis_operations import async_redis_operations, redis_operations
+
+
+@pytest.fixture
+def one_slot(store, monkeypatch):
+    monkeypatch.setattr(settings, "ADMISSION_MAX_RUNNING", 1)
+    # longer than any test, a waiter that isn't woken up fails
+    monkeypatch.setattr(settings, "ADMISSION_RECHECK_SEC", 30)
+
+
+def admit(*execution_ids):
+    for execution_id in execution_ids:
+        assert asyncio.run(admission.admit_async(f"user-{execution_id}", execution_id)) == admission.ADMITTED
+
+
+def test_waiter_is_woken_up_by_the_release(one_slot, monkeypatch):
+    admit("a", "b")
+    assert admission.wait_for_turn("a", "user-a")
+    starts = []
+    run_script = redis_operations.run_script
+    monkeypatch.setattr(redis_operations, "run_script", lambda *args: starts.append(args) or run_script(*args))
+    waiter = threading.Thread(target=admission.wait_for_turn, args=("b", "user-b"))
+    waiter.start()
+    time.sleep(0.1)
+    assert waiter.is_alive()
+    started = time.monotonic()
+    admission.release("user-a", "a", free_user=True)
+    waiter.join(5)
+    assert not waiter.is_alive()
+    assert time.monotonic() - started < 1
+    # its start script ran once, it didn't poll
+    assert len([args for args in starts if args[0] == admission.START_SCRIPT]) == 1
+
+
+def test_async_waiter_is_woken_up_by_the_release(one_slot):
+    admit("a", "b")
+
+    async def scenario():
+        assert await admission.wait_for_turn_async("a", "user-a")
+        waiter = asyncio.create_task(admission.wait_for_turn_async("b", "user-b"))
+        await asyncio.sleep(0.1)
+        assert not waiter.done()
+        await admission.release_async("user-a", "a", free_user=True)
+        return await asyncio.wait_for(waiter, 1)
+
+    assert asyncio.run(scenario())
+
+
+def test_a_slot_held_by_a_dead_executor_is_given_back_when_its_lease_runs_out(one_slot, monkeypatch):
+    admit("a", "b")
+    assert admission.wait_for_turn("a", "user-a")
+    monkeypatch.setattr(settings, "ADMISSION_RECHECK_SEC", 0.1)
+    # "a" never releases its slot
+    monkeypatch.setattr(admission.time, "time", lambda: time.monotonic() + settings.ADMISSION_LEASE_SEC + 1e9)
+    assert admission.wait_for_turn("b", "user-b")
+
+
+def test_turns_follow_the_priority_classes(one_slot):
+    admit("a", "low", "high")
+    assert admission.wait_for_turn("a", "user-a")
+    order = []
+    waiters = [
+        threading.Thread(target=lambda _id=_id, priority=priority: admission.wait_for_turn(
+            _id, f"user-{_id}", priority) and order.append(_id))
+        for _id, priority in (("low", settings.ADMISSION_PRIORITIES[-1]), ("high", settings.ADMISSION_PRIORITIES[0]))
+    ]
+    for waiter in waiters:
+        waiter.start()
+        time.sleep(0.1)
+    admission.release("user-a", "a", free_user=True)
+    time.sleep(0.1)
+    admission.release("user-high", "high", free_user=True)
+    for waiter in waiters:
+        waiter.join(5)
+    assert order == ["high", "low"]
@@ -0,0 +1,26 @@
+import pytest
+from fastapi.testclient import TestClient
+import main
+from run_code.redis_operations import async_blocking_operations
+
+
+@pytest.fixture
+def client(store):
+    return TestClient(main.app)
+
+
+def test_long_poll_times_out(client):
+    response = client.get("/get-result/missing", params={"wait": 0.05})
+    assert response.status_code == 404
+
+
+def test_long_poll_is_rejected_when_the_blocking_pool_is_exhausted(client, monkeypatch):
+    monkeypatch.setattr(async_blocking_operations, "in_use", async_blocking_operations.max_connections)
+    response = client.get("/get-result/missing", params={"wait": 1})
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+
+def test_without_wait_the_blocking_pool_is_not_used(client, monkeypatch):
+    monkeypatch.setattr(async_blocking_operations, "in_use", async_blocking_operations.max_connections)
+    assert client.get("/get-result/missing").status_code == 404
@@ -0,0 +1,53 @@
+import pytest
+from run_code import run_tests
+from run_code.deadlines import DeadlineScheduler
+from run_code.utils import hash_source_code
+
+
+PATCH_BUILTINS = """
+import math
+__builtins__['sum'] = lambda *args: 42
+math.sqrt = lambda x: -1.0
+
+def solve(a, b):
+    return a + b
+"""
+
+PATCH_BUILTINS_MODULE = """
+import builtins
+builtins.sum = lambda *args: 42
+
+def solve(a, b):
+    return a + b
+"""
+
+VICTIM = """
+import math
+
+def solve(a, b):
+    return sum([a, b]) + int(math.sqrt(0))
+"""
+
+TEST_CASES = [{"id": 1, "input": [1, 2], "expected": 3}, {"id": 2, "input": [2, 5], "expected": 7}]
+
+
+def _run(run, source_code):
+    return list(run(source_code, hash_source_code(source_code), TEST_CASES, DeadlineScheduler()))
+
+
+@pytest.mark.parametrize("run", [run_tests._run_suite, run_tests._run_parallel])
+@pytest.mark.parametrize("attacker", [PATCH_BUILTINS, PATCH_BUILTINS_MODULE])
+def test_submissions_dont_share_worker_state(pool, run, attacker):
+    assert [result["verdict"] for result in _run(run, attacker)] == ["Accepted", "Accepted"]
+    results = _run(run, VICTIM)
+    assert [result["output"] for result in results] == [3, 7]
+    assert [result["verdict"] for result in results] == ["Accepted", "Accepted"]
+
+
+def test_worker_is_kept_for_the_same_source(pool):
+    _run(run_tests._run_suite, VICTIM)
+    worker = pool._idle.queue[0]
+    _run(run_tests._run_suite, VICTIM)
+    assert pool._idle.queue[0] is worker
+    _run(run_tests._run_suite, PATCH_BUILTINS)
+    assert pool._idle.queue[0] is not worker
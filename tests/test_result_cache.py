@@ -0,0 +1,72 @@
+import pytest
+from run_code import result_cache as result_cache_module
+from run_code.memory_store import MemoryStore
+from run_code.redis_operations import RedisOperations
+from run_code.result_cache import ResultCache, decode_result, encode_result
+
+
+def make_result(output):
+    return {"id": "1", "output": output, "error": None, "verdict": "Accepted", "runtime_ms": 1.0}
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """a result cache on an in-process store"""
+    cache = ResultCache(maxsize=8, ttl=60, redis_ops=RedisOperations(client=MemoryStore()))
+    monkeypatch.setattr(result_cache_module, "result_cache", cache)
+    return cache
+
+
+@pytest.mark.parametrize("output", [(1, 2), {1: 1}, {1, 2}, [(1, "a")], b"\x00", 1.5, None, "text"])
+def test_output_round_trips(output):
+    decoded = decode_result(encode_result(make_result(output)))
+    assert decoded["output"] == output
+    assert type(decoded["output"]) is type(output)
+    assert "id" not in decoded
+
+
+@pytest.mark.parametrize("output", [frozenset({1}), float("nan"), object()])
+def test_outputs_that_are_not_literals_are_not_cached(cache, output):
+    assert encode_result(make_result(output)) is None
+    assert not cache.set("key", make_result(output))
+    assert cache.get_many(["key"]) == {}
+
+
+@pytest.mark.parametrize("output", [(1, 2), {1: 1}])
+def test_hit_is_judged_on_the_original_output(cache, output):
+    test_case = {"id": "7", "input": [1], "expected": output}
+    key = result_cache_module.cache_key("hash", [], test_case)
+    assert cache.set(key, make_result(output))
+    # read back from the store, not the LRU
+    cache._lru.clear()
+    cached_results, misses, _ = result_cache_module.lookup("hash", [], [test_case])
+    assert misses == []
+    assert cached_results[0]["id"] == "7"
+    assert cached_results[0]["output"] == output
+    assert cached_results[0]["verdict"] == "Accepted"
+
+
+def test_hit_keeps_the_verdict_judged_the_same_way(cache):
+    test_case = {"id": "7", "input": [1], "expected": 0.1 + 0.2}
+    key = result_cache_module.cache_key("hash", [], test_case)
+    judged_by = result_cache_module.judging_key(test_case, "float", 1e-9)
+    assert cache.set(key, make_result(0.3), judged_by=judged_by)
+    cache._lru.clear()
+    cached_results, _, _ = result_cache_module.lookup("hash", [], [test_case], (), "float", 1e-9)
+    assert cached_results[0]["verdict"] == "Accepted"
+    assert "judged_by" not in cached_results[0]
+
+
+@pytest.mark.parametrize("comparator, tolerance, expected, verdict", [
+    # another expected value
+    ("exact", 0, (2, 1), "WrongAnswer"),
+    # the same expected value judged another way
+    ("unordered", 0, (1, 2), "Accepted"),
+])
+def test_hit_is_judged_again_another_way(cache, comparator, tolerance, expected, verdict):
+    key = result_cache_module.cache_key("hash", [], {"input": [1]})
+    judged_by = result_cache_module.judging_key({"expected": (1, 2)}, "exact", 0)
+    assert cache.set(key, make_result((1, 2)), judged_by=judged_by)
+    test_case = {"id": "7", "input": [1], "expected": expected}
+    cached_results, _, _ = result_cache_module.lookup("hash", [], [test_case], (), comparator, tolerance)
+    assert cached_results[0]["verdict"] == verdict
@@ -0,0 +1,28 @@
+import pytest
+from fastapi.testclient import TestClient
+import main
+from run_code.redis_operations import async_stream_operations
+from run_code.run_tests import events_stream_name
+
+
+@pytest.fixture
+def client(store):
+    return TestClient(main.app)
+
+
+def test_stream_ends_with_the_summary_and_gives_its_connection_back(client, store):
+    store.xadd(events_stream_name("1"), {"event": "result", "data": "{}"})
+    store.xadd(events_stream_name("1"), {"event": "summary", "data": "{}"})
+    response = client.get("/stream-result/1")
+    assert response.status_code == 200
+    assert [line for line in response.text.splitlines() if line.startswith("event:")] == [
+        "event: result", "event: summary",
+    ]
+    assert async_stream_operations.in_use == 0
+
+
+def test_stream_is_rejected_when_too_many_are_open(client, monkeypatch):
+    monkeypatch.setattr(async_stream_operations, "in_use", async_stream_operations.max_connections)
+    response = client.get("/stream-result/1")
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
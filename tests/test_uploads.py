@@ -0,0 +1,62 @@
+import json
+import tempfile
+import pytest
+from fastapi.testclient import TestClient
+import main
+
+
+SOLUTION = b"def solve(a, b):\n    return a + b\n"
+TEST_CASES = b"\n".join(json.dumps({"id": i, "input": [i, 1], "expected": i + 1}).encode() for i in range(3))
+
+
+@pytest.fixture
+def uploads_dir(monkeypatch, tmp_path):
+    """where the uploaded test case files are copied"""
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    return tmp_path
+
+
+@pytest.fixture
+def client(store):
+    # without the lifespan, nothing is executed
+    return TestClient(main.app)
+
+
+@pytest.mark.parametrize("data, status_code", [
+    # a parameter rejected after the file was written
+    ({"allowed_imports": "", "comparator": "nope"}, 422),
+    ({"allowed_imports": "", "test_suite_id": "missing"}, 404),
+])
+def test_run_code_removes_the_upload_of_a_rejected_request(client, uploads_dir, data, status_code):
+    response = client.post(
+        "/run-code",
+        data=data,
+        files={"python_file": ("solution.py", SOLUTION), "test_cases_file": ("cases.jsonl", TEST_CASES)},
+    )
+    assert response.status_code == status_code
+    assert list(uploads_dir.iterdir()) == []
+
+
+def test_regrade_removes_the_upload_of_a_rejected_request(client, uploads_dir):
+    response = client.post(
+        "/regrade",
+        data={"allowed_imports": "", "comparator": "nope"},
+        files={"submissions": ("submissions.jsonl", b'{"submission_id": 1, "source": "def solve(): pass"}'),
+               "test_cases_file": ("cases.jsonl", TEST_CASES)},
+    )
+    assert response.status_code == 422
+    assert list(uploads_dir.iterdir()) == []
+
+
+def test_handed_over_upload_is_kept(client, uploads_dir, monkeypatch):
+    handed_over = []
+    monkeypatch.setattr(main.run_code.run_tests, "run_tests", lambda **job: handed_over.append(job["test_cases"]))
+    response = client.post(
+        "/run-code",
+        data={"allowed_imports": ""},
+        files={"python_file": ("solution.py", SOLUTION), "test_cases_file": ("cases.jsonl", TEST_CASES)},
+    )
+    assert response.status_code == 200
+    assert [test_case["id"] for test_case in handed_over[0]] == [0, 1, 2]
+    handed_over[0].close()
+    assert list(uploads_dir.iterdir()) == []